@@ -1,9 +1,9 @@
 import logging
+import os
 import theano
 
 from collections import Counter
 
-from blocks.algorithms import (GradientDescent, StepClipping, AdaDelta, CompositeRule, RemoveNotFinite)
 from blocks.extensions import FinishAfter, Printing
 from blocks.extensions.monitoring import TrainingDataMonitoring
 from blocks.filter import VariableFilter
@@ -11,9 +11,13 @@ from blocks.graph import ComputationGraph, apply_noise, apply_dropout
 from blocks.main_loop import MainLoop
 from blocks.model import Model
 
+from algorithms import create_algorithm
 from helpers import create_model, create_multitask_model
 from checkpoint import CheckpointNMT, LoadNMT
 from sampling import F1Validator, Sampler
+from stream import PackAudio, PackingStatistics, find_transformer
+from timing import PipelineTiming, time_stream_stages
+from training_log import AppendOnlyLog, LOG_RECORDS_FILENAME
 
 try:
     from blocks_extras.extensions.plot import Plot
@@ -29,7 +33,13 @@ theano.config.on_unused_input = 'warn'
 theano.config.exception_verbosity = 'low'
 
 
-def main(config, tr_stream, dev_stream, use_bokeh=False):
+def main(config, tr_stream, dev_stream, use_bokeh=False, rank=0, reducer=None):
+    """Trains the model.
+
+    With a `reducer` this is data parallel worker `rank` (see parallel.py),
+    only rank 0 monitors, checkpoints, validates and decides when to stop.
+
+    """
 
     logger.info('Building RNN encoder-decoder')
     cost, samples, search_model = create_model(config)
@@ -49,15 +59,26 @@ def main(config, tr_stream, dev_stream, use_bokeh=False):
 
     # Set extensions
     logger.info("Initializing extensions")
-    extensions = [
-        FinishAfter(after_n_batches=config['finish_after']),
-        TrainingDataMonitoring([cost], after_batch=True),
-        Printing(after_batch=True),
-        CheckpointNMT(config['saveto'], every_n_batches=config['save_freq'])
-    ]
-
-    # Add sampling
-    if config['hook_samples'] >= 1:
+    extensions = []
+    if rank == 0:
+        extensions = [
+            FinishAfter(after_n_batches=config['finish_after']),
+            TrainingDataMonitoring([cost], after_batch=True),
+            Printing(after_batch=True),
+            CheckpointNMT(config['saveto'], every_n_batches=config['save_freq'])
+        ]
+    elif config['save_freq']:
+        # The other workers save the cursors of their shards
+        extensions = [CheckpointNMT(config['saveto'], rank=rank, every_n_batches=config['save_freq'])]
+
+    # Report how much padding the packing saves
+    if rank == 0 and config['pack_audio']:
+        extensions.append(PackingStatistics(find_transformer(tr_stream, PackAudio)))
+
+    # Add sampling, which needs unpacked batches
+    if rank == 0 and config['hook_samples'] >= 1 and config['pack_audio']:
+        logger.info("Sampling is disabled with packed audio")
+    elif rank == 0 and config['hook_samples'] >= 1:
         logger.info("Building sampler")
         extensions.append(
             Sampler(model=search_model, data_stream=tr_stream,
@@ -67,7 +88,7 @@ def main(config, tr_stream, dev_stream, use_bokeh=False):
                     src_vocab_size=config['src_vocab_size']))
 
     # Add early stopping based on f1
-    if config['f1_validation'] is not None:
+    if rank == 0 and config['f1_validation'] is not None:
         logger.info("Building f1 validator")
         extensions.append(
             F1Validator(samples=samples, config=config,
@@ -77,15 +98,23 @@ def main(config, tr_stream, dev_stream, use_bokeh=False):
 
     # Reload model if necessary
     if config['reload']:
-        extensions.append(LoadNMT(config['saveto']))
+        extensions.append(LoadNMT(config['saveto'], load_log=rank == 0, rank=rank))
+
+    # Time where the batches go, after the other extensions were added
+    if rank == 0 and config['pipeline_timing']:
+        if not os.path.exists(config['saveto']):
+            os.makedirs(config['saveto'])
+        extensions.append(PipelineTiming(os.path.join(config['saveto'], 'metrics.prom'),
+                                         time_stream_stages(tr_stream), window=config['timing_window']))
 
     # Set up training algorithm
     logger.info("Initializing training algorithm")
-    algorithm = GradientDescent(
-        cost=cost, parameters=cg.parameters,
-        step_rule=CompositeRule([StepClipping(config['step_clipping']), eval(config['step_rule'])(), RemoveNotFinite()]),
-        on_unused_sources='warn'
-    )
+    algorithm = create_algorithm(config, cost, cg.parameters, training_model, reducer)
+
+    # Keep only recent log rows in memory, older ones go to a file
+    log = None
+    if rank == 0 and config['log_backend'] == 'append':
+        log = AppendOnlyLog(os.path.join(config['saveto'], LOG_RECORDS_FILENAME))
 
     # Initialize main loop
     logger.info("Initializing main loop")
@@ -93,6 +122,7 @@ def main(config, tr_stream, dev_stream, use_bokeh=False):
         model=training_model,
         algorithm=algorithm,
         data_stream=tr_stream,
+        log=log,
         extensions=extensions
     )
 
@@ -18,7 +18,11 @@ import pprint
 
 import config
 
+from blocks.graph import ComputationGraph
+
 from __init__ import main
+from helpers import create_model, uses_prosody
+from parallel import parameter_count, run_workers
 from lexicon import create_dictionary_from_lexicon, create_dictionary_from_punctuation_marks
 from stream import get_tr_stream, get_dev_stream
 
@@ -30,14 +34,31 @@ logger.setLevel(logging.INFO)
 parser = argparse.ArgumentParser()
 parser.add_argument("--proto",  default="get_config", help="Prototype config to use for config")
 parser.add_argument("--bokeh",  default=False, action="store_true", help="Use bokeh server for plotting")
+parser.add_argument("--workers", type=int, default=1, help="Number of data parallel training processes")
 args = parser.parse_args()
 
 
+def create_streams(config, data_path, shard=None):
+    tr_stream = get_tr_stream(data_path, config["src_eos_idx"], config["phones"]["sil"], config["trg_eos_idx"], seq_len=config["seq_len"], batch_size=config["batch_size"], sort_k_batches=config["sort_k_batches"], seed=config["shuffle_seed"], prosody=uses_prosody(config),
+                              pack_audio=config["pack_audio"], pack_length=config["pack_length"], pack_align=config["frame_downsampling"], shard=shard,
+                              teacher_posteriors=config["distill_posteriors"])
+    dev_stream = get_dev_stream(data_path, prosody=uses_prosody(config))
+    return tr_stream, dev_stream
+
+
+def train_worker(rank, reducer, config, data_path, use_bokeh):
+    tr_stream, dev_stream = create_streams(config, data_path, (rank, reducer.workers))
+    main(config, tr_stream, dev_stream, use_bokeh and rank == 0, rank, reducer)
+
+
 if __name__ == "__main__":
     config = getattr(config, args.proto)()
     #logger.info("Model options:\n{}".format(pprint.pformat(config)))
 
     data_path = "%s/data_global_cmvn_with_phones_alignment_pitch_features.h5" % config["data_dir"]
-    tr_stream = get_tr_stream(data_path, config["src_eos_idx"], config["phones"]["sil"], config["trg_eos_idx"], seq_len=config["seq_len"], batch_size=config["batch_size"], sort_k_batches=config["sort_k_batches"])
-    dev_stream = get_dev_stream(data_path)
-    main(config, tr_stream, dev_stream, args.bokeh)
+    if args.workers > 1:
+        cost, _, _ = create_model(config)
+        run_workers(args.workers, parameter_count(ComputationGraph(cost).parameters), train_worker, config, data_path, args.bokeh)
+    else:
+        tr_stream, dev_stream = create_streams(config, data_path)
+        main(config, tr_stream, dev_stream, args.bokeh)
@@ -0,0 +1,116 @@
+import logging
+
+from collections import OrderedDict
+from theano import tensor
+
+from blocks.algorithms import (GradientDescent, StepClipping, AdaDelta, CompositeRule, RemoveNotFinite)
+from blocks.filter import VariableFilter
+from blocks.graph import ComputationGraph
+from blocks.roles import INPUT, OUTPUT
+from blocks.utils import shared_floatx_zeros_matching
+
+from model import BidirectionalEncoder
+from parallel import DataParallelGradientDescent
+
+logger = logging.getLogger(__name__)
+
+
+def create_algorithm(config, cost, parameters, model, reducer=None):
+    """Creates the training algorithm selected by the config.
+
+    With a `reducer` the gradients are averaged over data parallel
+    workers, see parallel.py.
+
+    """
+    step_rule = CompositeRule([StepClipping(config['step_clipping']), eval(config['step_rule'])(), RemoveNotFinite()])
+    if reducer is not None:
+        if config['sparse_embeddings']:
+            raise ValueError("Sparse embedding updates are not implemented for data parallel training")
+        # The gradients are reduced by position, so all workers need the same order
+        parameters = [parameter for _, parameter in sorted(model.get_parameter_dict().items())
+                      if parameter in parameters]
+        return DataParallelGradientDescent(cost, parameters, step_rule, reducer, on_unused_sources='warn')
+
+    if not config['sparse_embeddings']:
+        return GradientDescent(
+            cost=cost, parameters=parameters,
+            step_rule=step_rule,
+            on_unused_sources='warn'
+        )
+
+    if config['step_rule'] != 'AdaDelta':
+        raise ValueError("Sparse embedding updates are implemented only for AdaDelta")
+    encoders = [brick for brick in model.get_top_bricks() if isinstance(brick, BidirectionalEncoder)]
+    if not encoders:
+        raise ValueError("Sparse embedding updates need the words encoder")
+
+    logger.info("Using sparse updates for {}".format(encoders[0].lookup.name))
+    gradients, updates = sparse_lookup_gradients(cost, parameters, encoders[0].lookup, config['step_clipping'])
+    algorithm = GradientDescent(
+        gradients=gradients,
+        step_rule=CompositeRule([AdaDelta(), RemoveNotFinite()]),
+        on_unused_sources='warn'
+    )
+    algorithm.add_updates(updates)
+    return algorithm
+
+
+def sparse_lookup_gradients(cost, parameters, lookup, threshold,
+                            decay_rate=0.95, epsilon=1e-6):
+    """Computes AdaDelta updates touching only the looked up rows.
+
+    The lookup table is removed from the dense parameters, its gradient is
+    taken with respect to the looked up embeddings and accumulated per
+    unique row. AdaDelta statistics and the table itself are updated only
+    in these rows with inplace subtensor updates. Gradient clipping uses
+    the norm of the dense and the sparse gradients together and the
+    non-finite check mimics `RemoveNotFinite`.
+
+    Returns clipped gradients of the remaining parameters (to be used with
+    `GradientDescent` without `StepClipping`) and the sparse updates.
+
+    """
+    table = lookup.W
+    parameters = [p for p in parameters if p is not table]
+
+    cg = ComputationGraph(cost)
+    indices, = VariableFilter(bricks=[lookup], roles=[INPUT])(cg.variables)
+    embeddings, = VariableFilter(bricks=[lookup], roles=[OUTPUT])(cg.variables)
+
+    gradients = tensor.grad(cost, [embeddings] + parameters)
+    embeddings_gradient = gradients[0].reshape((-1, lookup.dim))
+
+    # Sum the gradient of repeated words into one row
+    rows, inverse = tensor.extra_ops.Unique(return_inverse=True)(indices.flatten())
+    rows_gradient = tensor.inc_subtensor(
+        tensor.zeros((rows.shape[0], lookup.dim), dtype=table.dtype)[inverse],
+        embeddings_gradient)
+
+    norm = tensor.sqrt(sum(tensor.sqr(g).sum() for g in gradients[1:]) +
+                       tensor.sqr(rows_gradient).sum())
+    multiplier = tensor.switch(norm < threshold, 1, threshold / norm)
+    not_finite = tensor.or_(tensor.isnan(norm), tensor.isinf(norm))
+
+    rows_gradient = multiplier * rows_gradient
+    mean_square_step = shared_floatx_zeros_matching(table, name='mean_square_step_tm1')
+    mean_square_delta = shared_floatx_zeros_matching(table, name='mean_square_delta_x_tm1')
+
+    mean_square_step_t = (decay_rate * mean_square_step[rows] +
+                          (1 - decay_rate) * tensor.sqr(rows_gradient))
+    delta_x_t = (tensor.sqrt(mean_square_delta[rows] + epsilon) /
+                 tensor.sqrt(mean_square_step_t + epsilon) * rows_gradient)
+    mean_square_delta_t = (decay_rate * mean_square_delta[rows] +
+                           (1 - decay_rate) * tensor.sqr(delta_x_t))
+
+    step = tensor.switch(not_finite, 0.1 * table[rows], delta_x_t)
+    mean_square_step_t = tensor.switch(not_finite, mean_square_step[rows], mean_square_step_t)
+    mean_square_delta_t = tensor.switch(not_finite, mean_square_delta[rows], mean_square_delta_t)
+
+    updates = [
+        (mean_square_step, tensor.set_subtensor(mean_square_step[rows], mean_square_step_t)),
+        (mean_square_delta, tensor.set_subtensor(mean_square_delta[rows], mean_square_delta_t)),
+        (table, tensor.inc_subtensor(table[rows], -step)),
+    ]
+    dense_gradients = OrderedDict(
+        (p, multiplier * g) for p, g in zip(parameters, gradients[1:]))
+    return dense_gradients, updates
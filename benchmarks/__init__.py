@@ -0,0 +1,7 @@
+"""Benchmarks which run on synthetic data.
+
+Run them from the repository root, e.g.
+
+    python -m benchmarks.sparse_embeddings
+
+"""
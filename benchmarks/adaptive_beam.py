@@ -0,0 +1,81 @@
+"""F1 and speed of the adaptive beam for several margins.
+
+    python -m benchmarks.adaptive_beam DATA_H5 MODEL_DIR PARAMS --margins 0.5 1 2 4
+
+Decodes the dev set with the full beam of config['beam_size'] and with
+`AdaptiveBeamSearch` for every margin, which gives a curve of F1 over
+decoding speed. A margin of 0 is greedy search.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import numpy
+import time
+
+from collections import OrderedDict
+from itertools import islice
+
+from benchmarks.common import f1, reference_marks, report
+
+
+def decode(beam_search, search_model, examples, config):
+    """Returns the marks of every example and the time it took."""
+    trg_ivocab = {v: k for k, v in config["trg_vocab"].items()}
+    beam_size = config['beam_size']
+    hypotheses = []
+    start = time.time()
+    for example in examples:
+        input_values = OrderedDict(
+            (variable, numpy.tile(example[name], (beam_size,) + (1,) * example[name].ndim))
+            for name, variable in search_model.dict_of_inputs().items())
+        outputs, costs = beam_search.search(
+            input_values=input_values, max_length=len(example['sampling_words']) + 2,
+            eol_symbol=config['trg_eos_idx'], ignore_first_eol=True)
+        costs = numpy.array(costs) / numpy.array([len(output) for output in outputs])
+        best = outputs[numpy.argmin(costs)]
+        hypotheses.append([trg_ivocab[mark] for mark in best[:len(example['sampling_words']) - 1]])
+    return hypotheses, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", help="HDF5 file with a dev set")
+    parser.add_argument("model_dir")
+    parser.add_argument("model_filename")
+    parser.add_argument("--margins", type=float, nargs='+', default=[0., 0.5, 1., 2., 4.])
+    parser.add_argument("--utterances", type=int, default=200)
+    args = parser.parse_args()
+
+    from checkpoint import LoadNMT
+    from config import get_config
+    from helpers import create_model, uses_prosody
+    from search import create_beam_search
+    from stream import get_dev_stream
+
+    config = get_config()
+    stream = get_dev_stream(args.data_path, prosody=uses_prosody(config))
+    examples = [dict(zip(stream.sources, example))
+                for example in islice(stream.get_epoch_iterator(), args.utterances)]
+    references = [reference_marks(example, config) for example in examples]
+    examples = [dict(("sampling_%s" % name, value) for name, value in example.items()) for example in examples]
+    words = sum(len(reference) for reference in references)
+
+    _, samples, search_model = create_model(config)
+    loader = LoadNMT(args.model_dir, args.model_filename)
+    loader.set_model_parameters(search_model, loader.load_parameters(), borrow=True)
+
+    rows = []
+    for margin in [None] + args.margins:
+        config['beam_margin'] = margin
+        beam_search = create_beam_search(config, samples)
+        beam_search.compile()
+        hypotheses, elapsed = decode(beam_search, search_model, examples, config)
+        rows.append(OrderedDict([
+            ('margin', 'full beam' if margin is None else margin),
+            ('f1', f1(references, hypotheses, config['punctuation_marks'])),
+            ('words_per_s', words / elapsed),
+            ('greedy_steps', '-' if margin is None else beam_search.greedy_fraction),
+        ]))
+
+    report("Adaptive beam", rows)
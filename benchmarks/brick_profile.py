@@ -0,0 +1,171 @@
+"""Time of the compiled training and search functions per brick.
+
+    python -m benchmarks.brick_profile --inputs words audio both --combinations add concat --batches 10
+
+For every configuration the training function and the functions of the
+beam search are compiled with Theano profiling, run on synthetic batches
+and the time of every node of the optimized graphs is attributed to the
+bricks whose methods created it, e.g. Decoder/SequenceGenerator/Readout.
+The attribution follows the creation stack in `tag.trace` of the node
+outputs, nodes without one (e.g. elementwise ops fused by the optimizer)
+are '<unattributed>'. Scans count as a whole for the brick which built
+them. Theano prints its own per-function profiles at exit as well.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import inspect
+import numpy
+import os
+import sys
+import theano
+
+from collections import OrderedDict, defaultdict
+
+from benchmarks.common import report, synthetic_batch, synthetic_config
+from benchmarks.suite import COMBINATIONS, INPUTS
+
+
+def brick_methods():
+    """Source line ranges of the methods of every loaded brick class.
+
+    Returns a dictionary from the absolute path of a source file to a list
+    of (first line, last line, brick class name).
+
+    """
+    from blocks.bricks.base import Application, Brick
+
+    ranges = defaultdict(set)
+    for module in list(sys.modules.values()):
+        for value in list(vars(module).values()) if module is not None else []:
+            if not (isinstance(value, type) and issubclass(value, Brick)):
+                continue
+            for member in vars(value).values():
+                function = member.application_function if isinstance(member, Application) else member
+                if not inspect.isfunction(function):
+                    continue
+                try:
+                    lines, first = inspect.getsourcelines(function)
+                    path = os.path.abspath(inspect.getsourcefile(function))
+                except (IOError, TypeError):
+                    continue
+                ranges[path].add((first, first + len(lines) - 1, value.__name__))
+    return ranges
+
+
+def brick_path(node, ranges):
+    """Names of the bricks which created `node`, outermost first."""
+    trace = None
+    for output in node.outputs:
+        trace = getattr(output.tag, 'trace', None)
+        if trace:
+            break
+    if not trace:
+        return '<unattributed>'
+    if isinstance(trace[0], tuple):
+        trace = [trace]
+
+    path = []
+    for frame in trace[0]:
+        candidates = [(last - first, name) for first, last, name in ranges.get(os.path.abspath(frame[0]), ())
+                      if first <= frame[1] <= last]
+        if candidates:
+            name = min(candidates)[1]
+            if not path or path[-1] != name:
+                path.append(name)
+    return "/".join(path) or '<outside bricks>'
+
+
+def brick_times(profiles, ranges):
+    """Seconds spent in the nodes of every brick path over all `profiles`."""
+    times = defaultdict(float)
+    for profile in profiles:
+        for key, seconds in profile.apply_time.items():
+            # (fgraph, node) in recent Theano versions
+            node = key[1] if isinstance(key, tuple) else key
+            times[brick_path(node, ranges)] += seconds
+    return times
+
+
+def ranked_rows(times, calls, top):
+    total = sum(times.values())
+    rows = []
+    for path, seconds in sorted(times.items(), key=lambda item: -item[1])[:top]:
+        rows.append(OrderedDict([('brick', path), ('ms_per_call', 1000 * seconds / calls),
+                                 ('share', seconds / total if total else 0.)]))
+    return rows
+
+
+def compile_with_profiling(config):
+    """Builds and compiles the training algorithm and the beam search."""
+    from blocks.graph import ComputationGraph
+    from blocks.model import Model
+    from blocks.search import BeamSearch
+
+    from algorithms import create_algorithm
+    from helpers import create_model
+
+    cost, samples, search_model = create_model(config)
+    algorithm = create_algorithm(config, cost, ComputationGraph(cost).parameters, Model(cost))
+    beam_search = BeamSearch(samples=samples)
+    profile = theano.config.profile
+    theano.config.profile = True
+    try:
+        algorithm.initialize()
+        beam_search.compile()
+    finally:
+        theano.config.profile = profile
+    return algorithm, beam_search, search_model
+
+
+def profile_configuration(config, args):
+    algorithm, beam_search, search_model = compile_with_profiling(config)
+
+    batch = synthetic_batch(config, args.batch_size, args.length)
+    inputs = OrderedDict((v.name, batch[v.name]) for v in algorithm.inputs)
+    for _ in range(args.batches):
+        algorithm.process_batch(inputs)
+
+    utterance = synthetic_batch(config, 1, args.length, seed=4321)
+    input_values = OrderedDict(
+        (v, numpy.repeat(utterance[v.name[len('sampling_'):]], config['beam_size'], axis=0))
+        for v in search_model.inputs)
+    for _ in range(args.utterances):
+        beam_search.search(input_values=input_values, max_length=args.length + 2,
+                           eol_symbol=config['trg_eos_idx'], ignore_first_eol=True)
+
+    search_functions = [value for value in vars(beam_search).values()
+                        if isinstance(value, theano.compile.function_module.Function)]
+    ranges = brick_methods()
+    return (brick_times([algorithm._function.profile], ranges),
+            brick_times([function.profile for function in search_functions], ranges))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputs", nargs='+', default=list(INPUTS), choices=INPUTS)
+    parser.add_argument("--combinations", nargs='+', default=list(COMBINATIONS), choices=COMBINATIONS,
+                        help="Combinations of the 'both' input")
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--length", type=int, default=20, help="Words per utterance")
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--utterances", type=int, default=10, help="Utterances decoded by the beam search")
+    parser.add_argument("--top", type=int, default=15, help="Bricks listed per function")
+    args = parser.parse_args()
+
+    # Keep the whole creation stack of every variable, not only the
+    # innermost frames
+    theano.config.traceback.limit = -1
+
+    for input in args.inputs:
+        for combination in (args.combinations if input == 'both' else [None]):
+            overrides = {'input': input}
+            if combination is not None:
+                overrides['combination'] = combination
+            config = synthetic_config(**overrides)
+            training, search = profile_configuration(config, args)
+
+            name = input if combination is None else "{}/{}".format(input, combination)
+            report("{}: training, per batch".format(name), ranked_rows(training, args.batches, args.top))
+            report("{}: beam search, per utterance".format(name), ranked_rows(search, args.utterances, args.top))
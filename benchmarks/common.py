@@ -0,0 +1,102 @@
+from __future__ import print_function
+
+import numpy
+import time
+
+from config import get_config
+
+
+def synthetic_config(**overrides):
+    """Returns the default config with sizes which need no Kaldi files.
+
+    Entries which would read the vocabulary, lexicon or phone lists are
+    lazy, so they are never loaded as long as they are overridden here.
+
+    """
+    config = get_config()
+    config.update({
+        'src_vocab_size': 150000,
+        'src_eos_idx': 1,
+        'phones_vocab_size': 50,
+        'audio_feat_size': 43,
+    })
+    config.update(overrides)
+    return config
+
+
+def synthetic_batch(config, batch_size, length, frames_per_word=30, seed=1234):
+    """Creates a padded training batch with Zipf distributed words."""
+    rng = numpy.random.RandomState(seed)
+    frames = length * frames_per_word
+    phones_per_word = 4
+
+    words = numpy.minimum(rng.zipf(1.3, size=(batch_size, length)),
+                          config['src_vocab_size'] - 1).astype('int64')
+    words_ends = numpy.tile(numpy.arange(1, length + 1) * frames_per_word - 1, (batch_size, 1))
+    phones_words_ends = numpy.tile(numpy.arange(1, length + 1) * phones_per_word - 1, (batch_size, 1))
+    phones_words_acoustic_ends = numpy.tile(
+        numpy.arange(1, length * phones_per_word + 1) * (frames_per_word // phones_per_word) - 1, (batch_size, 1))
+
+    batch = {
+        'words': words,
+        'audio': rng.normal(size=(batch_size, frames, config['audio_feat_size'])).astype('float32'),
+        'words_ends': words_ends.astype('int64'),
+        'punctuation_marks': rng.randint(config['trg_vocab_size'], size=(batch_size, length)).astype('int64'),
+        'phones': rng.randint(config['phones_vocab_size'], size=(batch_size, length * phones_per_word)).astype('int64'),
+        'phones_words_ends': phones_words_ends.astype('int64'),
+        'phones_words_acoustic_ends': phones_words_acoustic_ends.astype('int64'),
+        'prosody': rng.normal(size=(batch_size, length, config['prosody_feat_size'])).astype('float32'),
+    }
+    for name, value in list(batch.items()):
+        batch[name + '_mask'] = numpy.ones(value.shape[:2], dtype='float32')
+    return batch
+
+
+def time_calls(function, repeats, warmup=1):
+    """Returns seconds per call of `function` after `warmup` calls."""
+    for _ in range(warmup):
+        function()
+    start = time.time()
+    for _ in range(repeats):
+        function()
+    return (time.time() - start) / repeats
+
+
+def reference_marks(example, config):
+    """The mark after every word of a dev set example."""
+    trg_ivocab = {v: k for k, v in config["trg_vocab"].items()}
+    return [trg_ivocab[mark] for mark in example['punctuation_marks'][:-1]]
+
+
+def marks_from_text(tokens, punctuation_marks):
+    """Recovers the mark after every word of a punctuated text."""
+    marks = []
+    for token in tokens:
+        if token in punctuation_marks:
+            if marks:
+                marks[-1] = token
+        else:
+            marks.append('<SPACE>')
+    return marks
+
+
+def f1(references, hypotheses, punctuation_marks):
+    """F1 score of the marks of `hypotheses` over all utterances."""
+    from sampling import count_punctuation_errors, compute_f1_score
+
+    errors = numpy.zeros(4)
+    for reference, hypothesis in zip(references, hypotheses):
+        errors += count_punctuation_errors(reference, hypothesis, punctuation_marks)
+    return compute_f1_score(*errors)
+
+
+def report(title, rows):
+    """Prints a list of dictionaries as an aligned table."""
+    print(title)
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    print("  ".join("{:>14}".format(c) for c in columns))
+    for row in rows:
+        print("  ".join("{:>14.4g}".format(row[c]) if isinstance(row[c], float)
+                        else "{:>14}".format(row[c]) for c in columns))
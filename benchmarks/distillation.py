@@ -0,0 +1,73 @@
+"""Speed and F1 of a distilled student compared to its teacher.
+
+    python -m benchmarks.distillation DATA_H5 TEACHER_DIR TEACHER_PARAMS STUDENT_DIR STUDENT_PARAMS \
+        [--proto get_config] [--student-proto get_student_config]
+
+Both models punctuate the dev set with translate.py. Besides the F1 on the
+reference punctuation, the student gets the F1 with the teacher output as
+the reference, i.e. how well it imitates the teacher.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import time
+
+from collections import OrderedDict
+from itertools import islice
+
+from benchmarks.common import f1, marks_from_text, reference_marks, report
+
+
+def evaluate(config, data_path, model_dir, model_filename, utterances):
+    """Returns the marks of every utterance, the words and the time taken."""
+    from translate import translate
+
+    results = translate(config, model_dir, model_filename, data_path)
+    # Building the model is not part of the decoding time
+    first = next(results)
+    start = time.time()
+    results = [first] + list(islice(results, utterances - 1))
+    elapsed = time.time() - start
+    hypotheses = [marks_from_text(text.split(), config['punctuation_marks']) for _, _, text, _, _ in results]
+    words = sum(num_words for _, _, _, num_words, _ in results[1:])
+    return hypotheses, words / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", help="HDF5 file with a dev set")
+    parser.add_argument("teacher_dir")
+    parser.add_argument("teacher_filename")
+    parser.add_argument("student_dir")
+    parser.add_argument("student_filename")
+    parser.add_argument("--proto", default="get_config", help="Config of the teacher")
+    parser.add_argument("--student-proto", default="get_student_config", help="Config of the student")
+    parser.add_argument("--utterances", type=int, default=500)
+    args = parser.parse_args()
+
+    import config as configurations
+    from helpers import uses_prosody
+    from stream import get_dev_stream
+
+    teacher_config = getattr(configurations, args.proto)()
+    student_config = getattr(configurations, args.student_proto)()
+    stream = get_dev_stream(args.data_path, prosody=uses_prosody(teacher_config))
+    references = [reference_marks(dict(zip(stream.sources, example)), teacher_config)
+                  for example in islice(stream.get_epoch_iterator(), args.utterances)]
+    punctuation_marks = teacher_config['punctuation_marks']
+
+    teacher, teacher_speed = evaluate(teacher_config, args.data_path, args.teacher_dir,
+                                      args.teacher_filename, args.utterances)
+    student, student_speed = evaluate(student_config, args.data_path, args.student_dir,
+                                      args.student_filename, args.utterances)
+
+    report("Distillation", [
+        OrderedDict([('model', 'teacher'), ('enc_nhids', teacher_config['enc_nhids']),
+                     ('dec_nhids', teacher_config['dec_nhids']), ('words_per_s', teacher_speed),
+                     ('f1', f1(references, teacher, punctuation_marks)), ('f1_vs_teacher', 1.)]),
+        OrderedDict([('model', 'student'), ('enc_nhids', student_config['enc_nhids']),
+                     ('dec_nhids', student_config['dec_nhids']), ('words_per_s', student_speed),
+                     ('f1', f1(references, student, punctuation_marks)),
+                     ('f1_vs_teacher', f1(teacher, student, punctuation_marks))]),
+    ])
@@ -0,0 +1,59 @@
+"""Training step time of the audio encoder for several frame rate reductions.
+
+    python -m benchmarks.frame_rate --factors 1 2 4 8
+
+F1 of each setting comes from the F1Validator of the corresponding
+training run (config['frame_downsampling'] and
+config['frame_downsampling_mode']).
+
+"""
+from __future__ import print_function
+
+import argparse
+
+from collections import OrderedDict
+
+from blocks.graph import ComputationGraph
+from blocks.model import Model
+
+from algorithms import create_algorithm
+from benchmarks.common import synthetic_config, synthetic_batch, time_calls, report
+from helpers import create_model
+
+INPUTS = ['audio', 'audio_mask', 'words_ends', 'words_ends_mask', 'punctuation_marks', 'punctuation_marks_mask']
+
+
+def step_time(config, batch, repeats):
+    cost, _, _ = create_model(config)
+    algorithm = create_algorithm(config, cost, ComputationGraph(cost).parameters, Model(cost))
+    algorithm.initialize()
+    inputs = OrderedDict((name, batch[name]) for name in INPUTS)
+    return time_calls(lambda: algorithm.process_batch(inputs), repeats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--factors", type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument("--modes", nargs='+', default=['pyramid', 'conv'])
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--length", type=int, default=20)
+    parser.add_argument("--frames-per-word", type=int, default=30)
+    parser.add_argument("--batches", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    for mode in args.modes:
+        for factor in args.factors:
+            if factor == 1 and mode != args.modes[0]:
+                continue
+            config = synthetic_config(input='audio', frame_downsampling=factor, frame_downsampling_mode=mode)
+            batch = synthetic_batch(config, args.batch_size, args.length, args.frames_per_word)
+            frames = batch['audio'].shape[1]
+            rows.append(OrderedDict([
+                ('mode', mode if factor > 1 else 'none'),
+                ('factor', factor),
+                ('scan_steps', -(-frames // factor)),
+                ('step_ms', 1000 * step_time(config, batch, args.batches)),
+            ]))
+
+    report("Audio encoder frame rate reduction", rows)
@@ -0,0 +1,110 @@
+"""Compute saved by incremental punctuation of partial hypotheses.
+
+    python -m benchmarks.incremental MODEL_DIR PARAMS --lookahead 2 --log partials.txt
+    python -m benchmarks.incremental MODEL_DIR PARAMS --lookahead 2 --data DATA_H5
+
+A log has one partial hypothesis per line, "STREAM word word ...", in the
+order the recognizer produced them; it only suits models without acoustic
+input. With --data the partial hypotheses are replayed from the dev set:
+after every word the last --revised words are first replaced by other
+words of the utterance with probability --revision-rate, as if the
+recognizer changed its mind, and the frames arrive up to the end of the
+word. The log is punctuated with and without reuse, which should give
+the same marks up to rounding.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import numpy
+import time
+
+from collections import OrderedDict
+from itertools import islice
+
+from benchmarks.common import report
+
+
+def read_log(path):
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                yield fields[0], fields[1:], None, None
+
+
+def replay_dev_set(path, utterances, revised, revision_rate, seed=1234):
+    from stream import get_dev_stream
+
+    rng = numpy.random.RandomState(seed)
+    stream = get_dev_stream(path)
+    for example in islice(stream.get_epoch_iterator(), utterances):
+        example = dict(zip(stream.sources, example))
+        uttid = example['uttids']
+        words = example['text'].split()[:-1]
+        ends = [int(end) for end in example['words_ends'][:-1]]
+        if min(ends + [0]) < 0:
+            continue
+        pushed = 0
+        for i in range(1, len(words) + 1):
+            frames = example['audio'][pushed:ends[i - 1] + 1]
+            pushed = max(pushed, ends[i - 1] + 1)
+            if rng.rand() < revision_rate:
+                partial = list(words[:i])
+                for j in range(max(0, i - revised), i):
+                    partial[j] = words[rng.randint(len(words))]
+                yield uttid, partial, frames, ends[:i]
+                frames = None
+            yield uttid, words[:i], frames, ends[:i]
+
+
+def replay(punctuator, updates):
+    marks = []
+    start = time.time()
+    for stream, words, frames, words_ends in updates:
+        marks.append(list(punctuator.update(stream, words, frames, words_ends)))
+    return marks, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir")
+    parser.add_argument("model_filename")
+    parser.add_argument("--lookahead", type=int, required=True,
+                        help="config['streaming_lookahead'] the model was trained with")
+    parser.add_argument("--log")
+    parser.add_argument("--data")
+    parser.add_argument("--utterances", type=int, default=100)
+    parser.add_argument("--revised", type=int, default=2)
+    parser.add_argument("--revision-rate", type=float, default=0.5)
+    args = parser.parse_args()
+
+    from config import get_config
+    from streaming import IncrementalPunctuator
+
+    config = get_config()
+    config['streaming_lookahead'] = args.lookahead
+    if args.log:
+        updates = list(read_log(args.log))
+    else:
+        updates = list(replay_dev_set(args.data, args.utterances, args.revised, args.revision_rate))
+
+    rows = []
+    results = []
+    for reuse in (False, True):
+        punctuator = IncrementalPunctuator(config, args.model_dir, args.model_filename,
+                                           normalize=False, reuse=reuse)
+        marks, elapsed = replay(punctuator, updates)
+        results.append(marks)
+        stats = punctuator.stats
+        rows.append(OrderedDict([
+            ('reuse', str(reuse)),
+            ('updates', len(updates)),
+            ('ms_per_update', 1000 * elapsed / max(len(updates), 1)),
+            ('rows_computed', float(stats['rows_computed']) / max(stats['rows'], 1)),
+            ('steps_computed', float(stats['steps_computed']) / max(stats['steps'], 1)),
+        ]))
+
+    report("Incremental punctuation", rows)
+    same = sum(a == b for a, b in zip(*results))
+    print("Updates with the same marks with and without reuse: {}/{}".format(same, len(updates)))
@@ -0,0 +1,101 @@
+"""Padding and training throughput of the audio encoder with packed batches.
+
+    python -m benchmarks.packing --pack-lengths 0 1500 3000
+
+Utterances have a random number of words with a random number of frames
+each and are sorted within read-ahead chunks like in `get_tr_stream`. A
+pack length of 0 packs into rows as long as the longest utterance of the
+batch.
+
+"""
+from __future__ import print_function
+
+import argparse
+import numpy
+import time
+
+from collections import OrderedDict
+
+from blocks.graph import ComputationGraph
+from blocks.model import Model
+from fuel.datasets import IndexableDataset
+from fuel.schemes import ConstantScheme, SequentialExampleScheme
+from fuel.streams import DataStream
+from fuel.transformers import Batch
+
+from algorithms import create_algorithm
+from benchmarks.common import synthetic_config, report
+from helpers import create_model
+from stream import PackAudio, PaddingWithEOS
+
+INPUTS = ['audio', 'audio_mask', 'words_ends', 'words_ends_mask', 'punctuation_marks', 'punctuation_marks_mask']
+PACKED_INPUTS = INPUTS + ['audio_starts', 'audio_rows']
+
+
+def synthetic_utterances(config, count, max_words, max_frames_per_word, chunk, seed=1234):
+    rng = numpy.random.RandomState(seed)
+    utterances = []
+    for _ in range(count):
+        words = rng.randint(2, max_words + 1)
+        ends = numpy.cumsum(rng.randint(5, max_frames_per_word + 1, size=words)) - 1
+        utterances.append((
+            rng.normal(size=(ends[-1] + 1, config['audio_feat_size'])).astype('float32'),
+            ends.astype('int64'),
+            rng.randint(config['trg_vocab_size'], size=words).astype('int64'),
+        ))
+    for start in range(0, count, chunk):
+        utterances[start:start + chunk] = sorted(utterances[start:start + chunk], key=lambda u: len(u[0]))
+    return OrderedDict(zip(['audio', 'words_ends', 'punctuation_marks'], [list(x) for x in zip(*utterances)]))
+
+
+def batches(data, config, batch_size, pack_length):
+    stream = DataStream(IndexableDataset(data), iteration_scheme=SequentialExampleScheme(len(data['audio'])))
+    stream = Batch(stream, iteration_scheme=ConstantScheme(batch_size))
+    mask_sources = None
+    if pack_length is not None:
+        stream = PackAudio(stream, pack_length or None, config['frame_downsampling'])
+        mask_sources = tuple(source for source in stream.sources if source != 'audio_rows')
+    stream = PaddingWithEOS(stream, mask_sources=mask_sources, padding={
+        'audio': 0, 'words_ends': -1, 'punctuation_marks': config['trg_eos_idx'], 'audio_starts': 0})
+    return list(stream.get_epoch_iterator(as_dict=True))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pack-lengths", type=int, nargs='+', default=[0, 3000])
+    parser.add_argument("--utterances", type=int, default=400)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--max-words", type=int, default=40)
+    parser.add_argument("--max-frames-per-word", type=int, default=60)
+    parser.add_argument("--sort-k-batches", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    baseline = None
+    for pack_length in [None] + args.pack_lengths:
+        config = synthetic_config(input='audio', pack_audio=pack_length is not None)
+        data = synthetic_utterances(config, args.utterances, args.max_words, args.max_frames_per_word,
+                                    args.batch_size * args.sort_k_batches)
+        epoch = batches(data, config, args.batch_size, pack_length)
+
+        cost, _, _ = create_model(config)
+        algorithm = create_algorithm(config, cost, ComputationGraph(cost).parameters, Model(cost))
+        algorithm.initialize()
+        names = INPUTS if pack_length is None else PACKED_INPUTS
+        algorithm.process_batch(OrderedDict((name, epoch[0][name]) for name in names))
+        start = time.time()
+        for batch in epoch:
+            algorithm.process_batch(OrderedDict((name, batch[name]) for name in names))
+        frames_per_second = sum(len(audio) for audio in data['audio']) / (time.time() - start)
+        baseline = baseline or frames_per_second
+
+        padded = 1. - float(sum(batch['audio_mask'].sum() for batch in epoch)) / sum(batch['audio_mask'].size for batch in epoch)
+        rows.append(OrderedDict([
+            ('pack_length', 'unpacked' if pack_length is None else (pack_length or 'longest')),
+            ('rows', sum(len(batch['audio']) for batch in epoch)),
+            ('padding', padded),
+            ('frames_per_s', frames_per_second),
+            ('speedup', frames_per_second / baseline),
+        ]))
+
+    report("Audio packing", rows)
@@ -0,0 +1,93 @@
+"""Scaling of data parallel training over the number of worker processes.
+
+    python -m benchmarks.parallel --workers 1 2 4 8 --threads 1
+
+Every worker count runs in a fresh process with OMP_NUM_THREADS set to
+--threads, so the BLAS of each worker uses that many threads.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+from collections import OrderedDict
+
+from benchmarks.common import synthetic_config, synthetic_batch, report
+
+
+def train_worker(rank, reducer, config, batch_size, length, batches, elapsed):
+    from blocks.graph import ComputationGraph
+    from blocks.model import Model
+
+    from algorithms import create_algorithm
+    from helpers import create_model
+
+    batch = synthetic_batch(config, batch_size, length, seed=1234 + rank)
+    cost, _, _ = create_model(config)
+    algorithm = create_algorithm(config, cost, ComputationGraph(cost).parameters, Model(cost), reducer)
+    algorithm.initialize()
+    inputs = OrderedDict((v.name, batch[v.name]) for v in algorithm.inputs)
+
+    algorithm.process_batch(inputs)
+    start = time.time()
+    for _ in range(batches):
+        algorithm.process_batch(inputs)
+    if rank == 0:
+        elapsed.value = time.time() - start
+
+
+def measure(workers, input, batch_size, length, batches):
+    from blocks.graph import ComputationGraph
+
+    from helpers import create_model
+    from parallel import parameter_count, run_workers
+
+    config = synthetic_config(input=input)
+    cost, _, _ = create_model(config)
+    elapsed = multiprocessing.Value('d', 0.)
+    run_workers(workers, parameter_count(ComputationGraph(cost).parameters),
+                train_worker, config, batch_size, length, batches, elapsed)
+    return {'examples_per_s': workers * batch_size * batches / elapsed.value}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--input", default='both')
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--length", type=int, default=20)
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.input, args.batch_size, args.length, args.batches)))
+        sys.exit(0)
+
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads))
+    rows = []
+    for workers in args.workers:
+        output = subprocess.check_output([
+            sys.executable, '-m', 'benchmarks.parallel',
+            '--input', args.input,
+            '--batch-size', str(args.batch_size),
+            '--length', str(args.length),
+            '--batches', str(args.batches),
+            '--child', str(workers)], env=env)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        single = rows[0]['examples_per_s'] if rows else result['examples_per_s']
+        rows.append(OrderedDict([
+            ('workers', workers),
+            ('examples_per_s', result['examples_per_s']),
+            ('speedup', result['examples_per_s'] / single),
+            ('efficiency', result['examples_per_s'] / single / workers),
+        ]))
+
+    report("Data parallel training", rows)
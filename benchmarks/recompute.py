@@ -0,0 +1,84 @@
+"""Peak memory and step time of the encoders with and without recomputation.
+
+    python -m benchmarks.recompute --lengths 10 20 40
+
+Every setting is measured in a fresh process, so the reported peak is the
+maximum resident set size of that training run alone. Run it with
+THEANO_FLAGS=device=cpu for host memory; on a GPU the resident set size
+does not include device memory.
+
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+
+from collections import OrderedDict
+
+from benchmarks.common import synthetic_config, synthetic_batch, time_calls, report
+
+INPUTS = {
+    'words': ['words', 'words_mask'],
+    'audio': ['audio', 'audio_mask', 'words_ends', 'words_ends_mask'],
+}
+
+
+def measure(input, recompute, batch_size, length, frames_per_word, batches):
+    from blocks.graph import ComputationGraph
+    from blocks.model import Model
+
+    from algorithms import create_algorithm
+    from helpers import create_model
+
+    config = synthetic_config(input=input, encoder_recompute=recompute)
+    batch = synthetic_batch(config, batch_size, length, frames_per_word)
+    cost, _, _ = create_model(config)
+    algorithm = create_algorithm(config, cost, ComputationGraph(cost).parameters, Model(cost))
+    algorithm.initialize()
+    inputs = OrderedDict((name, batch[name])
+                         for name in INPUTS[input] + ['punctuation_marks', 'punctuation_marks_mask'])
+    return {
+        'step_ms': 1000 * time_calls(lambda: algorithm.process_batch(inputs), batches),
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputs", nargs='+', default=['audio', 'words'], choices=sorted(INPUTS))
+    parser.add_argument("--lengths", type=int, nargs='+', default=[10, 20, 40])
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--frames-per-word", type=int, default=30)
+    parser.add_argument("--batches", type=int, default=3)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        input, recompute, length = json.loads(args.child)
+        print(json.dumps(measure(input, recompute, args.batch_size, length, args.frames_per_word, args.batches)))
+        sys.exit(0)
+
+    rows = []
+    for input in args.inputs:
+        for length in args.lengths:
+            for recompute in [False, True]:
+                output = subprocess.check_output([
+                    sys.executable, '-m', 'benchmarks.recompute',
+                    '--batch-size', str(args.batch_size),
+                    '--frames-per-word', str(args.frames_per_word),
+                    '--batches', str(args.batches),
+                    '--child', json.dumps([input, recompute, length])])
+                result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+                rows.append(OrderedDict([
+                    ('input', input),
+                    ('recompute', recompute),
+                    ('words', length),
+                    ('scan_steps', length * (args.frames_per_word if input == 'audio' else 1)),
+                    ('step_ms', result['step_ms']),
+                    ('peak_mb', result['peak_mb']),
+                ]))
+
+    report("Encoder recomputation", rows)
@@ -0,0 +1,88 @@
+"""Throughput of forced scoring compared to beam search.
+
+    python -m benchmarks.scoring DATA_H5 MODEL_DIR PARAMS --candidates 1 8
+
+Every utterance of the dev set is paired with its reference punctuation
+and candidates-1 copies with randomly changed marks, and all pairs are
+scored in batches of --batch-size. Beam search decodes the utterances once
+in batches of the same size.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import numpy
+import time
+
+from collections import OrderedDict
+from itertools import islice
+
+from benchmarks.common import report
+
+
+def perturb(marks, rng, eos):
+    """Replaces a tenth of the marks before </s> by random ones."""
+    marks = numpy.array(marks)
+    changed = rng.rand(len(marks) - 1) < 0.1
+    marks[:-1][changed] = rng.randint(eos, size=changed.sum())
+    return marks
+
+
+def batches(examples, batch_size):
+    for i in range(0, len(examples), batch_size):
+        yield examples[i:i + batch_size]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", help="HDF5 file with a dev set")
+    parser.add_argument("model_dir")
+    parser.add_argument("model_filename")
+    parser.add_argument("--candidates", type=int, nargs='+', default=[1, 8])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--utterances", type=int, default=200)
+    args = parser.parse_args()
+
+    from config import get_config
+    from helpers import uses_prosody
+    from scoring import ForcedScorer
+    from server import Punctuator, resolve_ends
+    from stream import get_dev_stream
+
+    config = get_config()
+    stream = get_dev_stream(args.data_path, prosody=uses_prosody(config))
+    examples = [dict(zip(stream.sources, example))
+                for example in islice(stream.get_epoch_iterator(), args.utterances)]
+    scorer = ForcedScorer(config, args.model_dir, args.model_filename)
+    # The ends of </s> resolved like for requests to the server
+    batch = [(example['text'].split(), resolve_ends(dict((source, example[source])
+                                                         for source in scorer.sources + ['punctuation_marks'])))
+             for example in examples]
+    rng = numpy.random.RandomState(1234)
+
+    rows = []
+    for candidates in args.candidates:
+        pairs = []
+        for words, example in batch:
+            pairs.append((words, example))
+            for _ in range(candidates - 1):
+                candidate = dict(example)
+                candidate['punctuation_marks'] = perturb(example['punctuation_marks'], rng, config['trg_eos_idx'])
+                pairs.append((words, candidate))
+        start = time.time()
+        for chunk in batches(pairs, args.batch_size):
+            scorer.score(chunk)
+        elapsed = time.time() - start
+        rows.append(OrderedDict([('method', 'scoring x{}'.format(candidates)),
+                                 ('pairs_per_s', len(pairs) / elapsed),
+                                 ('utterances_per_s', len(batch) / elapsed)]))
+
+    punctuator = Punctuator(config, args.model_dir, args.model_filename)
+    start = time.time()
+    for chunk in batches(batch, args.batch_size):
+        punctuator.punctuate(chunk)
+    elapsed = time.time() - start
+    rows.append(OrderedDict([('method', 'beam search'), ('pairs_per_s', len(batch) / elapsed),
+                             ('utterances_per_s', len(batch) / elapsed)]))
+
+    report("Forced scoring", rows)
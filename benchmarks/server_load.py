@@ -0,0 +1,84 @@
+"""Load generator for server.py.
+
+    python -m benchmarks.server_load --url http://127.0.0.1:8080/ --concurrency 1 4 16
+
+Every client thread sends requests back to back, so the concurrency is the
+number of requests in flight. With --audio-feat-size the requests also
+carry random frames and word ends for models with acoustic input.
+
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import numpy
+import threading
+import time
+
+from collections import OrderedDict
+
+from six.moves.urllib.request import Request, urlopen
+
+from benchmarks.common import report
+
+WORDS = ("the so we have a look at what is going on here and you know it was "
+         "quite good but then i think they said that this is not right").split()
+
+
+def synthetic_request(rng, max_words, audio_feat_size, frames_per_word):
+    words = list(rng.choice(WORDS, size=rng.randint(3, max_words + 1)))
+    request = {'words': words}
+    if audio_feat_size:
+        request['audio'] = rng.normal(size=(len(words) * frames_per_word, audio_feat_size)).tolist()
+        request['words_ends'] = list(range(frames_per_word - 1, len(words) * frames_per_word, frames_per_word))
+    return request
+
+
+def client(url, requests, latencies, replies):
+    for request in requests:
+        data = json.dumps(request).encode('utf-8')
+        start = time.time()
+        reply = urlopen(Request(url, data, {'Content-Type': 'application/json'})).read()
+        latencies.append(time.time() - start)
+        replies.append(json.loads(reply.decode('utf-8')))
+
+
+def run(url, concurrency, requests_per_client, rng, args):
+    latencies = []
+    replies = []
+    threads = [threading.Thread(target=client, args=(
+        url, [synthetic_request(rng, args.max_words, args.audio_feat_size, args.frames_per_word)
+              for _ in range(requests_per_client)], latencies, replies))
+        for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = numpy.array(latencies) * 1000
+    return OrderedDict([
+        ('concurrency', concurrency),
+        ('requests_per_s', len(latencies) / elapsed),
+        ('p50_ms', numpy.percentile(latencies, 50)),
+        ('p99_ms', numpy.percentile(latencies, 99)),
+        ('queue_ms', numpy.mean([reply['queue_ms'] for reply in replies])),
+        ('inference_ms', numpy.mean([reply['inference_ms'] for reply in replies])),
+        ('batch_size', numpy.mean([reply['batch_size'] for reply in replies])),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8080/")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=20, help="Requests per client thread")
+    parser.add_argument("--max-words", type=int, default=30)
+    parser.add_argument("--audio-feat-size", type=int, default=0)
+    parser.add_argument("--frames-per-word", type=int, default=30)
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(1234)
+    rows = [run(args.url, concurrency, args.requests, rng, args) for concurrency in args.concurrency]
+    report("Punctuation server", rows)
@@ -0,0 +1,57 @@
+"""Step time and optimizer memory traffic of dense vs sparse embedding updates.
+
+    python -m benchmarks.sparse_embeddings --vocab-size 150000 --batches 20
+
+"""
+from __future__ import print_function
+
+import argparse
+import numpy
+import theano
+
+from collections import OrderedDict
+
+from blocks.graph import ComputationGraph
+from blocks.model import Model
+
+from algorithms import create_algorithm
+from benchmarks.common import synthetic_config, synthetic_batch, time_calls, report
+from helpers import create_model
+
+
+def run(config, batch, repeats):
+    cost, _, _ = create_model(config)
+    cg = ComputationGraph(cost)
+    algorithm = create_algorithm(config, cost, cg.parameters, Model(cost))
+    algorithm.initialize()
+    inputs = OrderedDict((name, batch[name]) for name in
+                         ['words', 'words_mask', 'punctuation_marks', 'punctuation_marks_mask'])
+    return time_calls(lambda: algorithm.process_batch(inputs), repeats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab-size", type=int, default=150000)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--length", type=int, default=40)
+    parser.add_argument("--batches", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = []
+    for sparse in [False, True]:
+        config = synthetic_config(input='words', src_vocab_size=args.vocab_size, sparse_embeddings=sparse)
+        batch = synthetic_batch(config, args.batch_size, args.length)
+        seconds = run(config, batch, args.batches)
+
+        # The table and both AdaDelta accumulators are read and written
+        touched_rows = len(numpy.unique(batch['words'])) if sparse else config['src_vocab_size']
+        itemsize = numpy.dtype(theano.config.floatX).itemsize
+        traffic = 3 * 2 * touched_rows * config['enc_embed'] * itemsize
+        rows.append(OrderedDict([
+            ('mode', 'sparse' if sparse else 'dense'),
+            ('step_ms', 1000 * seconds),
+            ('touched_rows', touched_rows),
+            ('optimizer_MB', traffic / 2. ** 20),
+        ]))
+
+    report("Embedding updates, vocabulary {}".format(args.vocab_size), rows)
@@ -0,0 +1,122 @@
+"""Emission latency and F1 of streaming models for several lookaheads.
+
+    python -m benchmarks.streaming DATA_H5 --offline MODEL_DIR PARAMS \
+        --streaming 0 MODEL_DIR PARAMS --streaming 2 MODEL_DIR PARAMS
+
+Every --streaming model must have been trained with that
+config['streaming_lookahead']. The words of the dev set are pushed one by
+one together with their frames, as a recognizer would emit them. The
+latency of a mark is the audio time from the end of its word to the push
+which emitted it plus the time spent decoding, it is also given in words.
+The offline model gives the F1 without any restriction.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import numpy
+import time
+
+from collections import OrderedDict
+from itertools import islice
+
+from benchmarks.common import f1, marks_from_text, reference_marks, report
+
+
+def evaluate_offline(config, data_path, model_dir, model_filename, indices):
+    from translate import translate
+
+    results = islice(translate(config, model_dir, model_filename, data_path), max(indices) + 1)
+    return [marks_from_text(text.split(), config['punctuation_marks'])
+            for index, _, text, _, _ in results if index in indices]
+
+
+def evaluate_streaming(config, examples, model_dir, model_filename):
+    from streaming import StreamingPunctuator
+
+    punctuator = StreamingPunctuator(config, model_dir, model_filename, normalize=False)
+    frame_shift = config['take_every_nth'] / 100.
+    hypotheses = []
+    latencies = []
+    word_delays = []
+    words = 0
+    decoding = 0.
+
+    for example in examples:
+        text = example['text'].split()[:-1]
+        ends = list(example['words_ends'][:-1])
+        audio = example['audio']
+        arrivals = [(end + 1) * frame_shift for end in ends]
+        pushed_frames = 0
+
+        marks = []
+        for i, word in enumerate(text):
+            frames = audio[pushed_frames:ends[i] + 1]
+            pushed_frames = max(pushed_frames, ends[i] + 1)
+            start = time.time()
+            emitted = punctuator.push([word], frames, [ends[i]])
+            elapsed = time.time() - start
+            decoding += elapsed
+            for _, mark in emitted:
+                latencies.append(arrivals[i] - arrivals[len(marks)] + elapsed)
+                word_delays.append(i - len(marks))
+                marks.append(mark)
+
+        start = time.time()
+        punctuator.push([], audio[pushed_frames:])
+        emitted = punctuator.finish()
+        elapsed = time.time() - start
+        decoding += elapsed
+        for _, mark in emitted:
+            latencies.append(len(audio) * frame_shift - arrivals[len(marks)] + elapsed)
+            word_delays.append(len(text) - len(marks))
+            marks.append(mark)
+
+        hypotheses.append(marks)
+        words += len(text)
+
+    return hypotheses, OrderedDict([
+        ('latency_words', numpy.mean(word_delays)),
+        ('latency_s', numpy.mean(latencies)),
+        ('p95_latency_s', numpy.percentile(latencies, 95)),
+        ('ms_per_word', 1000 * decoding / max(words, 1)),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", help="HDF5 file with a dev set")
+    parser.add_argument("--offline", nargs=2, metavar=("MODEL_DIR", "PARAMS"))
+    parser.add_argument("--streaming", nargs=3, action='append', default=[],
+                        metavar=("K", "MODEL_DIR", "PARAMS"))
+    parser.add_argument("--utterances", type=int, default=200)
+    args = parser.parse_args()
+
+    from config import get_config
+    from helpers import uses_prosody
+    from stream import get_dev_stream
+
+    config = get_config()
+    stream = get_dev_stream(args.data_path, prosody=uses_prosody(config))
+    examples = [dict(zip(stream.sources, example))
+                for example in islice(stream.get_epoch_iterator(), args.utterances)]
+    # Words without alignment have no end frame to arrive at
+    indices = set(i for i, example in enumerate(examples) if (example['words_ends'][:-1] >= 0).all())
+    examples = [example for i, example in enumerate(examples) if i in indices]
+    references = [reference_marks(example, config) for example in examples]
+    punctuation_marks = config['punctuation_marks']
+
+    rows = []
+    if args.offline:
+        hypotheses = evaluate_offline(config, args.data_path, args.offline[0], args.offline[1], indices)
+        rows.append(OrderedDict([('lookahead', 'offline'), ('f1', f1(references, hypotheses, punctuation_marks)),
+                                 ('latency_words', '-'), ('latency_s', '-'), ('p95_latency_s', '-'),
+                                 ('ms_per_word', '-')]))
+    for lookahead, model_dir, model_filename in args.streaming:
+        config['streaming_lookahead'] = int(lookahead)
+        hypotheses, stats = evaluate_streaming(config, examples, model_dir, model_filename)
+        row = OrderedDict([('lookahead', int(lookahead)), ('f1', f1(references, hypotheses, punctuation_marks))])
+        row.update(stats)
+        rows.append(row)
+
+    report("Streaming punctuation", rows)
@@ -0,0 +1,243 @@
+"""Benchmarks of every stage on a synthetic Kaldi corpus.
+
+    python -m benchmarks.suite run ROOT --output results.json [--stages prepare_data tr_stream ...]
+    python -m benchmarks.suite compare OLD.json NEW.json [--threshold 0.1]
+
+`run` writes the corpus of benchmarks/synthetic_kaldi.py into ROOT unless
+it is there already, and measures:
+
+    prepare_data  time to build the HDF5 file
+    tr_stream     batches/s of `get_tr_stream` over one epoch
+    train_step    training step time per config['input'] and combination
+    beam_search   latency of one utterance per length and beam size
+    checkpoint    parameter save and load time per file format
+
+The results are printed and, with --output, written as JSON together with
+the git revision. `compare` matches the rows of two such files and lists
+every metric which got worse by more than --threshold, exiting with 1 if
+there is any.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import numpy
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+
+from benchmarks.common import report, synthetic_batch, time_calls
+from benchmarks.synthetic_kaldi import kaldi_config, write_kaldi_data
+
+STAGES = ('prepare_data', 'tr_stream', 'train_step', 'beam_search', 'checkpoint')
+INPUTS = ('words', 'audio', 'phones', 'phones-audio', 'prosody', 'both')
+COMBINATIONS = ('max', 'dropout-max', 'avg', 'add', 'dropout-add', 'concat', 'mask')
+
+
+def data_path(root):
+    return os.path.join(root, 'data.h5')
+
+
+def bench_prepare_data(root, args):
+    from prepare_data import prepare_data
+
+    config = kaldi_config(root)
+    start = time.time()
+    prepare_data(config, data_path(root), ['train', 'dev'])
+    elapsed = time.time() - start
+    with open(os.path.join(root, 'train', 'text')) as f:
+        utterances = sum(1 for _ in f)
+    return [OrderedDict([('utterances', utterances), ('seconds', elapsed),
+                         ('utterances_per_s', utterances / elapsed)])]
+
+
+def bench_tr_stream(root, args):
+    from stream import get_tr_stream
+
+    config = kaldi_config(root)
+    rows = []
+    for batch_size in args.batch_sizes:
+        stream = get_tr_stream(data_path(root), config["src_eos_idx"], config["phones"]["sil"],
+                               config["trg_eos_idx"], seq_len=config["seq_len"], batch_size=batch_size,
+                               sort_k_batches=config["sort_k_batches"])
+        start = time.time()
+        batches = sum(1 for _ in stream.get_epoch_iterator())
+        elapsed = time.time() - start
+        rows.append(OrderedDict([('batch_size', batch_size), ('batches', batches),
+                                 ('batches_per_s', batches / elapsed)]))
+    return rows
+
+
+def bench_train_step(root, args):
+    from blocks.graph import ComputationGraph
+    from blocks.model import Model
+
+    from algorithms import create_algorithm
+    from helpers import create_model
+
+    rows = []
+    for input in args.inputs:
+        for combination in (args.combinations if input == 'both' else ['-']):
+            config = kaldi_config(root, input=input, combination=combination)
+            cost, _, _ = create_model(config)
+            algorithm = create_algorithm(config, cost, ComputationGraph(cost).parameters, Model(cost))
+            algorithm.initialize()
+            batch = synthetic_batch(config, args.batch_size, args.length)
+            inputs = OrderedDict((v.name, batch[v.name]) for v in algorithm.inputs)
+            rows.append(OrderedDict([
+                ('input', input), ('combination', combination),
+                ('step_ms', 1000 * time_calls(lambda: algorithm.process_batch(inputs), args.repeats)),
+            ]))
+    return rows
+
+
+def bench_beam_search(root, args):
+    from blocks.search import BeamSearch
+
+    from helpers import create_model
+
+    config = kaldi_config(root, input=args.search_input)
+    _, samples, search_model = create_model(config)
+    beam_search = BeamSearch(samples=samples)
+    beam_search.compile()
+
+    rows = []
+    for length in args.lengths:
+        batch = synthetic_batch(config, 1, length)
+        for beam_size in args.beam_sizes:
+            input_values = OrderedDict(
+                (v, numpy.repeat(batch[v.name[len('sampling_'):]], beam_size, axis=0)) for v in search_model.inputs)
+            search = lambda: beam_search.search(input_values=input_values, max_length=length + 2,
+                                                eol_symbol=config['trg_eos_idx'], ignore_first_eol=True)
+            rows.append(OrderedDict([('length', length), ('beam_size', beam_size),
+                                     ('latency_ms', 1000 * time_calls(search, args.repeats))]))
+    return rows
+
+
+def bench_checkpoint(root, args):
+    from blocks.model import Model
+
+    from checkpoint import LoadNMT
+    from helpers import create_model
+
+    config = kaldi_config(root, input='both')
+    cost, _, _ = create_model(config)
+    model = Model(cost)
+    param_values = model.get_parameter_values()
+    size = sum(value.nbytes for value in param_values.values())
+
+    rows = []
+    folder = tempfile.mkdtemp(dir=root)
+    for filename in ('params.npz', 'params.mmap'):
+        loader = LoadNMT(folder, filename)
+        save = lambda: loader.save_parameter_values(param_values, loader.path_to_parameters)
+        load = lambda: loader.set_model_parameters(model, loader.load_parameters())
+        rows.append(OrderedDict([('format', filename.split('.')[1]), ('size_mb', size / 2. ** 20),
+                                 ('save_ms', 1000 * time_calls(save, args.repeats)),
+                                 ('load_ms', 1000 * time_calls(load, args.repeats))]))
+    return rows
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    if not os.path.exists(os.path.join(args.root, 'train', 'feats.scp')):
+        write_kaldi_data(args.root, args.utterances, args.dev_utterances)
+    if 'prepare_data' not in args.stages and not os.path.exists(data_path(args.root)):
+        raise ValueError("{} does not exist, run the prepare_data stage".format(data_path(args.root)))
+
+    results = OrderedDict()
+    for stage in STAGES:
+        if stage in args.stages:
+            results[stage] = globals()['bench_' + stage](args.root, args)
+            report(stage, results[stage])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('revision', git_revision()), ('time', time.time()),
+                                   ('results', results)]), f, indent=2)
+
+
+def higher_is_better(metric):
+    return metric.endswith('_per_s')
+
+
+def split_row(row):
+    """Returns the key columns and the metrics of a result row."""
+    key = tuple((name, value) for name, value in row.items() if not isinstance(value, float))
+    metrics = OrderedDict((name, value) for name, value in row.items() if isinstance(value, float))
+    return key, metrics
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f, object_pairs_hook=OrderedDict)
+    with open(args.new) as f:
+        new = json.load(f, object_pairs_hook=OrderedDict)
+
+    rows = []
+    regressions = 0
+    for stage, new_rows in new['results'].items():
+        old_rows = dict(split_row(row) for row in old['results'].get(stage, []))
+        for row in new_rows:
+            key, metrics = split_row(row)
+            if key not in old_rows:
+                continue
+            for metric, value in metrics.items():
+                if metric not in old_rows[key] or metric in ('seconds', 'size_mb'):
+                    continue
+                before = old_rows[key][metric]
+                change = (value - before) / before if before else 0.
+                worse = -change if higher_is_better(metric) else change
+                regressions += worse > args.threshold
+                rows.append(OrderedDict([
+                    ('stage', stage), ('row', " ".join(str(value) for _, value in key)), ('metric', metric),
+                    ('old', before), ('new', value), ('change', "{:+.1%}".format(change)),
+                    ('status', 'REGRESSION' if worse > args.threshold else 'ok'),
+                ]))
+
+    report("{} -> {}".format(old['revision'], new['revision']), rows)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument("root", help="Directory of the synthetic corpus")
+    run_parser.add_argument("--output", help="JSON file for the results")
+    run_parser.add_argument("--stages", nargs='+', default=list(STAGES), choices=STAGES)
+    run_parser.add_argument("--utterances", type=int, default=500)
+    run_parser.add_argument("--dev-utterances", type=int, default=50)
+    run_parser.add_argument("--batch-sizes", type=int, nargs='+', default=[20, 50])
+    run_parser.add_argument("--inputs", nargs='+', default=list(INPUTS), choices=INPUTS)
+    run_parser.add_argument("--combinations", nargs='+', default=list(COMBINATIONS), choices=COMBINATIONS)
+    run_parser.add_argument("--batch-size", type=int, default=20, help="Batch size of the training steps")
+    run_parser.add_argument("--length", type=int, default=20, help="Words per utterance of the training steps")
+    run_parser.add_argument("--search-input", default='both', choices=INPUTS)
+    run_parser.add_argument("--lengths", type=int, nargs='+', default=[10, 40, 160])
+    run_parser.add_argument("--beam-sizes", type=int, nargs='+', default=[1, 6, 12])
+    run_parser.add_argument("--repeats", type=int, default=5)
+
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="Relative change of a metric which counts as a regression")
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif compare(args):
+        sys.exit(1)
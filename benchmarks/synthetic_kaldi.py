@@ -0,0 +1,154 @@
+"""Synthetic Kaldi data directories for benchmarks without the corpus.
+
+    python -m benchmarks.synthetic_kaldi ROOT [--utterances 200] [--dev-utterances 50]
+
+Writes into ROOT a word list, phone lists and a lexicon, and for the
+'train' and 'dev' sets a data directory with a `text` holding punctuation
+tokens and `feats.ark`/`feats.scp`, and an alignment directory with a
+phone level CTM (`forced_phone_alignment.txt`) in which the words are
+separated by optional silences. `kaldi_config` returns a config which
+reads everything from ROOT instead of the paths of `get_config`.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import numpy
+import os
+
+from config import Lazy, _load_lexicon, get_config
+from lexicon import create_phone_dictionary_from_lexicon
+
+SETS = ('train', 'dev')
+
+
+def data_dir(root, name):
+    return os.path.join(root, name)
+
+
+def alignment_dir(root, name):
+    return os.path.join(root, name + '_alignment')
+
+
+def write_lexicon(root, rng, vocabulary, phones):
+    """Writes the word list and a lexicon with 1 to 5 phones per word."""
+    words = ['w%d' % i for i in range(vocabulary)]
+    phone_names = ['p%d' % i for i in range(phones)]
+    lexicon = dict((word, list(rng.choice(phone_names, size=rng.randint(1, 6)))) for word in words)
+
+    with open(os.path.join(root, 'wordlist'), 'w') as f:
+        f.write("".join("%s\n" % word for word in ['<unk>', '</s>'] + words))
+    with open(os.path.join(root, 'lexicon.txt'), 'w') as f:
+        f.write("".join("%s %s\n" % (word, " ".join(lexicon[word])) for word in words))
+    with open(os.path.join(root, 'nonsilence_phones.txt'), 'w') as f:
+        f.write("".join("%s\n" % phone for phone in phone_names))
+    with open(os.path.join(root, 'silence_phones.txt'), 'w') as f:
+        f.write("sil\nspn\n")
+    return words, lexicon
+
+
+def phone_labels(pronunciation):
+    """Adds the word position suffixes of Kaldi's position dependent phones."""
+    if len(pronunciation) == 1:
+        return [pronunciation[0] + '_S']
+    return ([pronunciation[0] + '_B'] + [phone + '_I' for phone in pronunciation[1:-1]] +
+            [pronunciation[-1] + '_E'])
+
+
+def write_set(root, name, rng, words, lexicon, utterances, max_words, feat_size, punctuation_marks):
+    """Writes the data and alignment directories of one set."""
+    import kaldi_io
+
+    for folder in (data_dir(root, name), alignment_dir(root, name)):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    # Zipf distributed words like in real text
+    ranks = numpy.minimum(rng.zipf(1.3, size=utterances * max_words), len(words)) - 1
+    text = open(os.path.join(data_dir(root, name), 'text'), 'w')
+    ctm = open(os.path.join(alignment_dir(root, name), 'forced_phone_alignment.txt'), 'w')
+    features = kaldi_io.BaseFloatMatrixWriter("ark,scp:{0}/feats.ark,{0}/feats.scp".format(data_dir(root, name)))
+
+    for i in range(utterances):
+        uttid = '%s-%06d' % (name, i)
+        utterance = [words[rank] for rank in ranks[i * max_words:i * max_words + rng.randint(3, max_words + 1)]]
+        tokens = []
+        for j, word in enumerate(utterance):
+            tokens.append(word)
+            if j == len(utterance) - 1:
+                tokens.append(punctuation_marks[0])
+            elif rng.rand() < 0.15:
+                tokens.append(punctuation_marks[rng.randint(len(punctuation_marks))])
+        text.write("%s %s\n" % (uttid, " ".join(tokens)))
+
+        # Durations in frames of 10ms
+        frame = rng.randint(10, 30)
+        segments = [(0, frame, 'sil')]
+        for word in utterance:
+            for phone in phone_labels(lexicon[word]):
+                duration = rng.randint(3, 12)
+                segments.append((frame, duration, phone))
+                frame += duration
+            if rng.rand() < 0.2:
+                duration = rng.randint(10, 50)
+                segments.append((frame, duration, 'sil'))
+                frame += duration
+        for start, duration, phone in segments:
+            ctm.write("%s 1 %.2f %.2f %s\n" % (uttid, start / 100., duration / 100., phone))
+
+        features.write(uttid, rng.normal(size=(frame, feat_size)).astype('float32'))
+
+    features.close()
+    text.close()
+    ctm.close()
+
+
+def write_kaldi_data(root, utterances=200, dev_utterances=50, max_words=40, vocabulary=2000,
+                     phones=40, feat_size=43, seed=1234):
+    """Writes the synthetic corpus into `root`."""
+    if not os.path.exists(root):
+        os.makedirs(root)
+    rng = numpy.random.RandomState(seed)
+    punctuation_marks = get_config()['punctuation_marks']
+    words, lexicon = write_lexicon(root, rng, vocabulary, phones)
+    for name, count in zip(SETS, (utterances, dev_utterances)):
+        write_set(root, name, rng, words, lexicon, count, max_words, feat_size, punctuation_marks)
+
+
+def kaldi_config(root, **overrides):
+    """Returns the default config reading the synthetic corpus of `root`."""
+    config = get_config()
+    config.update({
+        'data_dir': root,
+        'cache_dir': os.path.join(root, 'cache'),
+        'wordlist': os.path.join(root, 'wordlist'),
+        'vocabulary': os.path.join(root, 'wordlist'),
+        'cmvn_stats': os.path.join(root, 'cmvn_stats.npz'),
+        'audio_feat_size': 43,
+        'saveto': os.path.join(root, 'model'),
+    })
+    # The vocabulary is read lazily from config['vocabulary'], but these
+    # hold their paths
+    config['lexicon'] = Lazy(_load_lexicon, config, os.path.join(root, 'lexicon.txt'))
+    config['phones'] = Lazy(create_phone_dictionary_from_lexicon, os.path.join(root, 'nonsilence_phones.txt'),
+                            os.path.join(root, 'silence_phones.txt'))
+    for name in SETS:
+        config['%s_data_dir' % name] = data_dir(root, name)
+        config['%s_alignment_dir' % name] = alignment_dir(root, name)
+    config.update(overrides)
+    return config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root")
+    parser.add_argument("--utterances", type=int, default=200)
+    parser.add_argument("--dev-utterances", type=int, default=50)
+    parser.add_argument("--max-words", type=int, default=40)
+    parser.add_argument("--vocabulary", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    write_kaldi_data(args.root, args.utterances, args.dev_utterances, args.max_words, args.vocabulary,
+                     seed=args.seed)
+    print("Wrote {} train and {} dev utterances to {}".format(args.utterances, args.dev_utterances, args.root))
@@ -0,0 +1,124 @@
+"""F1, time and memory of windowed against full context punctuation.
+
+    python -m benchmarks.windowed MODEL_DIR PARAMS DATA_H5 --documents 5 --utterances-per-document 50
+
+Consecutive utterances of the dev set are joined into long documents, as
+if they were one programme, and punctuated once as a whole and once in
+windows of --window words. Each mode runs in a fresh process, which
+reports its peak memory and how much of it decoding added to the model
+and the documents.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import numpy
+import resource
+import subprocess
+import sys
+import time
+
+from collections import OrderedDict
+from itertools import islice
+
+from benchmarks.common import f1, report
+
+
+def read_documents(path, documents, utterances_per_document, sources, config):
+    """Returns (request, reference marks) of every document."""
+    from stream import get_dev_stream
+
+    trg_ivocab = {v: k for k, v in config["trg_vocab"].items()}
+    stream = get_dev_stream(path, prosody='prosody' in sources)
+    examples = [dict(zip(stream.sources, example)) for example in
+                islice(stream.get_epoch_iterator(), documents * utterances_per_document)]
+
+    for i in range(0, len(examples), utterances_per_document):
+        request = {'words': [], 'words_ends': [], 'audio': [], 'prosody': []}
+        reference = []
+        frames = 0
+        for example in examples[i:i + utterances_per_document]:
+            ends = example['words_ends'][:-1]
+            request['words'].extend(example['text'].split()[:-1])
+            request['words_ends'].extend(numpy.where(ends < 0, ends, ends + frames).tolist())
+            request['audio'].extend(example['audio'])
+            if 'prosody' in sources:
+                request['prosody'].extend(example['prosody'][:-1])
+            reference.extend(trg_ivocab[mark] for mark in example['punctuation_marks'][:-1])
+            frames += len(example['audio'])
+        if 'prosody' in sources:
+            request['prosody'].append(numpy.zeros_like(request['prosody'][0]))
+        request['audio'] = numpy.asarray(request['audio'])
+        yield dict((source, request[source]) for source in sources), reference
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def measure(mode, args):
+    """Punctuates the documents in one mode, in this process alone."""
+    from config import get_config
+    from server import Punctuator
+    from windowed import WindowedPunctuator
+
+    config = get_config()
+    punctuator = Punctuator(config, args.model_dir, args.model_filename)
+    documents = list(read_documents(args.data_path, args.documents, args.utterances_per_document,
+                                    punctuator.sources, config))
+    if mode == 'windowed':
+        windowed = WindowedPunctuator(punctuator, args.window or config['window_words'],
+                                      args.overlap or config['window_overlap'], args.batch_size)
+        punctuate = lambda request: windowed.punctuate(request)[0]
+    else:
+        punctuate = lambda request: punctuator.punctuate([punctuator.featurize(request)])[0]['punctuation']
+
+    loaded = peak_rss_mb()
+    start = time.time()
+    hypotheses = [punctuate(request) for request, _ in documents]
+    elapsed = time.time() - start
+    return OrderedDict([
+        ('mode', mode),
+        ('f1', f1([reference for _, reference in documents], hypotheses, config['punctuation_marks'])),
+        ('s_per_document', elapsed / len(documents)),
+        ('peak_rss_mb', peak_rss_mb()),
+        # What decoding adds to the model and the documents
+        ('decoding_rss_mb', peak_rss_mb() - loaded),
+        ('words_per_document', float(numpy.mean([len(request['words']) for request, _ in documents]))),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir")
+    parser.add_argument("model_filename")
+    parser.add_argument("data_path")
+    parser.add_argument("--documents", type=int, default=5)
+    parser.add_argument("--utterances-per-document", type=int, default=50)
+    parser.add_argument("--window", type=int)
+    parser.add_argument("--overlap", type=int)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args)))
+        sys.exit(0)
+
+    # Every mode in a fresh process, so that the peak is its own
+    rows = []
+    for mode in ('windowed', 'full'):
+        command = [sys.executable, '-m', 'benchmarks.windowed', args.model_dir, args.model_filename, args.data_path,
+                   '--documents', str(args.documents),
+                   '--utterances-per-document', str(args.utterances_per_document),
+                   '--batch-size', str(args.batch_size), '--child', mode]
+        for option in ('window', 'overlap'):
+            if getattr(args, option) is not None:
+                command += ['--' + option, str(getattr(args, option))]
+        output = subprocess.check_output(command)
+        rows.append(json.loads(output.decode('utf-8').strip().splitlines()[-1], object_pairs_hook=OrderedDict))
+
+    words = rows[0].pop('words_per_document')
+    rows[1].pop('words_per_document')
+    report("Windowed punctuation of {} words per document".format(words), rows)
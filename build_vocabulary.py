@@ -0,0 +1,49 @@
+"""Builds a frequency shortlist of the source vocabulary.
+
+Counts words in the training text, writes the `vocabulary_shortlist` most
+frequent ones to the path used by `get_config` and reports how much of the
+embedding table (and its AdaDelta state) is saved against the full list.
+
+"""
+import logging
+import numpy as np
+import theano
+
+from config import get_config
+from lexicon import count_words, write_shortlist, create_dictionary_from_lexicon
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+
+def embedding_megabytes(rows, config):
+    # The table itself and two AdaDelta accumulators
+    return 3 * rows * config['enc_embed'] * np.dtype(theano.config.floatX).itemsize / 2. ** 20
+
+
+if __name__ == "__main__":
+    config = get_config()
+    if not config['vocabulary_shortlist']:
+        raise ValueError("Set config['vocabulary_shortlist'] to the size of the shortlist")
+
+    counts = count_words("%s/text" % config['train_data_dir'], config['punctuation_marks'])
+    shortlist = write_shortlist(counts, config['vocabulary_shortlist'], config['vocabulary'])
+    logger.info("Wrote {} words to {}".format(len(shortlist), config['vocabulary']))
+
+    total = sum(counts.values())
+    covered = sum(counts[word] for word in shortlist)
+    logger.info("Shortlist covers {:.2%} of {} training tokens, {} word types".format(
+        float(covered) / total, total, len(counts)))
+
+    full_vocab = create_dictionary_from_lexicon(config['wordlist'], config['punctuation_marks'])
+    full_covered = sum(count for word, count in counts.items() if word in full_vocab)
+    logger.info("Full word list covers {:.2%} of training tokens".format(float(full_covered) / total))
+
+    full_rows = len(full_vocab)
+    rows = len(shortlist) + 2 + config['hash_buckets']
+    logger.info("Embedding rows: full {}, shortlist {} ({} hash buckets)".format(
+        full_rows, rows, config['hash_buckets']))
+    logger.info("Embedding and AdaDelta state: full {:.1f} MB, shortlist {:.1f} MB".format(
+        embedding_megabytes(full_rows, config), embedding_megabytes(rows, config)))
+    logger.info("Compare step times with python -m benchmarks.sparse_embeddings --vocab-size {}".format(rows))
@@ -1,7 +1,11 @@
 
+import errno
+import json
 import logging
+import mmap
 import numpy
 import os
+import struct
 import time
 
 from contextlib import closing
@@ -9,14 +13,83 @@ from six.moves import cPickle
 
 from blocks.extensions.saveload import SAVED_TO, LOADED_FROM
 from blocks.extensions import TrainingExtension, SimpleExtension
+from blocks.log import TrainingLog
 from blocks.serialization import secure_dump, load, BRICK_DELIMITER
 from blocks.utils import reraise_as
 
+from stream import ResumableStream
+from training_log import AppendOnlyLog, LOG_RECORDS_FILENAME
+
 logger = logging.getLogger(__name__)
 
+# Single-file parameter format: a fixed prefix (magic, header length, offset
+# of the data region), a JSON index and raw arrays aligned to page boundaries
+# so that they can be numpy.memmap'd and shared between processes.
+MMAP_MAGIC = b'NMTPARAM'
+MMAP_PREFIX = struct.Struct('<8sQQ')
+MMAP_ALIGNMENT = mmap.ALLOCATIONGRANULARITY
+
+
+def _align(offset, alignment=MMAP_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def is_mmap_parameter_file(path):
+    with open(path, 'rb') as source:
+        return source.read(len(MMAP_MAGIC)) == MMAP_MAGIC
+
+
+def save_mmap_parameter_values(param_values, path):
+    """Saves parameters as page aligned raw arrays with a JSON index."""
+    index = []
+    offset = 0
+    for name in sorted(param_values.keys()):
+        value = numpy.ascontiguousarray(param_values[name])
+        index.append({'name': name, 'dtype': value.dtype.str,
+                      'shape': list(value.shape), 'offset': offset})
+        offset = _align(offset + value.nbytes)
+    header = json.dumps({'parameters': index}).encode('utf8')
+    data_start = _align(MMAP_PREFIX.size + len(header))
+
+    with open(path, 'wb') as target:
+        target.write(MMAP_PREFIX.pack(MMAP_MAGIC, len(header), data_start))
+        target.write(header)
+        for entry in index:
+            target.seek(data_start + entry['offset'])
+            target.write(numpy.ascontiguousarray(
+                param_values[entry['name']]).tobytes())
+        target.truncate(data_start + offset)
+
+
+def load_mmap_parameter_values(path, mode='r'):
+    """Maps every parameter of a single-file checkpoint without reading it.
+
+    Pages are loaded lazily on first access and shared by all processes
+    which map the same file in read-only mode.
+
+    """
+    with open(path, 'rb') as source:
+        magic, header_size, data_start = MMAP_PREFIX.unpack(
+            source.read(MMAP_PREFIX.size))
+        if magic != MMAP_MAGIC:
+            raise ValueError("{} is not a parameter file".format(path))
+        header = json.loads(source.read(header_size).decode('utf8'))
+
+    param_values = {}
+    for entry in header['parameters']:
+        shape = tuple(entry['shape'])
+        if numpy.prod(shape) == 0:
+            param_values[entry['name']] = numpy.zeros(shape, entry['dtype'])
+            continue
+        param_values[entry['name']] = numpy.memmap(
+            path, dtype=numpy.dtype(entry['dtype']), mode=mode,
+            offset=data_start + entry['offset'], shape=shape)
+    return param_values
+
 
 class SaveLoadUtils(object):
     """Utility class for checkpointing."""
+    rank = 0
 
     @property
     def path_to_folder(self):
@@ -28,13 +101,23 @@ class SaveLoadUtils(object):
 
     @property
     def path_to_iteration_state(self):
+        # Data parallel workers read different shards, each has its own
+        if self.rank:
+            return os.path.join(self.folder, 'iterations_state.{}.pkl'.format(self.rank))
         return os.path.join(self.folder, 'iterations_state.pkl')
 
     @property
     def path_to_log(self):
         return os.path.join(self.folder, 'log')
 
+    @property
+    def path_to_log_records(self):
+        return os.path.join(self.folder, LOG_RECORDS_FILENAME)
+
     def load_parameter_values(self, path):
+        if is_mmap_parameter_file(path):
+            return load_mmap_parameter_values(path)
+
         with closing(numpy.load(path)) as source:
             param_values = {}
             for name, value in source.items():
@@ -46,6 +129,9 @@ class SaveLoadUtils(object):
         return param_values
 
     def save_parameter_values(self, param_values, path):
+        if path.endswith('.mmap'):
+            return save_mmap_parameter_values(param_values, path)
+
         param_values = {name.replace("/", BRICK_DELIMITER): param
                         for name, param in param_values.items()}
         numpy.savez(path, **param_values)
@@ -54,13 +140,20 @@ class SaveLoadUtils(object):
 class CheckpointNMT(SimpleExtension, SaveLoadUtils):
     """Redefines checkpointing for NMT.
 
-        Saves only parameters (npz), iteration state (pickle) and log (pickle).
+        Saves only parameters (npz, or the memory-mappable format when the
+        filename ends with .mmap), iteration state (pickle, or only the
+        stream cursor of a `ResumableStream`) and log (pickle, or only a
+        resume cursor when the log is an `AppendOnlyLog`).
+
+        A data parallel worker with a `rank` other than 0 saves only the
+        cursor of its own shard.
 
     """
 
-    def __init__(self, saveto, filename="params.npz", **kwargs):
+    def __init__(self, saveto, filename="params.npz", rank=0, **kwargs):
         self.folder = saveto
         self.filename = filename
+        self.rank = rank
         kwargs.setdefault("after_training", True)
         super(CheckpointNMT, self).__init__(**kwargs)
 
@@ -70,14 +163,27 @@ class CheckpointNMT(SimpleExtension, SaveLoadUtils):
                                    self.path_to_parameters)
 
     def dump_iteration_state(self, main_loop):
-        secure_dump(main_loop.iteration_state, self.path_to_iteration_state)
+        if isinstance(main_loop.data_stream, ResumableStream):
+            secure_dump(main_loop.data_stream.cursor, self.path_to_iteration_state)
+        else:
+            secure_dump(main_loop.iteration_state, self.path_to_iteration_state)
 
     def dump_log(self, main_loop):
-        secure_dump(main_loop.log, self.path_to_log, cPickle.dump)
+        log = main_loop.log
+        if isinstance(log, AppendOnlyLog):
+            log = log.cursor()
+        secure_dump(log, self.path_to_log, cPickle.dump)
 
     def dump(self, main_loop):
-        if not os.path.exists(self.path_to_folder):
+        try:
             os.mkdir(self.path_to_folder)
+        except OSError as e:
+            # Several data parallel workers may create it at once
+            if e.errno != errno.EEXIST:
+                raise
+        if self.rank:
+            self.dump_iteration_state(main_loop)
+            return
         print("")
         logger.info(" Saving model")
         start = time.time()
@@ -97,16 +203,23 @@ class CheckpointNMT(SimpleExtension, SaveLoadUtils):
         finally:
             already_saved_to = self.main_loop.log.current_row.get(SAVED_TO, ())
             self.main_loop.log.current_row[SAVED_TO] = (already_saved_to +
-                                                        (self.path_to_folder +
-                                                            'params.npz',))
+                                                        (self.path_to_parameters,))
 
 
 class LoadNMT(TrainingExtension, SaveLoadUtils):
-    """Loads parameters log and iterations state."""
+    """Loads parameters log and iterations state.
 
-    def __init__(self, saveto, filename="params.npz", **kwargs):
+    Without `load_log` the log is left alone, for data parallel workers
+    which only follow the worker that writes it. The iteration state is
+    that of the worker `rank`.
+
+    """
+
+    def __init__(self, saveto, filename="params.npz", load_log=True, rank=0, **kwargs):
         self.folder = saveto
         self.filename = filename
+        self.rank = rank
+        self.load_log_records = load_log
         super(LoadNMT, self).__init__(saveto, **kwargs)
 
     def before_training(self):
@@ -130,7 +243,10 @@ class LoadNMT(TrainingExtension, SaveLoadUtils):
 
     def load_log(self):
         with open(self.path_to_log, "rb") as source:
-            return cPickle.load(source)
+            log = cPickle.load(source)
+        if not isinstance(log, TrainingLog):
+            return AppendOnlyLog.from_cursor(log, self.path_to_log_records)
+        return log
 
     def load_to(self, main_loop):
         """Loads the dump from the root folder into the main loop."""
@@ -142,19 +258,45 @@ class LoadNMT(TrainingExtension, SaveLoadUtils):
         except Exception as e:
             logger.error(" Error {0}".format(str(e)))
 
+        cursor = None
         try:
             logger.info(" Loading iteration state...")
-            main_loop.iteration_state = self.load_iteration_state()
-        except Exception as e:
-            logger.error(" Error {0}".format(str(e)))
-
-        try:
-            logger.info(" Loading log...")
-            main_loop.log = self.load_log()
+            iteration_state = self.load_iteration_state()
+            if isinstance(iteration_state, dict):
+                cursor = iteration_state
+            else:
+                main_loop.iteration_state = iteration_state
         except Exception as e:
             logger.error(" Error {0}".format(str(e)))
 
-    def set_model_parameters(self, model, params_all):
+        if self.load_log_records:
+            try:
+                logger.info(" Loading log...")
+                main_loop.log = self.load_log()
+            except Exception as e:
+                logger.error(" Error {0}".format(str(e)))
+
+        if cursor is not None:
+            try:
+                logger.info(" Seeking data stream to {}".format(cursor))
+                self.set_stream_cursor(main_loop, cursor)
+            except Exception as e:
+                logger.error(" Error {0}".format(str(e)))
+
+    def set_stream_cursor(self, main_loop, cursor):
+        main_loop.data_stream.cursor = cursor
+        if main_loop.status.get('epoch_started', False):
+            # Blocks continues an interrupted epoch with this iterator
+            main_loop.epoch_iterator = main_loop.data_stream.get_epoch_iterator(as_dict=True)
+
+    def set_model_parameters(self, model, params_all, borrow=False):
+            """Copies loaded values into the model's shared variables.
+
+            With `borrow` the shared variables keep a reference to the loaded
+            arrays, so memory-mapped parameters stay backed by the page cache
+            (only safe when the model is not trained afterwards).
+
+            """
             params_this = model.get_parameter_dict()
             missing = set(params_this.keys()) - set(params_all.keys())
             for pname in params_this.keys():
@@ -166,7 +308,7 @@ class LoadNMT(TrainingExtension, SaveLoadUtils):
                             .format(params_this[pname].get_value().shape,
                                     val.shape, pname))
 
-                    params_this[pname].set_value(val)
+                    params_this[pname].set_value(val, borrow=borrow)
                     logger.info(" Loaded to CG {:15}: {}"
                                 .format(val.shape, pname))
                 else:
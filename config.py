@@ -1,18 +1,102 @@
-from lexicon import create_dictionary_from_lexicon, create_dictionary_from_punctuation_marks, create_phone_dictionary_from_lexicon, create_lexicon
+from lexicon import (create_dictionary_from_punctuation_marks, create_phone_dictionary_from_lexicon,
+                     load_compiled_dictionary, load_compiled_lexicon)
+
+
+class Lazy(object):
+    """Config value which is computed on first access."""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __call__(self):
+        return self.function(*self.args)
+
+
+class LazyConfig(dict):
+    """Dictionary which resolves `Lazy` values when they are accessed."""
+
+    def __getitem__(self, key):
+        value = super(LazyConfig, self).__getitem__(key)
+        if isinstance(value, Lazy):
+            value = value()
+            self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def copy(self):
+        """Returns a copy whose unresolved values are computed from the copy."""
+        copy = LazyConfig()
+        for key in self:
+            value = super(LazyConfig, self).__getitem__(key)
+            if isinstance(value, Lazy):
+                value = Lazy(value.function, *[copy if arg is self else arg for arg in value.args])
+            dict.__setitem__(copy, key, value)
+        return copy
+
+
+def _size_of(config, key):
+    return len(config[key])
+
+
+def _vocabulary_size(config):
+    return len(config['src_vocab']) + config['hash_buckets']
+
+
+def _index_of(config, key, value):
+    return config[key][value]
+
+
+def _prosody_size(config):
+    columns = config['prosodic_columns']
+    return 3 + 2 * (len(columns) if columns is not None else config['audio_feat_size'])
+
+
+def _load_vocabulary(config):
+    return load_compiled_dictionary(config['vocabulary'], config['punctuation_marks'], config['cache_dir'])
+
+
+def _load_lexicon(config, path):
+    return load_compiled_lexicon(path, config['cache_dir'])
+
 
 def get_config():
-    config = {}
-    config['vocabulary'] = "/disk/scratch2/s1569734/acoustic_punctuation/mgb.150k.wlist"
-    config['lexicon'] = create_lexicon("/disk/scratch2/s1569734/bbc_original/data/local/dict/lexicon.txt")
-    config['phones'] = create_phone_dictionary_from_lexicon("/disk/scratch2/s1569734/acoustic_punctuation/nonsilence_phones.txt", "/disk/scratch2/s1569734/acoustic_punctuation/silence_phones.txt")
-    config['phones_vocab_size'] = len(config['phones'])
+    config = LazyConfig()
+    config['data_dir'] = "/disk/scratch2/s1569734/acoustic_punctuation/"
+
+    # Compiled vocabulary and lexicon, rebuilt when the sources change
+    config['cache_dir'] = "%s/cache" % config['data_dir']
+
+    config['wordlist'] = "/disk/scratch2/s1569734/acoustic_punctuation/mgb.150k.wlist"
+    config['vocabulary'] = config['wordlist']
+
+    # Keep only this many most frequent training words instead of the whole
+    # word list, the shortlist is written by build_vocabulary.py
+    config['vocabulary_shortlist'] = None
+    if config['vocabulary_shortlist']:
+        config['vocabulary'] = "%s/shortlist.%d.wlist" % (config['data_dir'], config['vocabulary_shortlist'])
+
+    # Map words outside of the vocabulary to this many hashed embeddings
+    # instead of <unk>
+    config['hash_buckets'] = 0
+    config['lexicon'] = Lazy(_load_lexicon, config, "/disk/scratch2/s1569734/bbc_original/data/local/dict/lexicon.txt")
+    config['phones'] = Lazy(create_phone_dictionary_from_lexicon, "/disk/scratch2/s1569734/acoustic_punctuation/nonsilence_phones.txt", "/disk/scratch2/s1569734/acoustic_punctuation/silence_phones.txt")
+    config['phones_vocab_size'] = Lazy(_size_of, config, 'phones')
     config['punctuation_marks'] = ["<FULL_STOP>", "<COMMA>", "<QUESTION_MARK>", "<EXCLAMATION_MARK>", "<DOTS>"]
 
-    config["src_vocab"] = create_dictionary_from_lexicon(config["vocabulary"], config["punctuation_marks"])
-    config["src_vocab_size"] = len(config["src_vocab"].values())
+    config["src_vocab"] = Lazy(_load_vocabulary, config)
+    config["src_vocab_size"] = Lazy(_vocabulary_size, config)
     config["trg_vocab"] = create_dictionary_from_punctuation_marks(config["punctuation_marks"])
     config["trg_vocab_size"] = len(config["trg_vocab"].values())
-    config["src_eos_idx"] = config["src_vocab"]["</s>"]
+    config["src_eos_idx"] = Lazy(_index_of, config, "src_vocab", "</s>")
     config["trg_eos_idx"] = config["trg_vocab"]["</s>"]
     config['bos_token'] = '<s>'
     config['eos_token'] = '</s>'
@@ -28,15 +112,55 @@ def get_config():
     config['best_asr_data_dir'] = "/disk/scratch2/s1569734/bbc_without_punctuation/data/best_asr/"
     config['best_asr_alignment_dir'] = "/disk/scratch2/s1569734/bbc_without_punctuation/exp/alignment/best_asr/"
 
-    config['data_dir'] = "/disk/scratch2/s1569734/acoustic_punctuation/"
+    # Global mean and std of the training features, written by
+    # prepare_data.py and used to normalize new data at inference
+    config['cmvn_stats'] = "%s/cmvn_stats.npz" % config['data_dir']
 
     # Model related -----------------------------------------------------------
 
+    # One of 'words', 'audio', 'phones', 'phones-audio', 'prosody' and 'both'
     config['input'] = 'both'
     config['combination'] = 'dropout-add'
     config['audio_feat_size'] = 4
     config['take_every_nth'] = 3
 
+    # Merge this many adjacent frames before the frame level GRU of the audio
+    # encoder, either by concatenation ('pyramid') or a strided convolution
+    # ('conv')
+    config['frame_downsampling'] = 1
+    config['frame_downsampling_mode'] = 'pyramid'
+
+    # Recompute the GRU input projections of the word and audio encoders in
+    # the backward pass instead of storing them, for long utterances
+    config['encoder_recompute'] = False
+
+    # Pack several utterances into one row of frames for the audio encoder,
+    # rows are pack_length frames or as long as the longest utterance
+    config['pack_audio'] = False
+    config['pack_length'] = None
+
+    # Streaming model (see streaming.py): the backward GRUs of the encoders
+    # see only this many following words and the attention only the words up
+    # to the current mark, so every mark can be emitted as soon as this many
+    # more words arrived. None for the offline model
+    config['streaming_lookahead'] = None
+
+    # Frames (after downsampling) past the current one seen by the frame level
+    # backward GRU of the streaming audio encoder
+    config['streaming_frame_lookahead'] = 4
+
+    # Acoustic word embeddings from a GRU over the whole utterance sampled at
+    # word ends ('utterance'), from per-word segments encoded in parallel
+    # ('segment') or, for the 'both' input, from prosodic word features
+    # ('prosody')
+    config['audio_encoder'] = 'utterance'
+
+    # Audio feature columns pooled into the prosodic word features (None for
+    # all), each word gets its duration, pauses around it and the mean and std
+    # of the columns
+    config['prosodic_columns'] = None
+    config['prosody_feat_size'] = Lazy(_prosody_size, config)
+
 
     # Sequences longer than this will be discarded
     config['seq_len'] = 1000
@@ -60,12 +184,20 @@ def get_config():
     # This many batches will be read ahead and sorted
     config['sort_k_batches'] = 50
 
+    # Seed of the per-epoch shuffling of training examples, None keeps the
+    # order of the HDF5 file
+    config['shuffle_seed'] = None
+
     # Optimization step rule
     config['step_rule'] = 'AdaDelta'
 
     # Gradient clipping threshold
     config['step_clipping'] = 1.
 
+    # Update only the rows of the words embedding (and its AdaDelta state)
+    # which are present in the batch
+    config['sparse_embeddings'] = False
+
     # Std of weight initialization
     config['weight_scale'] = 0.01
 
@@ -74,6 +206,15 @@ def get_config():
     # Dropout ratio, applied only after readout maxout
     config['dropout'] = 0.5
 
+    # Distillation related ----------------------------------------------------
+
+    # Posteriors of a teacher model for the training set, cached by distill.py.
+    # The cost is distill_weight times the cross entropy with them plus the
+    # rest times the cost of the reference marks. None trains on the
+    # references only
+    config['distill_posteriors'] = None
+    config['distill_weight'] = 0.5
+
     # Vocabulary/dataset related ----------------------------------------------
 
     # Root directory for dataset
@@ -99,6 +240,20 @@ def get_config():
     # Beam-size
     config['beam_size'] = 6
 
+    # Decode greedily at steps where the best punctuation mark costs at least
+    # this much (in nats) less than the second best one and with the whole
+    # beam elsewhere (search.AdaptiveBeamSearch), None always uses the beam
+    config['beam_margin'] = None
+
+    # Use mask inputs in the sampling graph, needed to decode padded batches
+    # of several utterances (search.py, server.py)
+    config['masked_sampling'] = False
+
+    # Windows of long transcripts punctuated separately (windowed.py), in
+    # words, and the least number of words shared by consecutive windows
+    config['window_words'] = 100
+    config['window_overlap'] = 20
+
     # Timing/monitoring related -----------------------------------------------
 
     # Maximum number of updates
@@ -110,6 +265,16 @@ def get_config():
     # Save model after this many updates
     config['save_freq'] = 500
 
+    # Training log backend, 'append' writes finished rows to saveto/log.jsonl
+    # and checkpoints only a resume cursor, 'python' keeps the whole log
+    config['log_backend'] = 'append'
+
+    # Time the stages of the training stream, the training step and the
+    # extensions of every batch (timing.py), with rolling summaries of the
+    # last timing_window batches in saveto/metrics.prom
+    config['pipeline_timing'] = False
+    config['timing_window'] = 100
+
     # Show samples from model after this many updates
     config['sampling_freq'] = 1000
 
@@ -123,3 +288,15 @@ def get_config():
     config['val_burn_in'] = 5000
 
     return config
+
+
+def get_student_config():
+    """Smaller model distilled from one trained with `get_config`."""
+    config = get_config()
+    config['enc_nhids'] = 64
+    config['dec_nhids'] = 64
+    config['enc_embed'] = 128
+    config['dec_embed'] = 128
+    config['distill_posteriors'] = "%s/data_global_cmvn_with_phones_alignment_pitch_features.teacher.h5" % config['data_dir']
+    config['saveto'] = config['saveto'].rstrip('/') + '_student/'
+    return config
@@ -0,0 +1,30 @@
+"""Converts npz checkpoints into the memory-mappable parameter format.
+
+Parameters saved in the .mmap format are loaded lazily by `LoadNMT`, so
+several inference processes on one host share the same physical pages.
+
+    python convert_params.py best_f1_model_1473242935_F10.59.npz model.mmap
+
+"""
+import argparse
+import logging
+
+from checkpoint import SaveLoadUtils
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("source", help="Checkpoint to convert (npz or mmap)")
+parser.add_argument("target", help="Output path, the format is chosen by its extension")
+args = parser.parse_args()
+
+
+if __name__ == "__main__":
+    utils = SaveLoadUtils()
+    param_values = utils.load_parameter_values(args.source)
+    for name, value in sorted(param_values.items()):
+        logger.info(" {:15}: {}".format(value.shape, name))
+    utils.save_parameter_values(param_values, args.target)
+    logger.info("Saved {} parameters to {}".format(len(param_values), args.target))
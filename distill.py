@@ -0,0 +1,88 @@
+"""Caches the posteriors of a teacher model for distillation.
+
+    python distill.py TEACHER_DIR TEACHER_PARAMS [--proto get_config] [--student-proto get_student_config]
+
+The teacher, built with the --proto config, is fed the reference marks of
+every training example and its distribution over the punctuation marks at
+every slot is written to config['distill_posteriors'] of the student
+config, in the order of the training split. `get_tr_stream` adds them to
+the training examples, so the student is then trained as usual:
+
+    python . --proto get_student_config
+
+"""
+import argparse
+import h5py
+import logging
+import numpy
+import theano
+
+from blocks.graph import ComputationGraph
+from fuel.datasets import H5PYDataset
+
+import config as configurations
+from checkpoint import LoadNMT
+from helpers import create_model, create_posteriors_graph
+from prepare_data import create_numpy_array_dataset
+from search import pad_examples
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+
+def teacher_posteriors(config, model_dir, model_filename, data_path, batch_size=50):
+    """Yields the (marks, vocab) posteriors of every training example."""
+    config['masked_sampling'] = True
+    _, _, search_model = create_model(config)
+    posteriors = create_posteriors_graph(config, search_model)
+    loader = LoadNMT(model_dir, model_filename)
+    loader.set_model_parameters(search_model, loader.load_parameters(), borrow=True)
+    inputs = ComputationGraph(posteriors).inputs
+    compute_posteriors = theano.function(inputs, posteriors)
+    names = [v.name[len('sampling_'):] if v.name.startswith('sampling_') else v.name for v in inputs]
+    sources = tuple(sorted(set(name for name in names if not name.endswith('_mask'))))
+
+    dataset = H5PYDataset(data_path, which_sets=('train',), sources=sources, load_in_memory=False)
+    state = dataset.open()
+    for start in range(0, dataset.num_examples, batch_size):
+        examples = [dict(zip(dataset.sources, dataset.get_data(state, index)))
+                    for index in range(start, min(start + batch_size, dataset.num_examples))]
+        padded = pad_examples(examples, sources)
+        batch = compute_posteriors(*[padded[name].astype(v.dtype) for name, v in zip(names, inputs)])
+        for example, example_posteriors in zip(examples, batch):
+            yield example_posteriors[:len(example['punctuation_marks'])]
+        logger.info("Computed the posteriors of {} examples".format(start + len(examples)))
+    dataset.close(state)
+
+
+def save_posteriors(path, posteriors, num_examples):
+    """Writes the posteriors as the 'train' split of an HDF5 file."""
+    with h5py.File(path, 'w') as h5file:
+        shapes, dataset = create_numpy_array_dataset(h5file, 'teacher_posteriors', num_examples, 2, 'float32')
+        for i, example_posteriors in enumerate(posteriors):
+            shapes[i] = example_posteriors.shape
+            dataset[i] = numpy.asarray(example_posteriors, dtype='float32').ravel()
+        h5file.attrs['split'] = H5PYDataset.create_split_array(
+            {'train': {'teacher_posteriors': (0, num_examples)}})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir")
+    parser.add_argument("model_filename")
+    parser.add_argument("--proto", default="get_config", help="Config of the teacher")
+    parser.add_argument("--student-proto", default="get_student_config", help="Config of the student")
+    parser.add_argument("--data-path", help="Training HDF5 file, by default the one of __main__.py")
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+
+    config = getattr(configurations, args.proto)()
+    output = getattr(configurations, args.student_proto)()['distill_posteriors']
+    data_path = args.data_path or "%s/data_global_cmvn_with_phones_alignment_pitch_features.h5" % config["data_dir"]
+    num_examples = H5PYDataset(data_path, which_sets=('train',), sources=('punctuation_marks',),
+                               load_in_memory=False).num_examples
+
+    logger.info("Writing the posteriors of {} examples to {}".format(num_examples, output))
+    save_posteriors(output, teacher_posteriors(config, args.model_dir, args.model_filename, data_path,
+                                               args.batch_size), num_examples)
@@ -8,9 +8,11 @@ from blocks.filter import VariableFilter
 from blocks.graph import ComputationGraph
 from blocks.initialization import IsotropicGaussian, Orthogonal, Constant
 from blocks.model import Model
+from blocks.roles import INPUT
 from blocks.select import Selector
 
-from model import BidirectionalEncoder, BidirectionalAudioEncoder, BidirectionalPhonesEncoder, BidirectionalPhonemeAudioEncoder, Decoder
+from model import (BidirectionalEncoder, BidirectionalAudioEncoder, BidirectionalPhonesEncoder, BidirectionalPhonemeAudioEncoder,
+                   SegmentAudioEncoder, SegmentPhonemeAudioEncoder, ProsodicEncoder, Decoder)
 from cost import stimulation_cost
 
 logger = logging.getLogger(__name__)
@@ -20,7 +22,70 @@ logger.setLevel(logging.INFO)
 rs = np.random.RandomState(1234)
 rng = tensor.shared_randomstreams.RandomStreams(rs.randint(999999))
 
+# Masks of the sampling graph which are over words, one of them is used for
+# the attention of the decoder
+WORD_SAMPLING_MASKS = ('sampling_words_mask', 'sampling_words_ends_mask',
+                       'sampling_phones_words_ends_mask', 'sampling_prosody_mask')
+
+def sampling_mask(config, name, sequences):
+    """Mask input of the sampling graph, all ones unless config['masked_sampling']."""
+    if config['masked_sampling']:
+        return tensor.matrix(name)
+    return tensor.ones((sequences.shape[0], sequences.shape[1]))
+
+def uses_prosody(config):
+    """Whether the model reads the prosodic word features."""
+    return config["input"] == "prosody" or (config["input"] == "both" and config["audio_encoder"] == "prosody")
+
+def merge_representations(config, words, audio, train=True):
+    """Combines the word and audio representations of the 'both' input."""
+    if config["combination"] == "max":
+        return tensor.max(tensor.stack([words, audio], axis=0), axis=0)
+    if config["combination"] == "dropout-max":
+        max = tensor.max(tensor.stack([words, audio], axis=0), axis=0)
+        p = 0.5
+        if train is True:
+            mask = tensor.extra_ops.repeat(rng.binomial(n=1, p=p, size=(1, words.shape[1], words.shape[2]), dtype=theano.config.floatX), words.shape[0], axis=0)
+            return mask * max
+        else:
+            return p * max
+    if config["combination"] == "avg":
+        return tensor.mean(tensor.stack([words, audio], axis=0), axis=0)
+    if config["combination"] == "add":
+        return words + audio
+    if config["combination"] == "dropout-add":
+        p = 0.5
+        if train is True:
+            mask = tensor.extra_ops.repeat(rng.binomial(n=1, p=p, size=(1, words.shape[1], words.shape[2]), dtype=theano.config.floatX), words.shape[0], axis=0)
+            return mask * (words + audio)
+        else:
+            return p * (words + audio)
+    if config["combination"] == "concat":
+        return tensor.concatenate([words, audio], axis=2)
+    if config["combination"] == "mask":
+        p = 0.5
+        if train is True:
+            #mask = rng.binomial(n=1, p=p, size=words.shape, dtype=theano.config.floatX)
+            mask = tensor.extra_ops.repeat(rng.binomial(n=1, p=p, size=(1, words.shape[1], words.shape[2]), dtype=theano.config.floatX), words.shape[0], axis=0)
+
+            return mask * words + (1-mask) * audio
+        else:
+            return p * words + (1-p) * audio
+
 def create_model(config):
+    if config["pack_audio"] and (config["input"] not in ("audio", "both") or config["audio_encoder"] != "utterance"):
+        raise ValueError("Packing is only implemented for the utterance level audio encoder")
+    if config["streaming_lookahead"] is not None:
+        if config["input"] not in ("words", "audio", "both") or (config["input"] != "words" and config["audio_encoder"] != "utterance"):
+            raise ValueError("Streaming is only implemented for the word and the utterance level audio encoders")
+        if config["pack_audio"]:
+            raise ValueError("Streaming models can not be trained on packed audio")
+    if config["input"] in ("audio", "both") and config["audio_encoder"] == "segment":
+        if config["frame_downsampling"] != 1 or config["encoder_recompute"]:
+            raise ValueError("Frame downsampling (config['frame_downsampling'] and "
+                             "config['frame_downsampling_mode']) and encoder recomputation are only "
+                             "implemented for the utterance level audio encoder")
+
     if config["input"] == "words":
         encoder, training_representation, sampling_representation = create_word_encoder(config)
         models = [encoder]
@@ -33,47 +98,18 @@ def create_model(config):
     elif config["input"] == "phones-audio":
         encoder, training_representation, sampling_representation = create_phones_audio_encoder(config)
         models = [encoder]
+    elif config["input"] == "prosody":
+        encoder, training_representation, sampling_representation = create_prosodic_encoder(config)
+        models = [encoder]
     elif config["input"] == "both":
         words_encoder, words_training_representation, words_sampling_representation = create_word_encoder(config)
-        audio_encoder, audio_training_representation, audio_sampling_representation = create_audio_encoder(config)
-
-        def merge_representations(words, audio, train=True):
-            if config["combination"] == "max":
-                return tensor.max(tensor.stack([words, audio], axis=0), axis=0)
-            if config["combination"] == "dropout-max":
-                max = tensor.max(tensor.stack([words, audio], axis=0), axis=0)
-                p = 0.5
-                if train is True:
-                    mask = tensor.extra_ops.repeat(rng.binomial(n=1, p=p, size=(1, words.shape[1], words.shape[2]), dtype=theano.config.floatX), words.shape[0], axis=0)
-                    return mask * max
-                else:
-                    return p * max
-            if config["combination"] == "avg":
-                return tensor.mean(tensor.stack([words, audio], axis=0), axis=0)
-            if config["combination"] == "add":
-                return words + audio
-            if config["combination"] == "dropout-add":
-                p = 0.5
-                if train is True:
-                    mask = tensor.extra_ops.repeat(rng.binomial(n=1, p=p, size=(1, words.shape[1], words.shape[2]), dtype=theano.config.floatX), words.shape[0], axis=0)
-                    return mask * (words + audio)
-                else:
-                    return p * (words + audio)
-            if config["combination"] == "concat":
-                return tensor.concatenate([words, audio], axis=2)
-            if config["combination"] == "mask":
-                p = 0.5
-                if train is True:
-                    #mask = rng.binomial(n=1, p=p, size=words.shape, dtype=theano.config.floatX)
-                    mask = tensor.extra_ops.repeat(rng.binomial(n=1, p=p, size=(1, words.shape[1], words.shape[2]), dtype=theano.config.floatX), words.shape[0], axis=0)
-
-                    return mask * words + (1-mask) * audio
-                else:
-                    return p * words + (1-p) * audio
-
-
-        training_representation = merge_representations(words_training_representation, audio_training_representation)
-        sampling_representation = merge_representations(words_sampling_representation, audio_sampling_representation, False)
+        if config["audio_encoder"] == "prosody":
+            audio_encoder, audio_training_representation, audio_sampling_representation = create_prosodic_encoder(config)
+        else:
+            audio_encoder, audio_training_representation, audio_sampling_representation = create_audio_encoder(config)
+
+        training_representation = merge_representations(config, words_training_representation, audio_training_representation)
+        sampling_representation = merge_representations(config, words_sampling_representation, audio_sampling_representation, False)
         models = [words_encoder, audio_encoder]
 
     decoder, cost, samples, search_model, punctuation_marks, mask = create_decoder(config, training_representation, sampling_representation)
@@ -88,6 +124,76 @@ def create_model(config):
 
     return cost, samples, search_model
 
+def find_brick(bricks, brick_class):
+    """The first of `bricks` which is a `brick_class`, or None."""
+    for brick in bricks:
+        if isinstance(brick, brick_class):
+            return brick
+    return None
+
+def create_shared_audio_search(config, search_model):
+    """Sampling graph for several transcriptions of the same audio.
+
+    Built on the bricks of the `search_model` from `create_model` with
+    config['masked_sampling']. The 'sampling_audio' input holds a single
+    utterance and the word level inputs one row per transcription, e.g.
+    per ASR N-best hypothesis, so the frame level audio encoder runs once
+    for all of them (see `BidirectionalAudioEncoder.apply_shared`).
+
+    """
+    if config["input"] not in ("audio", "both") or config["audio_encoder"] != "utterance":
+        raise ValueError("Sharing is only implemented for the utterance level audio encoder")
+    bricks = search_model.top_bricks
+    audio_encoder = find_brick(bricks, BidirectionalAudioEncoder)
+    decoder = find_brick(bricks, Decoder)
+
+    audio = tensor.ftensor3('sampling_audio')
+    audio_mask = tensor.matrix('sampling_audio_mask')
+    words_ends = tensor.lmatrix('sampling_words_ends')
+    words_ends_mask = tensor.matrix('sampling_words_ends_mask')
+    representation = audio_encoder.apply_shared(audio, audio_mask, words_ends, words_ends_mask)
+    if config["input"] == "both":
+        words = tensor.lmatrix('sampling_words')
+        words_mask = tensor.matrix('sampling_words_mask')
+        words_representation = find_brick(bricks, BidirectionalEncoder).apply(words, words_mask)
+        representation = merge_representations(config, words_representation, representation, False)
+
+    generated = decoder.generate(representation, words_ends_mask.T)
+    _, samples = VariableFilter(bricks=[decoder.sequence_generator], name="outputs")(ComputationGraph(generated[1]))
+    return samples, Model(generated)
+
+def _teacher_forced_graph(config, search_model, application_name):
+    if not config['masked_sampling']:
+        raise ValueError("Padded batches need config['masked_sampling']")
+    decoder = find_brick(search_model.top_bricks, Decoder)
+    representation, representation_mask = sorted(
+        VariableFilter(applications=[decoder.generate], roles=[INPUT])(search_model.variables),
+        key=lambda variable: -variable.ndim)
+
+    punctuation_marks = tensor.lmatrix('punctuation_marks')
+    punctuation_marks_mask = tensor.matrix('punctuation_marks_mask')
+    application = getattr(decoder, application_name)
+    return application(representation, representation_mask.T, punctuation_marks, punctuation_marks_mask)
+
+def create_scoring_graph(config, search_model):
+    """Forced scoring of given punctuations on the inputs of `search_model`.
+
+    The `search_model` must come from `create_model` with
+    config['masked_sampling']. Returns the negative log-probability of
+    every mark of the 'punctuation_marks' input as a (batch, time) matrix
+    which is zero where 'punctuation_marks_mask' is.
+
+    """
+    return _teacher_forced_graph(config, search_model, 'cost_matrix')
+
+def create_posteriors_graph(config, search_model):
+    """Posteriors of every mark given the previous 'punctuation_marks'.
+
+    Like `create_scoring_graph`, returns a (batch, time, vocab) tensor.
+
+    """
+    return _teacher_forced_graph(config, search_model, 'posteriors')
+
 def create_multitask_model(config):
     words_encoder, words_training_representation, words_sampling_representation = create_word_encoder(config)
     audio_encoder, audio_training_representation, audio_sampling_representation = create_audio_encoder(config)
@@ -107,7 +213,8 @@ def create_multitask_model(config):
 
 
 def create_word_encoder(config):
-    encoder = BidirectionalEncoder(config['src_vocab_size'], config['enc_embed'], config['enc_nhids'])
+    encoder = BidirectionalEncoder(config['src_vocab_size'], config['enc_embed'], config['enc_nhids'],
+                                   config['encoder_recompute'], config['streaming_lookahead'])
     encoder.weights_init = IsotropicGaussian(config['weight_scale'])
     encoder.biases_init = Constant(0)
     encoder.push_initialization_config()
@@ -120,35 +227,69 @@ def create_word_encoder(config):
     training_representation.name = "words_representation"
 
     sampling_input_words = tensor.lmatrix('sampling_words')
-    sampling_input_words_mask = tensor.ones((sampling_input_words.shape[0], sampling_input_words.shape[1]))
+    sampling_input_words_mask = sampling_mask(config, 'sampling_words_mask', sampling_input_words)
     sampling_representation = encoder.apply(sampling_input_words, sampling_input_words_mask)
 
     return encoder, training_representation, sampling_representation
 
 def create_audio_encoder(config):
-    encoder = BidirectionalAudioEncoder(config['audio_feat_size'], config['enc_embed'], config['enc_nhids'])
+    if config['audio_encoder'] == 'segment':
+        encoder = SegmentAudioEncoder(config['audio_feat_size'], config['enc_embed'], config['enc_nhids'])
+    else:
+        encoder = BidirectionalAudioEncoder(config['audio_feat_size'], config['enc_embed'], config['enc_nhids'],
+                                            config['frame_downsampling'], config['frame_downsampling_mode'],
+                                            config['encoder_recompute'], config['streaming_lookahead'],
+                                            config['streaming_frame_lookahead'])
     encoder.weights_init = IsotropicGaussian(config['weight_scale'])
     encoder.biases_init = Constant(0)
     encoder.push_initialization_config()
     encoder.bidir.prototype.weights_init = Orthogonal()
-    encoder.embedding.prototype.weights_init = Orthogonal()
+    if config['audio_encoder'] == 'segment':
+        encoder.segments.bidir.prototype.weights_init = Orthogonal()
+    else:
+        encoder.embedding.prototype.weights_init = Orthogonal()
     encoder.initialize()
 
     audio = tensor.ftensor3('audio')
     audio_mask = tensor.matrix('audio_mask')
     words_ends = tensor.lmatrix('words_ends')
     words_ends_mask = tensor.matrix('words_ends_mask')
-    training_representation = encoder.apply(audio, audio_mask, words_ends, words_ends_mask)
+    if config['pack_audio']:
+        audio_starts = tensor.matrix('audio_starts')
+        audio_rows = tensor.lvector('audio_rows')
+        training_representation = encoder.apply_packed(audio, audio_mask, audio_starts,
+                                                       words_ends, words_ends_mask, audio_rows)
+    else:
+        training_representation = encoder.apply(audio, audio_mask, words_ends, words_ends_mask)
     training_representation.name = "audio_representation"
 
     sampling_audio = tensor.ftensor3('sampling_audio')
-    sampling_audio_mask = tensor.ones((sampling_audio.shape[0], sampling_audio.shape[1]))
+    sampling_audio_mask = sampling_mask(config, 'sampling_audio_mask', sampling_audio)
     sampling_words_ends = tensor.lmatrix('sampling_words_ends')
-    sampling_words_ends_mask = tensor.ones((sampling_words_ends.shape[0], sampling_words_ends.shape[1]))
+    sampling_words_ends_mask = sampling_mask(config, 'sampling_words_ends_mask', sampling_words_ends)
     sampling_representation = encoder.apply(sampling_audio, sampling_audio_mask, sampling_words_ends, sampling_words_ends_mask)
 
     return encoder, training_representation, sampling_representation
 
+def create_prosodic_encoder(config):
+    encoder = ProsodicEncoder(config['prosody_feat_size'], config['enc_embed'], config['enc_nhids'])
+    encoder.weights_init = IsotropicGaussian(config['weight_scale'])
+    encoder.biases_init = Constant(0)
+    encoder.push_initialization_config()
+    encoder.bidir.prototype.weights_init = Orthogonal()
+    encoder.initialize()
+
+    prosody = tensor.ftensor3('prosody')
+    prosody_mask = tensor.matrix('prosody_mask')
+    training_representation = encoder.apply(prosody, prosody_mask)
+    training_representation.name = "prosody_representation"
+
+    sampling_prosody = tensor.ftensor3('sampling_prosody')
+    sampling_prosody_mask = sampling_mask(config, 'sampling_prosody_mask', sampling_prosody)
+    sampling_representation = encoder.apply(sampling_prosody, sampling_prosody_mask)
+
+    return encoder, training_representation, sampling_representation
+
 def create_phones_encoder(config):
     encoder = BidirectionalPhonesEncoder(config['phones_vocab_size'], config['enc_embed'], config['enc_nhids'])
     encoder.weights_init = IsotropicGaussian(config['weight_scale'])
@@ -166,19 +307,25 @@ def create_phones_encoder(config):
     training_representation.name = "phones_representation"
 
     sampling_phones = tensor.lmatrix('sampling_phones')
-    sampling_phones_mask = tensor.ones((sampling_phones.shape[0], sampling_phones.shape[1]))
+    sampling_phones_mask = sampling_mask(config, 'sampling_phones_mask', sampling_phones)
     sampling_phones_words_ends = tensor.lmatrix('sampling_phones_words_ends')
-    sampling_phones_words_ends_mask = tensor.ones((sampling_phones_words_ends.shape[0], sampling_phones_words_ends.shape[1]))
+    sampling_phones_words_ends_mask = sampling_mask(config, 'sampling_phones_words_ends_mask', sampling_phones_words_ends)
     sampling_representation = encoder.apply(sampling_phones, sampling_phones_mask, sampling_phones_words_ends, sampling_phones_words_ends_mask)
 
     return encoder, training_representation, sampling_representation
 
 def create_phones_audio_encoder(config):
-    encoder = BidirectionalPhonemeAudioEncoder(config['audio_feat_size'], config['enc_embed'], config['enc_nhids'])
+    if config['audio_encoder'] == 'segment':
+        encoder = SegmentPhonemeAudioEncoder(config['audio_feat_size'], config['enc_embed'], config['enc_nhids'])
+    else:
+        encoder = BidirectionalPhonemeAudioEncoder(config['audio_feat_size'], config['enc_embed'], config['enc_nhids'])
     encoder.weights_init = IsotropicGaussian(config['weight_scale'])
     encoder.biases_init = Constant(0)
     encoder.push_initialization_config()
-    encoder.audio_embedding.prototype.weights_init = Orthogonal()
+    if config['audio_encoder'] == 'segment':
+        encoder.segments.bidir.prototype.weights_init = Orthogonal()
+    else:
+        encoder.audio_embedding.prototype.weights_init = Orthogonal()
     encoder.phoneme_embedding.prototype.weights_init = Orthogonal()
     encoder.words_embedding.prototype.weights_init = Orthogonal()
     encoder.initialize()
@@ -193,13 +340,13 @@ def create_phones_audio_encoder(config):
     training_representation.name = "phones_representation"
 
     sampling_audio = tensor.ftensor3('sampling_audio')
-    sampling_audio_mask = tensor.ones((sampling_audio.shape[0], sampling_audio.shape[1]))
+    sampling_audio_mask = sampling_mask(config, 'sampling_audio_mask', sampling_audio)
     sampling_phones_words_acoustic_ends = tensor.lmatrix('sampling_phones_words_acoustic_ends')
-    sampling_phones_words_acoustic_ends_mask = tensor.ones((sampling_phones_words_acoustic_ends.shape[0], sampling_phones_words_acoustic_ends.shape[1]))
+    sampling_phones_words_acoustic_ends_mask = sampling_mask(config, 'sampling_phones_words_acoustic_ends_mask', sampling_phones_words_acoustic_ends)
     sampling_phones = tensor.lmatrix('sampling_phones')
-    sampling_phones_mask = tensor.ones((sampling_phones.shape[0], sampling_phones.shape[1]))
+    sampling_phones_mask = sampling_mask(config, 'sampling_phones_mask', sampling_phones)
     sampling_phones_words_ends = tensor.lmatrix('sampling_phones_words_ends')
-    sampling_phones_words_ends_mask = tensor.ones((sampling_phones_words_ends.shape[0], sampling_phones_words_ends.shape[1]))
+    sampling_phones_words_ends_mask = sampling_mask(config, 'sampling_phones_words_ends_mask', sampling_phones_words_ends)
     sampling_representation = encoder.apply(
         sampling_audio, sampling_audio_mask, sampling_phones_words_acoustic_ends,
         sampling_phones_words_acoustic_ends_mask, sampling_phones_words_ends, sampling_phones_words_ends_mask)
@@ -212,7 +359,8 @@ def create_decoder(config, training_representation, sampling_representation):
     else:
         enc_nhids = config["enc_nhids"] * 2
 
-    decoder = Decoder(config['trg_vocab_size'], config['dec_embed'], config['dec_nhids'], enc_nhids)
+    decoder = Decoder(config['trg_vocab_size'], config['dec_embed'], config['dec_nhids'], enc_nhids,
+                      causal_attention=config['streaming_lookahead'] is not None)
     decoder.weights_init = IsotropicGaussian(config['weight_scale'])
     decoder.biases_init = Constant(0)
     decoder.push_initialization_config()
@@ -221,6 +369,14 @@ def create_decoder(config, training_representation, sampling_representation):
 
     cost, samples, search_model, punctuation_marks, mask = use_decoder_on_representations(decoder, training_representation, sampling_representation)
 
+    if config['distill_posteriors'] is not None:
+        teacher_posteriors = tensor.tensor3('teacher_posteriors')
+        # Replaces `cost` so that the decoder runs only once per step
+        cost, soft_cost = decoder.distillation_costs(training_representation, mask, punctuation_marks, mask,
+                                                     teacher_posteriors)
+        cost = (1 - config['distill_weight']) * cost + config['distill_weight'] * soft_cost
+        cost.name = "distilled_cost"
+
     return decoder, cost, samples, search_model, punctuation_marks, mask
 
 def use_decoder_on_representations(decoder, training_representation, sampling_representation):
@@ -228,7 +384,8 @@ def use_decoder_on_representations(decoder, training_representation, sampling_re
     punctuation_marks_mask = tensor.matrix('punctuation_marks_mask')
     cost = decoder.cost(training_representation, punctuation_marks_mask, punctuation_marks, punctuation_marks_mask)
 
-    generated = decoder.generate(sampling_representation)
+    masks = [v for v in ComputationGraph(sampling_representation).inputs if v.name in WORD_SAMPLING_MASKS]
+    generated = decoder.generate(sampling_representation, masks[0].T if masks else None)
     search_model = Model(generated)
     _, samples = VariableFilter(bricks=[decoder.sequence_generator], name="outputs")(ComputationGraph(generated[1]))
 
@@ -0,0 +1,121 @@
+"""Examples read directly from a Kaldi data directory.
+
+Instead of building an HDF5 file with prepare_data.py, the `text` and
+`feats.scp` of a data directory and its forced phone alignment are
+featurized on the fly, one utterance at a time. The features are read by
+random access through the offsets in `feats.scp`, so only the arks of the
+utterances in `text` are touched, and they are normalized with the global
+statistics stored by prepare_data.py.
+
+"""
+import logging
+import kaldi_io
+import numpy as np
+
+from fuel.datasets import Dataset
+from fuel.streams import DataStream
+
+from lexicon import word_to_index
+from prepare_data import (get_prosodic_features, get_time_boundaries, get_utterances_from_text_file,
+                          get_word_segments, load_cmvn_stats)
+
+logger = logging.getLogger(__name__)
+
+
+class KaldiDataset(Dataset):
+    """Streams the utterances of a Kaldi data directory.
+
+    Provides the sources of the HDF5 dev set. Utterances without features
+    are skipped, words without alignment get uniformly spaced ends like in
+    prepare_data.py. With `shard` (rank, workers) only every workers-th of
+    the remaining utterances is featurized.
+
+    """
+    def __init__(self, config, data_dir, alignment_dir, prosody=False, shard=None, **kwargs):
+        self.provides_sources = ('words', 'audio', 'words_ends', 'punctuation_marks', 'phones',
+                                 'phones_words_ends', 'phones_words_acoustic_ends', 'text', 'uttids')
+        if prosody:
+            self.provides_sources += ('prosody',)
+        super(KaldiDataset, self).__init__(**kwargs)
+        self.config = config
+        self.data_dir = data_dir
+        self.alignment_dir = alignment_dir
+        self.shard = shard
+
+    def open(self):
+        config = self.config
+        alignment = "%s/forced_phone_alignment.txt" % self.alignment_dir
+        self.phones, self.phone_ends, self.words_ends, self.phones_words_ends = get_time_boundaries(
+            alignment, config['take_every_nth'])
+        self.word_segments = get_word_segments(alignment)
+        self.mean, self.std = load_cmvn_stats(config['cmvn_stats'])
+        features = kaldi_io.RandomAccessBaseFloatMatrixReader("scp:%s/feats.scp" % self.data_dir)
+        utterances = get_utterances_from_text_file("%s/text" % self.data_dir, config['punctuation_marks'])
+        self.utterances_seen = 0
+        return features, utterances
+
+    def close(self, state):
+        state[0].close()
+
+    def _in_shard(self):
+        index = self.utterances_seen
+        self.utterances_seen += 1
+        if self.shard is None:
+            return True
+        rank, workers = self.shard
+        return index % workers == rank
+
+    def get_data(self, state=None, request=None):
+        if request is not None:
+            raise ValueError("KaldiDataset only supports sequential access")
+        features, utterances = state
+        for (uttid, words, punctuation_marks) in utterances:
+            if uttid not in features:
+                logger.info("audio %s not in feats.scp" % uttid)
+                continue
+            if not self._in_shard():
+                continue
+            example = self.featurize(uttid, words, punctuation_marks, features[uttid])
+            return tuple(example[source] for source in self.sources)
+        raise StopIteration
+
+    def featurize(self, uttid, words, punctuation_marks, features):
+        """Returns the sources of one utterance as a dictionary."""
+        config = self.config
+        audio = (features[::config['take_every_nth']] - self.mean) / self.std
+        num_words = len(words)
+
+        words_ends = self.words_ends.get(uttid, [])
+        if words_ends:
+            words_ends = words_ends + [-1] * (num_words - len(words_ends))
+        else:
+            step = float(len(audio) - 1) / num_words
+            words_ends = [int(step * (i + 1)) for i in range(num_words)]
+        phones_words_ends = self.phones_words_ends.get(uttid, [])
+        phones_words_ends = phones_words_ends + [-1] * (num_words - len(phones_words_ends))
+
+        example = {
+            'words': np.array([word_to_index(word, config['src_vocab'], config['hash_buckets'])
+                               for word in words], dtype=np.int32),
+            'audio': np.asarray(audio, dtype=np.float32),
+            'words_ends': np.array(words_ends, dtype=np.int16),
+            'punctuation_marks': np.array([config['trg_vocab'][mark] for mark in punctuation_marks],
+                                          dtype=np.int8),
+            'phones': np.array([config['phones'].get(phone) for phone in self.phones.get(uttid, [])],
+                               dtype=np.int8),
+            'phones_words_ends': np.array(phones_words_ends, dtype=np.int16),
+            'phones_words_acoustic_ends': np.array(self.phone_ends.get(uttid, []), dtype=np.int16),
+            'text': u" ".join(words),
+            'uttids': unicode(uttid),
+        }
+        if 'prosody' in self.sources:
+            example['prosody'] = get_prosodic_features(
+                self.word_segments.get(uttid, []), audio, num_words,
+                config['take_every_nth'], config['prosodic_columns'])
+        return example
+
+
+def get_kaldi_stream(config, data_dir, alignment_dir, prosody=False, shard=None):
+    """Stream of the examples of a Kaldi data directory."""
+    dataset = KaldiDataset(config, data_dir, alignment_dir, prosody=prosody, shard=shard)
+    return DataStream(dataset)
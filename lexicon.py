@@ -1,3 +1,17 @@
+import errno
+import json
+import numpy
+import os
+import zlib
+
+from collections import Counter
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
 def create_dictionary_from_lexicon(path, punctuation_marks):
     words = ["<unk>", "</s>"]
     with open(path, 'r') as f:
@@ -30,3 +44,223 @@ def create_lexicon(path):
 def create_dictionary_from_punctuation_marks(punctuation_marks):
     punctuation_marks = ["<SPACE>"] + punctuation_marks + ["</s>"]
     return dict(zip(punctuation_marks, range(len(punctuation_marks))))
+
+def count_words(path, punctuation_marks):
+    """Counts words in a Kaldi text file, ignoring punctuation marks."""
+    counts = Counter()
+    with open(path, 'r') as f:
+        for line in f:
+            for word in line.strip().split()[1:]:
+                if word not in punctuation_marks:
+                    counts[word] += 1
+
+    return counts
+
+def write_shortlist(counts, size, path):
+    """Writes the `size` most frequent words as a word list."""
+    words = sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:size]
+    with open(path, 'w') as f:
+        for (word, _) in words:
+            f.write("%s\n" % word)
+
+    return [word for (word, _) in words]
+
+def word_to_index(word, vocabulary, hash_buckets=0):
+    """Maps a word to its index, hashing out of vocabulary words.
+
+    Without hash buckets unknown words map to <unk>, otherwise to one of
+    `hash_buckets` indices placed after the vocabulary.
+
+    """
+    if word in vocabulary:
+        return vocabulary[word]
+    if hash_buckets:
+        return len(vocabulary) + (zlib.crc32(_key(word)) & 0xffffffff) % hash_buckets
+    return vocabulary["<unk>"]
+
+
+def _key(word):
+    return word if isinstance(word, bytes) else word.encode('utf8')
+
+
+def _word(key):
+    return key if isinstance(key, str) else key.decode('utf8')
+
+
+class CompiledVocabulary(Mapping):
+    """Read-only word to index mapping backed by sorted numpy arrays."""
+
+    def __init__(self, words, indices):
+        self.words = words
+        self.indices = indices
+
+    def _find(self, word):
+        key = _key(word)
+        position = numpy.searchsorted(self.words, key)
+        if position < len(self.words) and self.words[position] == key:
+            return position
+        raise KeyError(word)
+
+    def __getitem__(self, word):
+        return int(self.indices[self._find(word)])
+
+    def __contains__(self, word):
+        try:
+            self._find(word)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return (_word(key) for key in self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def iteritems(self):
+        return zip(self, (int(index) for index in self.indices))
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [int(index) for index in self.indices]
+
+    @classmethod
+    def compile(cls, dictionary):
+        words = numpy.array(sorted(_key(word) for word in dictionary))
+        indices = numpy.array([dictionary[_word(word)] for word in words], dtype='int32')
+        return cls(words, indices)
+
+    def save(self, prefix):
+        _save_array(prefix + '.words.npy', self.words)
+        _save_array(prefix + '.indices.npy', self.indices)
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(numpy.load(prefix + '.words.npy', mmap_mode='r'),
+                   numpy.load(prefix + '.indices.npy', mmap_mode='r'))
+
+
+class CompiledLexicon(Mapping):
+    """Read-only pronunciation lexicon backed by sorted numpy arrays.
+
+    Pronunciations of all words are stored as phone ids in one flat array
+    indexed by `offsets`, words are looked up by binary search.
+
+    """
+    def __init__(self, words, offsets, phones, inventory):
+        self.words = words
+        self.offsets = offsets
+        self.phones = phones
+        self.inventory = [_word(phone) for phone in inventory]
+
+    def _find(self, word):
+        key = _key(word)
+        position = numpy.searchsorted(self.words, key)
+        if position < len(self.words) and self.words[position] == key:
+            return position
+        raise KeyError(word)
+
+    def __getitem__(self, word):
+        position = self._find(word)
+        phones = self.phones[self.offsets[position]:self.offsets[position + 1]]
+        return [self.inventory[phone] for phone in phones]
+
+    def __contains__(self, word):
+        try:
+            self._find(word)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return (_word(key) for key in self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def compile(cls, lexicon):
+        words = sorted(_key(word) for word in lexicon)
+        inventory = sorted(set(phone for pronunciation in lexicon.values() for phone in pronunciation))
+        phone_ids = dict(zip(inventory, range(len(inventory))))
+
+        offsets = [0]
+        phones = []
+        for word in words:
+            phones.extend(phone_ids[phone] for phone in lexicon[_word(word)])
+            offsets.append(len(phones))
+
+        return cls(numpy.array(words), numpy.array(offsets, dtype='int64'),
+                   numpy.array(phones, dtype='int16'), numpy.array([_key(p) for p in inventory]))
+
+    def save(self, prefix):
+        _save_array(prefix + '.words.npy', self.words)
+        _save_array(prefix + '.offsets.npy', self.offsets)
+        _save_array(prefix + '.phones.npy', self.phones)
+        _save_array(prefix + '.inventory.npy', numpy.array([_key(p) for p in self.inventory]))
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(numpy.load(prefix + '.words.npy', mmap_mode='r'),
+                   numpy.load(prefix + '.offsets.npy', mmap_mode='r'),
+                   numpy.load(prefix + '.phones.npy', mmap_mode='r'),
+                   numpy.load(prefix + '.inventory.npy'))
+
+
+def _replace(path, write):
+    """Writes a file under a temporary name and renames it to `path`.
+
+    Processes which mapped the old file keep reading it, and none ever
+    sees a partially written one.
+
+    """
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        write(f)
+    os.rename(temporary, path)
+
+
+def _save_array(path, array):
+    _replace(path, lambda f: numpy.save(f, array))
+
+
+def _load_compiled(cls, source_paths, prefix, build, options=None):
+    """Loads a compiled artifact, rebuilding it if its sources changed."""
+    stamp = {os.path.abspath(path): os.path.getmtime(path) for path in source_paths}
+    stamp['options'] = options
+    stamp_path = prefix + '.json'
+    if os.path.exists(stamp_path):
+        with open(stamp_path, 'r') as f:
+            if json.load(f) == stamp:
+                return cls.load(prefix)
+
+    # Worker processes may rebuild it at the same time
+    folder = os.path.dirname(prefix)
+    if folder:
+        try:
+            os.makedirs(folder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    compiled = cls.compile(build())
+    compiled.save(prefix)
+    # The stamp last, so that it never marks older arrays as current
+    _replace(stamp_path, lambda f: f.write(json.dumps(stamp).encode('utf-8')))
+    return cls.load(prefix)
+
+
+def load_compiled_dictionary(path, punctuation_marks, cache_dir):
+    """Cached version of `create_dictionary_from_lexicon`."""
+    prefix = os.path.join(cache_dir, os.path.basename(path) + '.vocab')
+    return _load_compiled(CompiledVocabulary, [path], prefix,
+                          lambda: create_dictionary_from_lexicon(path, punctuation_marks),
+                          options=list(punctuation_marks))
+
+
+def load_compiled_lexicon(path, cache_dir):
+    """Cached version of `create_lexicon`."""
+    prefix = os.path.join(cache_dir, os.path.basename(path) + '.lexicon')
+    return _load_compiled(CompiledLexicon, [path], prefix,
+                          lambda: create_lexicon(path))
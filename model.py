@@ -1,4 +1,5 @@
 
+import theano
 from theano import tensor
 from toolz import merge
 
@@ -8,11 +9,13 @@ from blocks.bricks.attention import SequenceContentAttention
 from blocks.bricks.base import application
 from blocks.bricks.lookup import LookupTable
 from blocks.bricks.parallel import Fork
-from blocks.bricks.recurrent import GatedRecurrent, Bidirectional
+from blocks.bricks.recurrent import GatedRecurrent, Bidirectional, recurrent
 from blocks.bricks.sequence_generators import (
     LookupFeedback, Readout, SoftmaxEmitter,
     SequenceGenerator)
-from blocks.roles import add_role, WEIGHT
+from blocks.filter import VariableFilter
+from blocks.graph import ComputationGraph
+from blocks.roles import add_role, OUTPUT, WEIGHT
 from blocks.utils import shared_floatx_nans
 
 from picklable_itertools.extras import equizip
@@ -43,6 +46,23 @@ class LookupFeedbackWMT15(LookupFeedback):
         return lookup
 
 
+class ResettableGatedRecurrent(GatedRecurrent):
+    """Gated recurrent network whose state is zeroed where `resets` is one.
+
+    Used on packed rows which hold several utterances one after another,
+    see `PackAudio` in stream.py.
+
+    """
+
+    @recurrent(sequences=['mask', 'inputs', 'gate_inputs', 'resets'],
+               states=['states'], outputs=['states'], contexts=[])
+    def apply(self, inputs, gate_inputs, states, mask=None, resets=None):
+        if resets is not None:
+            states = states * (1 - resets[:, None])
+        return super(ResettableGatedRecurrent, self).apply(
+            inputs=inputs, gate_inputs=gate_inputs, states=states, mask=mask, iterate=False)
+
+
 class BidirectionalWMT15(Bidirectional):
     """Wrap two Gated Recurrents each having separate parameters."""
 
@@ -53,15 +73,91 @@ class BidirectionalWMT15(Bidirectional):
         backward = [x[::-1] for x in self.children[1].apply(reverse=True, as_list=True, **backward_dict)]
         return [tensor.concatenate([f, b], axis=2) for f, b in equizip(forward, backward)]
 
+    @application
+    def apply_recomputed(self, forward_fork, backward_fork, inputs, mask, forward_resets=None, backward_resets=None):
+        """Like `apply` on the outputs of the forks, with less memory.
+
+        The forks are applied inside the scan step instead of to the whole
+        sequence. Theano's scan stores only the step outputs for the
+        backward pass and recomputes everything else in the step, so the
+        T x B x 3H projections of both directions are never kept, only the
+        inputs and the states. The price is one small matrix product per
+        step in both passes instead of a single large one.
+
+        """
+        forward = _recomputed_scan(self.children[0], forward_fork, inputs, mask, forward_resets)
+        backward = _recomputed_scan(self.children[1], backward_fork, inputs, mask, backward_resets, reverse=True)
+        return tensor.concatenate([forward, backward], axis=2)
+
+    @application
+    def apply_lookahead(self, forward_dict, backward_dict, lookahead, forward_states=None):
+        """Like `apply` with a backward network limited to `lookahead` steps.
+
+        The backward network runs separately over every step and the
+        `lookahead` steps after it, so no output depends on anything later.
+        This costs `lookahead` + 1 backward passes. `forward_states` are
+        the initial states of the forward network, to continue a sequence.
+
+        """
+        if forward_states is not None:
+            forward_dict = merge(forward_dict, {'states': forward_states})
+        forward = self.children[0].apply(**forward_dict)
+        length, batch_size = backward_dict['mask'].shape
+        windows = dict((name, _lookahead_windows(value, lookahead))
+                       for name, value in backward_dict.items())
+        backward = self.children[1].apply(reverse=True, **windows)[-1]
+        backward = backward.reshape((length, batch_size, backward.shape[-1]))
+        return tensor.concatenate([forward, backward], axis=2)
+
+
+def _recomputed_scan(recurrent, fork, inputs, mask, resets=None, reverse=False):
+    sequences = {'mask': mask}
+    if resets is not None:
+        sequences['resets'] = resets
+    names = list(sequences.keys())
+
+    def step(inputs, *args):
+        return recurrent.apply(states=args[-1], iterate=False,
+                               **merge(dict(equizip(names, args[:-1])),
+                                       fork.apply(inputs, as_dict=True)))
+
+    initial_states = recurrent.initial_states(inputs.shape[1], as_list=True)[0]
+    states, _ = theano.scan(step, sequences=[inputs] + [sequences[name] for name in names],
+                            outputs_info=[initial_states],
+                            go_backwards=reverse, name=recurrent.name + '_recomputed')
+    if reverse:
+        states = states[::-1]
+    return states
+
+
+def _lookahead_windows(sequence, lookahead):
+    """Stacks steps t, ..., t + lookahead of `sequence` for every step t.
+
+    The windows of a T x B x ... sequence are returned as a
+    (lookahead + 1) x TB x ... sequence, zero padded after the end.
+
+    """
+    rest = [sequence.shape[i] for i in range(1, sequence.ndim)]
+    padded = tensor.concatenate([sequence, tensor.zeros([lookahead] + rest, dtype=sequence.dtype)])
+    windows = tensor.stack([padded[i:i + sequence.shape[0]] for i in range(lookahead + 1)])
+    return windows.reshape([lookahead + 1, sequence.shape[0] * rest[0]] + rest[1:], ndim=sequence.ndim)
+
 
 class BidirectionalEncoder(Initializable):
-    """Encoder of RNNsearch model."""
+    """Encoder of RNNsearch model.
 
-    def __init__(self, vocab_size, embedding_dim, state_dim, **kwargs):
+    With `lookahead` the backward GRU sees only that many following words
+    (see `BidirectionalWMT15.apply_lookahead`).
+
+    """
+
+    def __init__(self, vocab_size, embedding_dim, state_dim, recompute=False, lookahead=None, **kwargs):
         super(BidirectionalEncoder, self).__init__(**kwargs)
         self.vocab_size = vocab_size
         self.embedding_dim = embedding_dim
         self.state_dim = state_dim
+        self.recompute = recompute
+        self.lookahead = lookahead
 
         self.lookup = LookupTable(name='words_embeddings')
         self.bidir = BidirectionalWMT15(
@@ -94,30 +190,72 @@ class BidirectionalEncoder(Initializable):
         words_mask = words_mask.T
 
         embeddings = self.lookup.apply(words)
-        representation = self.bidir.apply(
-            merge(self.fwd_fork.apply(embeddings, as_dict=True),
-                  {'mask': words_mask}),
-            merge(self.back_fork.apply(embeddings, as_dict=True),
-                  {'mask': words_mask})
-        )
-        return representation
+        if self.recompute and self.lookahead is None:
+            return self.bidir.apply_recomputed(self.fwd_fork, self.back_fork, embeddings, words_mask)
+
+        forward = merge(self.fwd_fork.apply(embeddings, as_dict=True), {'mask': words_mask})
+        backward = merge(self.back_fork.apply(embeddings, as_dict=True), {'mask': words_mask})
+        if self.lookahead is not None:
+            return self.bidir.apply_lookahead(forward, backward, self.lookahead)
+        return self.bidir.apply(forward, backward)
+
+    @application(inputs=['words', 'words_mask', 'forward_states'],
+                 outputs=['representation'])
+    def apply_continued(self, words, words_mask, forward_states):
+        """Representation of the words which follow a prefix.
+
+        Only for a `lookahead` encoder, in which the prefix affects later
+        words only through the last forward states, `forward_states`.
+
+        """
+        words = words.T
+        words_mask = words_mask.T
+
+        embeddings = self.lookup.apply(words)
+        forward = merge(self.fwd_fork.apply(embeddings, as_dict=True), {'mask': words_mask})
+        backward = merge(self.back_fork.apply(embeddings, as_dict=True), {'mask': words_mask})
+        return self.bidir.apply_lookahead(forward, backward, self.lookahead, forward_states)
 
 
 class BidirectionalAudioEncoder(Initializable):
+    """Hierarchical encoder of frames sampled at word ends.
 
-    def __init__(self, feature_size, embedding_dim, state_dim, **kwargs):
+    With `downsampling` k > 1 every k adjacent frames are merged before the
+    frame level GRU, either by concatenation ('pyramid') or by a learned
+    projection of the concatenation, i.e. a strided convolution ('conv'),
+    and word ends are rescaled accordingly.
+
+    With `recompute` the input projections of the frame level GRU are
+    recomputed in the backward pass (see
+    `BidirectionalWMT15.apply_recomputed`). `apply_packed` encodes batches
+    from `PackAudio`.
+
+    With `lookahead` the backward GRUs see only `frame_lookahead` following
+    (downsampled) frames and `lookahead` following words.
+
+    """
+
+    def __init__(self, feature_size, embedding_dim, state_dim, downsampling=1, downsampling_mode='pyramid',
+                 recompute=False, lookahead=None, frame_lookahead=0, **kwargs):
         super(BidirectionalAudioEncoder, self).__init__(**kwargs)
         self.feature_size = feature_size
         self.embedding_dim = embedding_dim
         self.state_dim = state_dim
-
-        self.embedding = BidirectionalWMT15(GatedRecurrent(activation=Tanh(), dim=state_dim), name="audio_embeddings")
+        self.downsampling = downsampling
+        self.downsampling_mode = downsampling_mode
+        self.recompute = recompute
+        self.lookahead = lookahead
+        self.frame_lookahead = frame_lookahead
+        if downsampling_mode not in ('pyramid', 'conv'):
+            raise ValueError("Unknown downsampling mode {}".format(downsampling_mode))
+
+        self.embedding = BidirectionalWMT15(ResettableGatedRecurrent(activation=Tanh(), dim=state_dim), name="audio_embeddings")
         self.embedding_fwd_fork = Fork(
             [name for name in self.embedding.prototype.apply.sequences
-             if name != 'mask'], prototype=Linear(), name='embedding_fwd_fork')
+             if name not in ('mask', 'resets')], prototype=Linear(), name='embedding_fwd_fork')
         self.embedding_back_fork = Fork(
             [name for name in self.embedding.prototype.apply.sequences
-             if name != 'mask'], prototype=Linear(), name='embedding_back_fork')
+             if name not in ('mask', 'resets')], prototype=Linear(), name='embedding_back_fork')
 
         self.bidir = BidirectionalWMT15(GatedRecurrent(activation=Tanh(), dim=state_dim), name="audio_representation")
         self.fwd_fork = Fork(
@@ -130,10 +268,26 @@ class BidirectionalAudioEncoder(Initializable):
         self.children = [self.bidir, self.embedding,
                          self.fwd_fork, self.back_fork, self.embedding_fwd_fork, self.embedding_back_fork]
 
+        if self.downsampling > 1 and self.downsampling_mode == 'conv':
+            self.frame_reduction = Linear(name='frame_reduction')
+            self.children.append(self.frame_reduction)
+
+    @property
+    def _frame_dim(self):
+        if self.downsampling == 1:
+            return self.feature_size
+        if self.downsampling_mode == 'conv':
+            return self.embedding_dim
+        return self.downsampling * self.feature_size
+
     def _push_allocation_config(self):
-        self.embedding_fwd_fork.input_dim = self.feature_size
+        if self.downsampling > 1 and self.downsampling_mode == 'conv':
+            self.frame_reduction.input_dim = self.downsampling * self.feature_size
+            self.frame_reduction.output_dim = self.embedding_dim
+
+        self.embedding_fwd_fork.input_dim = self._frame_dim
         self.embedding_fwd_fork.output_dims = [self.embedding.children[0].get_dim(name) for name in self.embedding_fwd_fork.output_names]
-        self.embedding_back_fork.input_dim = self.feature_size
+        self.embedding_back_fork.input_dim = self._frame_dim
         self.embedding_back_fork.output_dims = [self.embedding.children[1].get_dim(name) for name in self.embedding_back_fork.output_names]
 
         self.fwd_fork.input_dim = 2 * self.embedding_dim
@@ -142,32 +296,131 @@ class BidirectionalAudioEncoder(Initializable):
         self.back_fork.output_dims = [self.bidir.children[1].get_dim(name) for name in self.back_fork.output_names]
 
 
+    def _reduce_frame_rate(self, audio, audio_mask, words_ends=None):
+        k = self.downsampling
+        padding = (k - audio.shape[1] % k) % k
+        audio = tensor.concatenate(
+            [audio, tensor.zeros((audio.shape[0], padding, audio.shape[2]), dtype=audio.dtype)], axis=1)
+        audio = audio.reshape((audio.shape[0], audio.shape[1] // k, k * self.feature_size))
+        if self.downsampling_mode == 'conv':
+            audio = tensor.tanh(self.frame_reduction.apply(audio))
+
+        # A merged frame is valid if its first frame is
+        audio_mask = tensor.concatenate(
+            [audio_mask, tensor.zeros((audio_mask.shape[0], padding), dtype=audio_mask.dtype)], axis=1)[:, ::k]
+        if words_ends is not None:
+            words_ends = tensor.switch(words_ends < 0, words_ends, words_ends // k)
+
+        return audio, audio_mask, words_ends
+
+    def _embed_frames(self, audio, audio_mask, audio_starts=None, forward_states=None):
+        audio = audio.dimshuffle(1, 0, 2)
+        audio_mask = audio_mask.dimshuffle(1, 0)
+
+        forward_resets = backward_resets = None
+        if audio_starts is not None:
+            forward_resets = audio_starts.dimshuffle(1, 0)
+            # Going backwards an utterance starts right before the next one
+            backward_resets = tensor.concatenate(
+                [forward_resets[1:], tensor.zeros_like(forward_resets[:1])])
+
+        if self.recompute and self.lookahead is None:
+            return self.embedding.apply_recomputed(
+                self.embedding_fwd_fork, self.embedding_back_fork, audio, audio_mask,
+                forward_resets, backward_resets)
+
+        forward = merge(self.embedding_fwd_fork.apply(audio, as_dict=True), {'mask': audio_mask})
+        backward = merge(self.embedding_back_fork.apply(audio, as_dict=True), {'mask': audio_mask})
+        if self.lookahead is not None:
+            return self.embedding.apply_lookahead(forward, backward, self.frame_lookahead, forward_states)
+        if audio_starts is not None:
+            forward['resets'] = forward_resets
+            backward['resets'] = backward_resets
+        return self.embedding.apply(forward, backward)
+
     @application(inputs=['audio', 'audio_mask', 'words_ends', 'words_ends_mask'],
                  outputs=['representation'])
     def apply(self, audio, audio_mask, words_ends, words_ends_mask):
         batch_size = audio.shape[0]
-        audio = audio.dimshuffle(1, 0, 2)
-        audio_mask = audio_mask.dimshuffle(1, 0)
+        if self.downsampling > 1:
+            audio, audio_mask, words_ends = self._reduce_frame_rate(audio, audio_mask, words_ends)
 
-        embeddings = self.embedding.apply(
-            merge(self.embedding_fwd_fork.apply(audio, as_dict=True),
-                  {'mask': audio_mask}),
-            merge(self.embedding_back_fork.apply(audio, as_dict=True),
-                  {'mask': audio_mask})
-        )
+        embeddings = self._embed_frames(audio, audio_mask)
+        rows = tensor.arange(batch_size)
+        return self._represent_words(embeddings, rows, words_ends, words_ends_mask)
 
-        rows = tensor.arange(batch_size).reshape((batch_size, 1))
-        embeddings = embeddings.dimshuffle(1, 0, 2)[rows, words_ends].dimshuffle(1, 0, 2)
+    @application(inputs=['audio', 'audio_mask', 'audio_starts', 'words_ends', 'words_ends_mask', 'audio_rows'],
+                 outputs=['representation'])
+    def apply_packed(self, audio, audio_mask, audio_starts, words_ends, words_ends_mask, audio_rows):
+        """Encodes rows which hold several utterances.
 
-        words_ends_mask = words_ends_mask.dimshuffle(1, 0)
-        representation = self.bidir.apply(
-            merge(self.fwd_fork.apply(embeddings, as_dict=True),
-                  {'mask': words_ends_mask}),
-            merge(self.back_fork.apply(embeddings, as_dict=True),
-                  {'mask': words_ends_mask})
-        )
+        The frame level GRUs are reset at every utterance start in
+        `audio_starts`, `words_ends` point into the packed rows and
+        `audio_rows` gives the row of each utterance. Sampling at the word
+        ends unpacks the utterances again, so the representation has the
+        layout of `apply`.
 
-        return representation
+        """
+        if self.downsampling > 1:
+            audio, audio_mask, words_ends = self._reduce_frame_rate(audio, audio_mask, words_ends)
+            audio_starts = audio_starts[:, ::self.downsampling]
+
+        embeddings = self._embed_frames(audio, audio_mask, audio_starts)
+        return self._represent_words(embeddings, audio_rows, words_ends, words_ends_mask)
+
+    @application(inputs=['audio', 'audio_mask', 'words_ends', 'words_ends_mask'],
+                 outputs=['representation'])
+    def apply_shared(self, audio, audio_mask, words_ends, words_ends_mask):
+        """Encodes several word sequences of one utterance.
+
+        `audio` holds a single utterance and every row of `words_ends` the
+        words of one transcription of it, e.g. the N-best hypotheses of a
+        recognizer. The frame level GRUs run once for all of them.
+
+        """
+        if self.downsampling > 1:
+            audio, audio_mask, words_ends = self._reduce_frame_rate(audio, audio_mask, words_ends)
+
+        embeddings = self._embed_frames(audio, audio_mask)
+        rows = tensor.zeros((words_ends.shape[0],), dtype='int64')
+        return self._represent_words(embeddings, rows, words_ends, words_ends_mask)
+
+    def _represent_words(self, embeddings, rows, words_ends, words_ends_mask):
+        embeddings = embeddings.dimshuffle(1, 0, 2)[rows[:, None], words_ends].dimshuffle(1, 0, 2)
+        return self._encode_words(embeddings, words_ends_mask.dimshuffle(1, 0))
+
+    def _encode_words(self, embeddings, mask, forward_states=None):
+        forward = merge(self.fwd_fork.apply(embeddings, as_dict=True), {'mask': mask})
+        backward = merge(self.back_fork.apply(embeddings, as_dict=True), {'mask': mask})
+        if self.lookahead is not None:
+            return self.bidir.apply_lookahead(forward, backward, self.lookahead, forward_states)
+        return self.bidir.apply(forward, backward)
+
+    @application(inputs=['audio', 'audio_mask', 'forward_states'],
+                 outputs=['embeddings'])
+    def embed_frames_continued(self, audio, audio_mask, forward_states):
+        """Time major frame embeddings of the frames which follow a prefix.
+
+        Only for a `lookahead` encoder, `forward_states` are the last
+        forward states of the frame level GRU on the prefix, which has to
+        end at a multiple of `downsampling` frames.
+
+        """
+        if self.downsampling > 1:
+            audio, audio_mask, _ = self._reduce_frame_rate(audio, audio_mask)
+        return self._embed_frames(audio, audio_mask, forward_states=forward_states)
+
+    @application(inputs=['embeddings', 'embeddings_mask', 'forward_states'],
+                 outputs=['representation'])
+    def represent_words_continued(self, embeddings, embeddings_mask, forward_states):
+        """Representation of the words which follow a prefix.
+
+        Takes the time major frame embeddings at the ends of the words, see
+        `embed_frames_continued`, and the last forward states of the word
+        level GRU on the prefix.
+
+        """
+        return self._encode_words(embeddings, embeddings_mask, forward_states)
 
 
 class BidirectionalPhonesEncoder(Initializable):
@@ -332,6 +585,249 @@ class BidirectionalPhonemeAudioEncoder(Initializable):
         return representation
 
 
+class ProsodicEncoder(Initializable):
+    """Encoder of precomputed prosodic word features.
+
+    Consumes one feature vector per word (see `get_prosodic_features` in
+    prepare_data.py), so there is no frame level recurrence at all.
+
+    """
+
+    def __init__(self, feature_size, embedding_dim, state_dim, **kwargs):
+        super(ProsodicEncoder, self).__init__(**kwargs)
+        self.feature_size = feature_size
+        self.embedding_dim = embedding_dim
+        self.state_dim = state_dim
+
+        self.embedding = Linear(name='prosody_embeddings')
+        self.bidir = BidirectionalWMT15(GatedRecurrent(activation=Tanh(), dim=state_dim), name="prosody_representation")
+        self.fwd_fork = Fork(
+            [name for name in self.bidir.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='fwd_fork')
+        self.back_fork = Fork(
+            [name for name in self.bidir.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='back_fork')
+
+        self.children = [self.embedding, self.bidir, self.fwd_fork, self.back_fork]
+
+    def _push_allocation_config(self):
+        self.embedding.input_dim = self.feature_size
+        self.embedding.output_dim = self.embedding_dim
+
+        self.fwd_fork.input_dim = self.embedding_dim
+        self.fwd_fork.output_dims = [self.bidir.children[0].get_dim(name) for name in self.fwd_fork.output_names]
+        self.back_fork.input_dim = self.embedding_dim
+        self.back_fork.output_dims = [self.bidir.children[1].get_dim(name) for name in self.back_fork.output_names]
+
+    @application(inputs=['prosody', 'prosody_mask'],
+                 outputs=['representation'])
+    def apply(self, prosody, prosody_mask):
+        prosody = prosody.dimshuffle(1, 0, 2)
+        prosody_mask = prosody_mask.dimshuffle(1, 0)
+
+        embeddings = tensor.tanh(self.embedding.apply(prosody))
+        representation = self.bidir.apply(
+            merge(self.fwd_fork.apply(embeddings, as_dict=True),
+                  {'mask': prosody_mask}),
+            merge(self.back_fork.apply(embeddings, as_dict=True),
+                  {'mask': prosody_mask})
+        )
+
+        return representation
+
+
+class SegmentEncoder(Initializable):
+    """Encodes frame segments of all utterances in parallel.
+
+    Segment i of an utterance spans the frames after the end of segment
+    i - 1 up to `ends[i]` (negative ends mean the last frame). All segments
+    of the batch are gathered into one padded batch and encoded by a short
+    bidirectional GRU, so the number of sequential steps is the length of
+    the longest segment instead of the longest utterance. The embedding of
+    a segment is the final forward and backward state.
+
+    """
+
+    def __init__(self, feature_size, state_dim, **kwargs):
+        super(SegmentEncoder, self).__init__(**kwargs)
+        self.feature_size = feature_size
+        self.state_dim = state_dim
+
+        self.bidir = BidirectionalWMT15(GatedRecurrent(activation=Tanh(), dim=state_dim), name="segment_embeddings")
+        self.fwd_fork = Fork(
+            [name for name in self.bidir.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='segment_fwd_fork')
+        self.back_fork = Fork(
+            [name for name in self.bidir.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='segment_back_fork')
+
+        self.children = [self.bidir, self.fwd_fork, self.back_fork]
+
+    def _push_allocation_config(self):
+        self.fwd_fork.input_dim = self.feature_size
+        self.fwd_fork.output_dims = [self.bidir.children[0].get_dim(name) for name in self.fwd_fork.output_names]
+        self.back_fork.input_dim = self.feature_size
+        self.back_fork.output_dims = [self.bidir.children[1].get_dim(name) for name in self.back_fork.output_names]
+
+    @application(inputs=['frames', 'frames_mask', 'ends', 'ends_mask'],
+                 outputs=['embeddings'])
+    def apply(self, frames, frames_mask, ends, ends_mask):
+        batch_size = frames.shape[0]
+        num_segments = ends.shape[1]
+
+        last_frame = tensor.cast(frames_mask.sum(axis=1), 'int64') - 1
+        ends = tensor.switch(ends < 0, last_frame[:, None], ends)
+        starts = tensor.concatenate([tensor.zeros((batch_size, 1), dtype='int64'), ends[:, :-1] + 1], axis=1)
+        starts = tensor.minimum(starts, ends)
+        lengths = tensor.switch(ends_mask, ends - starts + 1, 1)
+
+        offsets = tensor.arange(lengths.max())
+        positions = tensor.minimum(starts[:, :, None] + offsets[None, None, :], ends[:, :, None])
+        rows = tensor.arange(batch_size).reshape((batch_size, 1, 1))
+        segments = frames[rows, positions]
+        segments = segments.reshape((batch_size * num_segments, offsets.shape[0], frames.shape[2])).dimshuffle(1, 0, 2)
+        segments_mask = tensor.cast(offsets[None, None, :] < lengths[:, :, None], frames_mask.dtype)
+        segments_mask = segments_mask.reshape((batch_size * num_segments, offsets.shape[0])).T
+
+        states = self.bidir.apply(
+            merge(self.fwd_fork.apply(segments, as_dict=True),
+                  {'mask': segments_mask}),
+            merge(self.back_fork.apply(segments, as_dict=True),
+                  {'mask': segments_mask})
+        )
+
+        last = tensor.cast(lengths.flatten() - 1, 'int64')
+        forward = states[last, tensor.arange(batch_size * num_segments)][:, :self.state_dim]
+        backward = states[0][:, self.state_dim:]
+        embeddings = tensor.concatenate([forward, backward], axis=1)
+
+        return embeddings.reshape((batch_size, num_segments, 2 * self.state_dim)).dimshuffle(1, 0, 2)
+
+
+class SegmentAudioEncoder(Initializable):
+    """Audio encoder which embeds word segments in parallel.
+
+    Drop-in alternative of `BidirectionalAudioEncoder`: frames are cut at
+    `words_ends` and encoded by a `SegmentEncoder` instead of a GRU over
+    the whole utterance.
+
+    """
+
+    def __init__(self, feature_size, embedding_dim, state_dim, **kwargs):
+        super(SegmentAudioEncoder, self).__init__(**kwargs)
+        self.feature_size = feature_size
+        self.embedding_dim = embedding_dim
+        self.state_dim = state_dim
+
+        self.segments = SegmentEncoder(feature_size, state_dim, name="audio_segments")
+
+        self.bidir = BidirectionalWMT15(GatedRecurrent(activation=Tanh(), dim=state_dim), name="audio_representation")
+        self.fwd_fork = Fork(
+            [name for name in self.bidir.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='fwd_fork')
+        self.back_fork = Fork(
+            [name for name in self.bidir.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='back_fork')
+
+        self.children = [self.segments, self.bidir, self.fwd_fork, self.back_fork]
+
+    def _push_allocation_config(self):
+        self.fwd_fork.input_dim = 2 * self.state_dim
+        self.fwd_fork.output_dims = [self.bidir.children[0].get_dim(name) for name in self.fwd_fork.output_names]
+        self.back_fork.input_dim = 2 * self.state_dim
+        self.back_fork.output_dims = [self.bidir.children[1].get_dim(name) for name in self.back_fork.output_names]
+
+    @application(inputs=['audio', 'audio_mask', 'words_ends', 'words_ends_mask'],
+                 outputs=['representation'])
+    def apply(self, audio, audio_mask, words_ends, words_ends_mask):
+        embeddings = self.segments.apply(audio, audio_mask, words_ends, words_ends_mask)
+
+        words_ends_mask = words_ends_mask.dimshuffle(1, 0)
+        representation = self.bidir.apply(
+            merge(self.fwd_fork.apply(embeddings, as_dict=True),
+                  {'mask': words_ends_mask}),
+            merge(self.back_fork.apply(embeddings, as_dict=True),
+                  {'mask': words_ends_mask})
+        )
+
+        return representation
+
+
+class SegmentPhonemeAudioEncoder(Initializable):
+    """Phone level counterpart of `SegmentAudioEncoder`.
+
+    Drop-in alternative of `BidirectionalPhonemeAudioEncoder`: frames are
+    cut at phone ends and encoded in parallel, the phone and word level
+    GRUs are the same.
+
+    """
+
+    def __init__(self, feature_size, embedding_dim, state_dim, **kwargs):
+        super(SegmentPhonemeAudioEncoder, self).__init__(**kwargs)
+        self.feature_size = feature_size
+        self.embedding_dim = embedding_dim
+        self.state_dim = state_dim
+
+        self.segments = SegmentEncoder(feature_size, state_dim, name="audio_segments")
+
+        self.phoneme_embedding = BidirectionalWMT15(GatedRecurrent(activation=Tanh(), dim=state_dim), name="phoneme_embeddings")
+        self.phoneme_fwd_fork = Fork(
+            [name for name in self.phoneme_embedding.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='phoneme_fwd_fork')
+        self.phoneme_back_fork = Fork(
+            [name for name in self.phoneme_embedding.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='phoneme_back_fork')
+
+        self.words_embedding = BidirectionalWMT15(GatedRecurrent(activation=Tanh(), dim=state_dim), name="words_embeddings")
+        self.words_fwd_fork = Fork(
+            [name for name in self.words_embedding.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='words_fwd_fork')
+        self.words_back_fork = Fork(
+            [name for name in self.words_embedding.prototype.apply.sequences
+             if name != 'mask'], prototype=Linear(), name='words_back_fork')
+
+        self.children = [self.segments, self.phoneme_embedding, self.words_embedding,
+                         self.phoneme_fwd_fork, self.phoneme_back_fork, self.words_fwd_fork, self.words_back_fork]
+
+    def _push_allocation_config(self):
+        self.phoneme_fwd_fork.input_dim = 2 * self.state_dim
+        self.phoneme_fwd_fork.output_dims = [self.phoneme_embedding.children[0].get_dim(name) for name in self.phoneme_fwd_fork.output_names]
+        self.phoneme_back_fork.input_dim = 2 * self.state_dim
+        self.phoneme_back_fork.output_dims = [self.phoneme_embedding.children[1].get_dim(name) for name in self.phoneme_back_fork.output_names]
+
+        self.words_fwd_fork.input_dim = 2 * self.state_dim
+        self.words_fwd_fork.output_dims = [self.words_embedding.children[0].get_dim(name) for name in self.words_fwd_fork.output_names]
+        self.words_back_fork.input_dim = 2 * self.state_dim
+        self.words_back_fork.output_dims = [self.words_embedding.children[1].get_dim(name) for name in self.words_back_fork.output_names]
+
+    @application(inputs=['audio', 'audio_mask', 'phones_words_acoustic_ends', 'phones_words_acoustic_ends_mask', 'phoneme_words_ends', 'phoneme_words_ends_mask'],
+                 outputs=['representation'])
+    def apply(self, audio, audio_mask, phones_words_acoustic_ends, phones_words_acoustic_ends_mask, phoneme_words_ends, phoneme_words_ends_mask):
+        batch_size = audio.shape[0]
+        phoneme_embeddings = self.segments.apply(audio, audio_mask, phones_words_acoustic_ends, phones_words_acoustic_ends_mask)
+
+        phones_words_acoustic_ends_mask = phones_words_acoustic_ends_mask.dimshuffle(1, 0)
+        words_embeddings = self.phoneme_embedding.apply(
+            merge(self.phoneme_fwd_fork.apply(phoneme_embeddings, as_dict=True),
+                  {'mask': phones_words_acoustic_ends_mask}),
+            merge(self.phoneme_back_fork.apply(phoneme_embeddings, as_dict=True),
+                  {'mask': phones_words_acoustic_ends_mask})
+        )
+
+        rows = tensor.arange(batch_size).reshape((batch_size, 1))
+        words_embeddings = words_embeddings.dimshuffle(1, 0, 2)[rows, phoneme_words_ends].dimshuffle(1, 0, 2)
+
+        phoneme_words_ends_mask = phoneme_words_ends_mask.dimshuffle(1, 0)
+        representation = self.words_embedding.apply(
+            merge(self.words_fwd_fork.apply(words_embeddings, as_dict=True),
+                  {'mask': phoneme_words_ends_mask}),
+            merge(self.words_back_fork.apply(words_embeddings, as_dict=True),
+                  {'mask': phoneme_words_ends_mask})
+        )
+
+        return representation
+
+
 class GRUInitialState(GatedRecurrent):
     """Gated Recurrent with special initial state.
 
@@ -365,11 +861,52 @@ class GRUInitialState(GatedRecurrent):
                 add_role(self.parameters[i], WEIGHT)
 
 
+class CausalContentAttention(SequenceContentAttention):
+    """Content attention which sees only the words up to the current mark.
+
+    The decoder emits one mark per word, so the glimpse of output step i
+    is restricted to the first i + 1 words. The step is carried along as
+    the extra glimpse 'positions'.
+
+    """
+
+    @application(outputs=['weighted_averages', 'weights', 'positions'])
+    def take_glimpses(self, attended, preprocessed_attended=None,
+                      attended_mask=None, previous_positions=None, **states):
+        window = tensor.le(tensor.arange(attended.shape[0])[:, None], previous_positions[None, :])
+        window = tensor.cast(window, theano.config.floatX)
+        if attended_mask is not None:
+            window = window * attended_mask
+        energies = self.compute_energies(attended, preprocessed_attended, states)
+        weights = self.compute_weights(energies, window)
+        weighted_averages = self.compute_weighted_averages(weights, attended)
+        return weighted_averages, weights.T, previous_positions + 1
+
+    @take_glimpses.property('inputs')
+    def take_glimpses_inputs(self):
+        return (['attended', 'preprocessed_attended', 'attended_mask', 'previous_positions'] +
+                self.state_names)
+
+    @application
+    def initial_glimpses(self, batch_size, attended):
+        return (super(CausalContentAttention, self).initial_glimpses(batch_size, attended) +
+                [tensor.zeros((batch_size,))])
+
+    def get_dim(self, name):
+        if name == 'positions':
+            return 0
+        return super(CausalContentAttention, self).get_dim(name)
+
+
 class Decoder(Initializable):
-    """Decoder of RNNsearch model."""
+    """Decoder of RNNsearch model.
+
+    With `causal_attention` the attention uses `CausalContentAttention`.
+
+    """
 
     def __init__(self, vocab_size, embedding_dim, state_dim,
-                 representation_dim, theano_seed=None, **kwargs):
+                 representation_dim, theano_seed=None, causal_attention=False, **kwargs):
         super(Decoder, self).__init__(**kwargs)
         self.vocab_size = vocab_size
         self.embedding_dim = embedding_dim
@@ -383,7 +920,8 @@ class Decoder(Initializable):
             activation=Tanh(), name='decoder')
 
         # Initialize the attention mechanism
-        self.attention = SequenceContentAttention(
+        attention_class = CausalContentAttention if causal_attention else SequenceContentAttention
+        self.attention = attention_class(
             state_names=self.transition.apply.states,
             attended_dim=representation_dim,
             match_dim=state_dim, name="attention")
@@ -420,7 +958,16 @@ class Decoder(Initializable):
                  outputs=['cost'])
     def cost(self, representation, source_sentence_mask,
              target_sentence, target_sentence_mask):
+        cost = self.cost_matrix(representation, source_sentence_mask,
+                                target_sentence, target_sentence_mask)
+        return cost.sum() / target_sentence_mask.shape[0]
 
+    @application(inputs=['representation', 'source_sentence_mask',
+                         'target_sentence_mask', 'target_sentence'],
+                 outputs=['cost_matrix'])
+    def cost_matrix(self, representation, source_sentence_mask,
+                    target_sentence, target_sentence_mask):
+        """Negative log-probability of every target symbol, (batch, time)."""
         source_sentence_mask = source_sentence_mask.T
         target_sentence = target_sentence.T
         target_sentence_mask = target_sentence_mask.T
@@ -433,17 +980,65 @@ class Decoder(Initializable):
             'attended_mask': source_sentence_mask}
         )
 
-        return (cost * target_sentence_mask).sum() / \
-            target_sentence_mask.shape[1]
+        return (cost * target_sentence_mask).T
+
+    def _log_posteriors(self, representation, source_sentence_mask,
+                        target_sentence, target_sentence_mask):
+        # The readouts of the teacher forced targets, (time, batch, vocab)
+        cost = self.cost_matrix(representation, source_sentence_mask,
+                                target_sentence, target_sentence_mask)
+        readouts, = VariableFilter(
+            applications=[self.sequence_generator.readout.readout],
+            roles=[OUTPUT])(ComputationGraph(cost).variables)
+        readouts = readouts - readouts.max(axis=2, keepdims=True)
+        return readouts - tensor.log(tensor.exp(readouts).sum(axis=2, keepdims=True))
+
+    @application(inputs=['representation', 'source_sentence_mask',
+                         'target_sentence_mask', 'target_sentence'],
+                 outputs=['posteriors'])
+    def posteriors(self, representation, source_sentence_mask,
+                   target_sentence, target_sentence_mask):
+        """Distribution over every target symbol given the previous ones.
+
+        Returns a (batch, time, vocab) tensor.
+
+        """
+        return tensor.exp(self._log_posteriors(
+            representation, source_sentence_mask,
+            target_sentence, target_sentence_mask)).dimshuffle(1, 0, 2)
+
+    @application(inputs=['representation', 'source_sentence_mask',
+                         'target_sentence_mask', 'target_sentence',
+                         'soft_targets'],
+                 outputs=['cost', 'soft_cost'])
+    def distillation_costs(self, representation, source_sentence_mask,
+                           target_sentence, target_sentence_mask, soft_targets):
+        """`cost` and the cross entropy with the (batch, time, vocab) `soft_targets`.
+
+        Both are computed from the same run of the decoder fed the
+        `target_sentence`.
+
+        """
+        log_posteriors = self._log_posteriors(
+            representation, source_sentence_mask,
+            target_sentence, target_sentence_mask)
+        targets = target_sentence.T
+        flat = log_posteriors.reshape((-1, log_posteriors.shape[2]))
+        cost = -flat[tensor.arange(flat.shape[0]), targets.flatten()].reshape(targets.shape)
+        soft_cost = -(soft_targets.dimshuffle(1, 0, 2) * log_posteriors).sum(axis=2)
+        return [(c * target_sentence_mask.T).sum() / target_sentence_mask.shape[0]
+                for c in (cost, soft_cost)]
 
     @application
-    def generate(self, representation, **kwargs):
+    def generate(self, representation, representation_mask=None, **kwargs):
         length = representation.shape[0]
         batch_size = representation.shape[1]
+        if representation_mask is None:
+            representation_mask = tensor.ones((batch_size, length)).T
 
         return self.sequence_generator.generate(
             n_steps=2 * length,
             batch_size=batch_size,
             attended=representation,
-            attended_mask=tensor.ones((batch_size, length)).T,
+            attended_mask=representation_mask,
             **kwargs)
@@ -0,0 +1,54 @@
+"""Punctuation of the N-best hypotheses of a recognizer.
+
+All hypotheses of an utterance share its audio, so the frame level audio
+encoder runs once per utterance and only the word level encoders and the
+decoder run over the hypotheses, batched together:
+
+    punctuator = NBestPunctuator(get_config(), model_dir, model_filename)
+    results = punctuator.punctuate_nbest(audio, [{'words': [...], 'words_ends': [...]}, ...])
+
+Every result is the dictionary returned by `server.Punctuator`.
+
+"""
+from checkpoint import LoadNMT
+from helpers import create_model, create_shared_audio_search
+from search import BatchBeamSearch, pad_examples
+from server import Punctuator
+
+# Sources of the utterance rather than of a hypothesis
+SHARED_SOURCES = ('audio',)
+
+
+class NBestPunctuator(Punctuator):
+    """Decodes several transcriptions of one utterance in a batch."""
+
+    def __init__(self, config, model_dir, model_filename):
+        config['masked_sampling'] = True
+        self.config = config
+        _, _, search_model = create_model(config)
+        samples, shared_model = create_shared_audio_search(config, search_model)
+        loader = LoadNMT(model_dir, model_filename)
+        loader.set_model_parameters(search_model, loader.load_parameters(), borrow=True)
+        self.inputs = shared_model.inputs
+        self.sources = sorted(set(v.name[len('sampling_'):] for v in self.inputs
+                                  if not v.name.endswith('_mask')))
+        self.beam_search = BatchBeamSearch(samples=samples)
+        self.beam_search.compile()
+        self.trg_ivocab = {v: k for k, v in config["trg_vocab"].items()}
+
+    def punctuate(self, batch):
+        """Like `Punctuator.punctuate` for examples which all have the same audio."""
+        beam_size = self.config['beam_size']
+        padded = pad_examples([example for _, example in batch],
+                              [source for source in self.sources if source not in SHARED_SOURCES], beam_size)
+        padded.update(pad_examples([batch[0][1]], SHARED_SOURCES))
+        return self._search(batch, padded)
+
+    def punctuate_nbest(self, audio, hypotheses):
+        """Punctuates every hypothesis (a request without 'audio') of `audio`."""
+        batch = []
+        for hypothesis in hypotheses:
+            request = dict(hypothesis)
+            request['audio'] = audio
+            batch.append(self.featurize(request))
+        return self.punctuate(batch)
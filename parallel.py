@@ -0,0 +1,206 @@
+"""Synchronous data-parallel training in several processes on one host.
+
+Every worker trains a copy of the model on its own shard of the training
+data. After each batch the gradients of all workers are averaged through
+shared memory and every worker applies the same step rule to the average,
+so the copies stay identical without ever exchanging parameters. Only rank
+0 monitors, checkpoints and validates; when it stops, the others stop too.
+
+"""
+import logging
+import multiprocessing
+import numpy
+import os
+import theano
+
+from collections import OrderedDict
+from theano import tensor
+
+from blocks.algorithms import GradientDescent, UpdatesAlgorithm
+from blocks.graph import ComputationGraph
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerStopped(Exception):
+    """Raised in the workers waiting for a worker which has stopped."""
+    pass
+
+
+class Barrier(object):
+    """Reusable barrier for processes, Python 2 has none in multiprocessing.
+
+    `abort` wakes up all waiting processes with `WorkerStopped` and makes
+    every later `wait` raise it as well.
+
+    """
+    def __init__(self, parties):
+        self.parties = parties
+        self._condition = multiprocessing.Condition()
+        self._count = multiprocessing.RawValue('i', 0)
+        self._generation = multiprocessing.RawValue('i', 0)
+        self._aborted = multiprocessing.RawValue('i', 0)
+
+    def wait(self):
+        with self._condition:
+            if self._aborted.value:
+                raise WorkerStopped()
+            generation = self._generation.value
+            self._count.value += 1
+            if self._count.value == self.parties:
+                self._count.value = 0
+                self._generation.value += 1
+                self._condition.notify_all()
+                return
+            while self._generation.value == generation and not self._aborted.value:
+                self._condition.wait()
+            if self._generation.value == generation:
+                raise WorkerStopped()
+
+    def abort(self):
+        with self._condition:
+            self._aborted.value = 1
+            self._condition.notify_all()
+
+
+class SharedMemoryReducer(object):
+    """Averages the gradients of all workers in shared memory.
+
+    Each worker copies its flattened gradients into its own slot, then
+    averages one contiguous chunk over all slots (a reduce-scatter) and
+    finally reads the whole average, so every value is summed exactly once
+    and all workers see the same result.
+
+    """
+    def __init__(self, workers, size, dtype=None):
+        self.workers = workers
+        self.size = size
+        self.dtype = numpy.dtype(dtype or theano.config.floatX)
+        typecode = {'float32': 'f', 'float64': 'd'}[self.dtype.name]
+        self._slots = multiprocessing.RawArray(typecode, workers * size)
+        self._average = multiprocessing.RawArray(typecode, size)
+        self.barrier = Barrier(workers)
+        self.rank = None
+
+    def attach(self, rank):
+        """Binds the reducer to the worker it is used in."""
+        self.rank = rank
+        self.slots = numpy.frombuffer(self._slots, dtype=self.dtype).reshape((self.workers, self.size))
+        self.average = numpy.frombuffer(self._average, dtype=self.dtype)
+
+    def _unflatten(self, like):
+        values = []
+        offset = 0
+        for value in like:
+            values.append(self.average[offset:offset + value.size].reshape(value.shape))
+            offset += value.size
+        return values
+
+    def all_reduce(self, gradients):
+        """Returns the averages of `gradients` over all workers."""
+        offset = 0
+        for gradient in gradients:
+            self.slots[self.rank, offset:offset + gradient.size] = gradient.ravel()
+            offset += gradient.size
+        self.barrier.wait()
+
+        start = self.rank * self.size // self.workers
+        end = (self.rank + 1) * self.size // self.workers
+        numpy.mean(self.slots[:, start:end], axis=0, out=self.average[start:end])
+        self.barrier.wait()
+        return self._unflatten(gradients)
+
+    def broadcast(self, values):
+        """Returns the `values` of rank 0 in all workers."""
+        if self.rank == 0:
+            offset = 0
+            for value in values:
+                self.average[offset:offset + value.size] = value.ravel()
+                offset += value.size
+        self.barrier.wait()
+        values = [value.copy() for value in self._unflatten(values)]
+        self.barrier.wait()
+        return values
+
+
+class DataParallelGradientDescent(UpdatesAlgorithm):
+    """Gradient descent with gradients averaged over all workers.
+
+    The gradients of the cost are computed by one function, averaged by the
+    `reducer` and passed to a `GradientDescent` whose gradients are
+    placeholders, so the step rule (clipping, AdaDelta, ...) sees only the
+    average. Updates added by extensions, e.g. for monitoring, are computed
+    together with the gradients.
+
+    """
+    def __init__(self, cost, parameters, step_rule, reducer, **kwargs):
+        super(DataParallelGradientDescent, self).__init__(**kwargs)
+        self.cost = cost
+        self.parameters = parameters
+        self.reducer = reducer
+        self.gradients = tensor.grad(cost, parameters)
+        self.average_gradients = OrderedDict(
+            (parameter, parameter.type('average_gradient_{}'.format(i)))
+            for i, parameter in enumerate(parameters))
+        self.step = GradientDescent(gradients=self.average_gradients, step_rule=step_rule,
+                                    on_unused_sources='ignore')
+
+    def initialize(self):
+        logger.info("Initializing the data parallel algorithm of worker {}".format(self.reducer.rank))
+        # All workers start from the parameters of rank 0, which may be reloaded
+        values = self.reducer.broadcast([p.get_value() for p in self.parameters])
+        for parameter, value in zip(self.parameters, values):
+            parameter.set_value(value)
+
+        self.inputs = ComputationGraph(self.cost).inputs
+        self._function = theano.function(self.inputs, self.gradients, updates=self.updates,
+                                         on_unused_input='ignore')
+        self.step.initialize()
+
+    def process_batch(self, batch):
+        self._validate_source_names(batch)
+        gradients = self._function(*[batch[v.name] for v in self.inputs])
+        averages = self.reducer.all_reduce(gradients)
+        self.step.process_batch(OrderedDict(
+            (placeholder.name, average)
+            for placeholder, average in zip(self.average_gradients.values(), averages)))
+
+
+def parameter_count(parameters):
+    return sum(parameter.get_value().size for parameter in parameters)
+
+
+def check_thread_count():
+    """Warns that processes may oversubscribe the cores without OMP_NUM_THREADS."""
+    if 'OMP_NUM_THREADS' not in os.environ:
+        logger.info("OMP_NUM_THREADS is not set, the workers may oversubscribe the cores")
+
+
+def _run_worker(rank, reducer, target, args):
+    reducer.attach(rank)
+    try:
+        target(rank, reducer, *args)
+    except WorkerStopped:
+        logger.info("Worker {} stopped with the others".format(rank))
+    finally:
+        reducer.barrier.abort()
+
+
+def run_workers(workers, size, target, *args):
+    """Runs `target(rank, reducer, *args)` in `workers` processes.
+
+    `size` is the number of parameters to reduce. Raises if any worker
+    fails.
+
+    """
+    check_thread_count()
+    reducer = SharedMemoryReducer(workers, size)
+    processes = [multiprocessing.Process(target=_run_worker, args=(rank, reducer, target, args))
+                 for rank in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError("Workers {} failed".format(failed))
@@ -5,7 +5,7 @@ import numpy as np
 from collections import defaultdict
 from config import get_config
 from fuel.datasets.hdf5 import H5PYDataset
-from lexicon import create_dictionary_from_lexicon, create_dictionary_from_punctuation_marks
+from lexicon import create_dictionary_from_lexicon, create_dictionary_from_punctuation_marks, word_to_index
 
 def get_uttids_from_text_file(path):
     uttids = set()
@@ -67,6 +67,14 @@ def get_mean_std_from_audio_features(path):
 
     return mean, std
 
+def save_cmvn_stats(path, mean, std):
+    """Stores the global feature statistics for normalizing new data."""
+    np.savez(path, mean=mean, std=std)
+
+def load_cmvn_stats(path):
+    stats = np.load(path)
+    return stats['mean'], stats['std']
+
 def get_audio_features_from_file(path, take_every_nth, mean, std):
     for (uttid, features) in kaldi_io.SequentialBaseFloatMatrixReader(path):
         features = features[::take_every_nth]
@@ -106,6 +114,65 @@ def get_time_boundaries(path, take_every_nth):
 
     return phones, phone_time_boundaries, words_time_boundaries, phoneme_words_boundaries
 
+def get_word_segments(path):
+    """Reads start and end times (in seconds) of words from the alignment."""
+    segments = defaultdict(lambda: [])
+
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                (uttid, _, start, duration, phone) = line.strip().split()
+                raw_phone = phone.strip("_SIEB")
+
+                if raw_phone == "sil" or raw_phone == "spn":
+                    continue
+
+                start = float(start)
+                end = start + float(duration)
+                if phone.endswith("_B") or phone.endswith("_S") or not segments[uttid]:
+                    segments[uttid].append([start, end])
+                else:
+                    segments[uttid][-1][1] = end
+            except ValueError, e:
+                pass
+
+    return segments
+
+def get_prosodic_features(segments, features, num_words, take_every_nth, columns=None):
+    """Computes a prosodic feature vector for every word.
+
+    The vector holds the word duration, the pauses before and after the
+    word and the mean and standard deviation of the selected feature
+    columns over the frames of the word. The last row belongs to </s> and
+    holds only the pause after the last word. Words without alignment get
+    zero vectors.
+
+    """
+    if columns is not None:
+        features = features[:, columns]
+    frame_shift = take_every_nth / 100.0
+    utterance_end = len(features) * frame_shift
+
+    prosody = np.zeros((num_words, 3 + 2 * features.shape[1]), dtype=np.float32)
+    if len(segments) != num_words - 1:
+        return prosody
+
+    for (i, (start, end)) in enumerate(segments):
+        previous_end = segments[i - 1][1] if i > 0 else 0.0
+        next_start = segments[i + 1][0] if i + 1 < len(segments) else utterance_end
+
+        first_frame = min(int(start / frame_shift), len(features) - 1)
+        last_frame = max(first_frame + 1, int(end / frame_shift))
+        frames = features[first_frame:last_frame]
+
+        prosody[i, :3] = [end - start, start - previous_end, max(0.0, next_start - end)]
+        prosody[i, 3:] = np.concatenate([frames.mean(0), frames.std(0)])
+
+    if segments:
+        prosody[-1, 1] = max(0.0, utterance_end - segments[-1][1])
+
+    return prosody
+
 def get_time_boundaries_from_ctm_file(path, take_every_nth):
     time_boundaries = defaultdict(lambda: [])
 
@@ -135,11 +202,15 @@ def create_numpy_array_dataset(h5file, name, num_utts, ndim, dtype):
     return shapes, dataset
 
 
-if __name__ == "__main__":
-    config = get_config()
-    data_file = "%s/data_global_cmvn_with_phones_alignment_best_asr.h5" % config["data_dir"]
-    datasets = ["best_asr"]
+def prepare_data(config, data_file, datasets):
+    """Builds an HDF5 file with a split for every Kaldi dataset.
+
+    A dataset needs config['<dataset>_data_dir'] and
+    config['<dataset>_alignment_dir']. The features are normalized with the
+    statistics of config['train_data_dir'], which are saved to
+    config['cmvn_stats'].
 
+    """
     with h5py.File(data_file, 'w') as h5file:
         words_dictionary = config["src_vocab"]
         phones_dictionary = config["phones"]
@@ -161,10 +232,12 @@ if __name__ == "__main__":
         phones_words_acoustic_ends_shapes, phones_words_acoustic_ends_dataset = create_numpy_array_dataset(h5file, 'phones_words_acoustic_ends', num_utts, 1, 'int16')
         punctuation_marks_shapes, punctuation_marks_dataset = create_numpy_array_dataset(h5file, 'punctuation_marks', num_utts, 1, 'int8')
         audio_shapes, audio = create_numpy_array_dataset(h5file, 'audio', num_utts, 2, 'float32')
+        prosody_shapes, prosody = create_numpy_array_dataset(h5file, 'prosody', num_utts, 2, 'float32')
         words_ends_shapes, words_ends = create_numpy_array_dataset(h5file, 'words_ends', num_utts, 1, 'int16')
 
 
         mean, std = get_mean_std_from_audio_features("scp:%s/feats.scp" % config["train_data_dir"])
+        save_cmvn_stats(config["cmvn_stats"], mean, std)
         for dataset in datasets:
             data_dir = config["%s_data_dir" % dataset]
 
@@ -178,7 +251,7 @@ if __name__ == "__main__":
 
                 text[uttid] = " ".join(words)
                 uttids_dataset[uttid] = text_uttid
-                words = np.array([words_dictionary.get(word, words_dictionary["<unk>"]) for word in words], dtype=np.int32)
+                words = np.array([word_to_index(word, words_dictionary, config["hash_buckets"]) for word in words], dtype=np.int32)
                 words_shapes[uttid] = words.shape
                 words_dataset[uttid] = words
 
@@ -186,16 +259,22 @@ if __name__ == "__main__":
                 punctuation_marks_shapes[uttid] = punctuation_marks.shape
                 punctuation_marks_dataset[uttid] = punctuation_marks
 
+            alignment_dir = config["%s_alignment_dir" % dataset]
+            word_segments = get_word_segments("%s/forced_phone_alignment.txt" % alignment_dir)
             for (uttid, features) in get_audio_features_from_file("scp:%s/feats.scp" % data_dir, config["take_every_nth"], mean, std):
                 if uttid not in uttids:
                     print "audio %s not in uttids" % uttid
                     continue
 
+                segments = word_segments.get(uttid, [])
                 uttid = uttids[uttid]
                 audio_shapes[uttid] = features.shape
                 audio[uttid] = features.ravel()
 
-            alignment_dir = config["%s_alignment_dir" % dataset]
+                word_prosody = get_prosodic_features(segments, features, words_shapes[uttid][0], config["take_every_nth"], config["prosodic_columns"])
+                prosody_shapes[uttid] = word_prosody.shape
+                prosody[uttid] = word_prosody.ravel()
+
             phones_per_utt, phone_time_boundaries, words_time_boundaries, phoneme_words_boundaries = get_time_boundaries("%s/forced_phone_alignment.txt" % alignment_dir, config["take_every_nth"])
             for (uttid, phones) in phones_per_utt.iteritems():
                 if uttid not in uttids:
@@ -276,3 +355,10 @@ if __name__ == "__main__":
         h5file.attrs['split'] = H5PYDataset.create_split_array(split_dict)
 
     print "Done."
+
+
+if __name__ == "__main__":
+    config = get_config()
+    data_file = "%s/data_global_cmvn_with_phones_alignment_best_asr.h5" % config["data_dir"]
+    datasets = ["best_asr"]
+    prepare_data(config, data_file, datasets)
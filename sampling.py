@@ -10,15 +10,46 @@ import time
 
 from blocks.extensions import SimpleExtension
 from blocks.serialization import BRICK_DELIMITER
-from blocks.search import BeamSearch
 
 from collections import OrderedDict
 
+from search import create_beam_search
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 
 
+def count_punctuation_errors(reference, hypothesis, punctuation_marks):
+    """Counts correct, substituted, inserted and deleted punctuation marks.
+
+    `reference` and `hypothesis` hold the token after every word.
+
+    """
+    C = S = I = D = 0
+    for (x, y) in zip(reference, hypothesis):
+        if x == y:
+            if x in punctuation_marks:
+                C += 1
+        else:
+            if x in punctuation_marks and y in punctuation_marks:
+                S += 1
+            elif x not in punctuation_marks:
+                I += 1
+            elif y not in punctuation_marks:
+                D += 1
+    return C, S, I, D
+
+
+def compute_f1_score(C, S, I, D):
+    C += 0.0001
+    precision = float(C) / (C + S + I)
+    recall = float(C) / (C + S + D)
+    f1 = (2.0 * precision * recall) / (precision + recall)
+
+    return f1
+
+
 class SamplingBase(object):
     """Utility class for F1Validator and Sampler."""
 
@@ -105,6 +136,8 @@ class Sampler(SimpleExtension, SamplingBase):
                 'sampling_phones_words_ends': phones_words_ends_batch[i][:length][None, :],
                 'sampling_audio': audio_batch[i][:numpy.max(numpy.nonzero(numpy.sum(audio_batch[i], 1))) + 1][None, :],
             }
+            if 'prosody' in batch:
+                available_inputs['sampling_prosody'] = batch['prosody'][sample_idx[i]][:length][None, :]
 
             inputs = [available_inputs[input.name] for input in self.model.inputs]
 
@@ -149,7 +182,7 @@ class F1Validator(SimpleExtension, SamplingBase):
         self.eos_idx = self.vocab[self.eos_sym]
         self.best_models = []
         self.val_f1_curve = []
-        self.beam_search = BeamSearch(samples=samples)
+        self.beam_search = create_beam_search(config, samples)
 
         # Create saving directory if it does not exist
         if not os.path.exists(self.config['saveto']):
@@ -185,6 +218,8 @@ class F1Validator(SimpleExtension, SamplingBase):
         logger.info("Started Validation: ")
         val_start_time = time.time()
         total_cost = 0.0
+        if self.config['beam_margin'] is not None:
+            self.beam_search.reset_counts()
 
         if self.verbose:
             ftrans = open(self.config['val_set_out'], 'w')
@@ -238,22 +273,8 @@ class F1Validator(SimpleExtension, SamplingBase):
                     # Compute F-Measure
                     keywords = ['<FULL_STOP>', '<COMMA>', '<QUESTION_MARK>', '<EXCLAMATION_MARK>', '<DOTS>']
 
-                    merged_tokens = zip(reference.split(), trans_out.split())
-                    for (x,y) in merged_tokens:
-                        if x == y:
-                            if x in keywords:
-                                C += 1
-                        else:
-                            if x in keywords and y in keywords:
-                                S += 1
-                            elif x not in keywords:
-                                I += 1
-                            elif y not in keywords:
-                                D += 1
-
-                        # If beam returns too short answer
-                        if len(reference) > len(trans_out.split()):
-                            D += len([w for w in reference[len(trans_out.split()):] if w in keywords])
+                    errors = count_punctuation_errors(reference.split(), trans_out.split(), keywords)
+                    C, S, I, D = [total + count for total, count in zip((C, S, I, D), errors)]
 
                     if self.verbose:
                         print(trans_out, file=ftrans)
@@ -275,16 +296,13 @@ class F1Validator(SimpleExtension, SamplingBase):
             ftrans.close()
 
         logger.info("Validation Took: {} minutes".format(float(time.time() - val_start_time) / 60.))
+        if self.config['beam_margin'] is not None:
+            logger.info("Decoded {:.1%} of the steps greedily".format(self.beam_search.greedy_fraction))
 
         return f1_score
 
     def compute_f1_score(self, C, S, I, D):
-        C += 0.0001
-        precision = float(C) / (C + S + I)
-        recall = float(C) / (C + S + D)
-        f1 = (2.0 * precision * recall) / (precision + recall)
-
-        return f1
+        return compute_f1_score(C, S, I, D)
 
     def _is_valid_to_save(self, f1_score):
         if not self.best_models or min(self.best_models,
@@ -0,0 +1,65 @@
+"""Forced scoring of candidate punctuations.
+
+Instead of searching, the model gives the log-probability of punctuations
+which are already known, e.g. from rules, other systems or an N-best list.
+Many (input, candidate) pairs are padded into one batch and scored by a
+single compiled call:
+
+    scorer = ForcedScorer(get_config(), model_dir, model_filename)
+    scores = scorer.score_requests([{'words': [...], 'punctuation': ['<SPACE>', '<COMMA>', ...]}, ...])
+
+A candidate has one mark per word, the </s> after the last word is added.
+The same input may be paired with any number of candidates.
+
+"""
+import theano
+
+from blocks.graph import ComputationGraph
+
+from checkpoint import LoadNMT
+from helpers import create_model, create_scoring_graph
+from search import pad_examples
+from server import featurize
+
+
+class ForcedScorer(object):
+    """Log-probabilities of given punctuations under a model."""
+
+    def __init__(self, config, model_dir, model_filename):
+        config['masked_sampling'] = True
+        self.config = config
+        _, _, search_model = create_model(config)
+        costs = create_scoring_graph(config, search_model)
+        loader = LoadNMT(model_dir, model_filename)
+        loader.set_model_parameters(search_model, loader.load_parameters(), borrow=True)
+        self.inputs = ComputationGraph(costs).inputs
+        self.sources = sorted(set(v.name[len('sampling_'):] for v in search_model.inputs
+                                  if not v.name.endswith('_mask')))
+        self.compute_costs = theano.function(self.inputs, costs)
+
+    def featurize(self, request):
+        """Converts a request with a 'punctuation' candidate into an example."""
+        words, example = featurize(self.config, self.sources, request)
+        marks = list(request['punctuation']) + ['</s>']
+        if len(marks) != len(words):
+            raise ValueError("The candidate needs one mark per word")
+        example['punctuation_marks'] = [self.config['trg_vocab'][mark] for mark in marks]
+        return words, example
+
+    def score(self, batch):
+        """Returns the log-probability of every example and of each of its marks.
+
+        The marks of an example include the </s> after its last word.
+
+        """
+        padded = pad_examples([example for _, example in batch], self.sources + ['punctuation_marks'])
+        input_values = [padded[v.name[len('sampling_'):] if v.name.startswith('sampling_') else v.name].astype(v.dtype)
+                        for v in self.inputs]
+        slot_scores = -self.compute_costs(*input_values)
+        lengths = padded['punctuation_marks_mask'].sum(axis=1).astype('int64')
+        return [(float(scores[:length].sum()), scores[:length])
+                for scores, length in zip(slot_scores, lengths)]
+
+    def score_requests(self, requests):
+        """Scores requests like `score` does with their examples."""
+        return self.score([self.featurize(request) for request in requests])
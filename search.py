@@ -0,0 +1,234 @@
+"""Beam search over batches of utterances of different lengths.
+
+`BatchBeamSearch` needs a sampling graph built with
+config['masked_sampling'], so that padding does not leak into the
+encoders or the attention. Each utterance gets `beam_size` consecutive
+rows of the batch and its own beam, the result for every utterance is the
+same as that of `BeamSearch` on the utterance alone.
+
+"""
+import numpy
+
+from collections import OrderedDict
+
+from blocks.search import BeamSearch
+from theano import config as theano_config
+
+
+def pad_examples(examples, names, beam_size=1):
+    """Pads a list of examples (dictionaries of sequences) into a batch.
+
+    Returns a dictionary with an array and a '_mask' for every name, each
+    example repeated `beam_size` times.
+
+    """
+    batch = OrderedDict()
+    for name in names:
+        values = [numpy.asarray(example[name]) for example in examples]
+        length = max(len(value) for value in values)
+        padded = numpy.zeros((len(values), length) + values[0].shape[1:], dtype=values[0].dtype)
+        mask = numpy.zeros((len(values), length), dtype=theano_config.floatX)
+        for i, value in enumerate(values):
+            padded[i, :len(value)] = value
+            mask[i, :len(value)] = 1
+        batch[name] = numpy.repeat(padded, beam_size, axis=0)
+        batch[name + '_mask'] = numpy.repeat(mask, beam_size, axis=0)
+    return batch
+
+
+def merge_punctuation(words, marks, punctuation_marks):
+    """Inserts the predicted punctuation marks after the words."""
+    output = []
+    for (word, mark) in zip(words, marks):
+        output.append(word)
+        if mark in punctuation_marks:
+            output.append(mark)
+
+    if len(words) > len(marks):
+        output.extend(words[len(marks):])
+    return output
+
+
+class BatchBeamSearch(BeamSearch):
+    """Beam search with an independent beam for every utterance of a batch."""
+
+    @staticmethod
+    def _smallest_in_groups(costs, groups, only_first_row=False):
+        beam_size = costs.shape[0] // groups
+        vocab_size = costs.shape[1]
+        grouped = costs.reshape((groups, beam_size, vocab_size))
+        if only_first_row:
+            grouped = grouped[:, :1]
+        flat = grouped.reshape((groups, -1))
+
+        rows = numpy.arange(groups)[:, None]
+        args = numpy.argpartition(flat, beam_size - 1, axis=1)[:, :beam_size]
+        args = args[rows, numpy.argsort(flat[rows, args], axis=1)]
+        indexes = rows * beam_size + args // vocab_size
+        return indexes.ravel(), (args % vocab_size).ravel(), flat[rows, args].ravel()
+
+    def search_batch(self, input_values, groups, eol_symbol, max_lengths, ignore_first_eol=False):
+        """Searches `groups` utterances of `input_values` (see `pad_examples`).
+
+        Every utterance is decoded for at most its entry of `max_lengths`
+        steps. Returns a list with the outputs, the total costs and the
+        costs of every step of the hypotheses of every utterance, the
+        hypotheses sorted from the best one.
+
+        """
+        if not self.compiled:
+            self.compile()
+
+        contexts, states = self.compute_initial_states_and_contexts(input_values)[:2]
+        beam_size = states['outputs'].shape[0] // groups
+        max_lengths = numpy.repeat(numpy.asarray(max_lengths), beam_size)
+
+        all_outputs = states['outputs'][None, :]
+        all_masks = numpy.ones_like(all_outputs, dtype=theano_config.floatX)
+        all_costs = numpy.zeros_like(all_outputs, dtype=theano_config.floatX)
+
+        for i in range(max_lengths.max() + 1):
+            # Utterances which reached their length are finished
+            all_masks[-1, max_lengths <= i] = 0
+            if all_masks[-1].sum() == 0:
+                break
+
+            logprobs = self.compute_logprobs(contexts, states)
+            next_costs = (all_costs[-1, :, None] +
+                          logprobs * all_masks[-1, :, None])
+            (finished,) = numpy.where(all_masks[-1] == 0)
+            next_costs[finished, :eol_symbol] = numpy.inf
+            next_costs[finished, eol_symbol + 1:] = numpy.inf
+
+            indexes, outputs, chosen_costs = self._smallest_in_groups(
+                next_costs, groups, only_first_row=i == 0)
+
+            for name in states:
+                states[name] = states[name][indexes]
+            all_outputs = all_outputs[:, indexes]
+            all_masks = all_masks[:, indexes]
+            all_costs = all_costs[:, indexes]
+
+            states.update(self.compute_next_states(contexts, states, outputs))
+            all_outputs = numpy.vstack([all_outputs, outputs[None, :]])
+            all_costs = numpy.vstack([all_costs, chosen_costs[None, :]])
+            mask = outputs != eol_symbol
+            if ignore_first_eol and i == 0:
+                mask[:] = 1
+            all_masks = numpy.vstack([all_masks, mask[None, :]])
+
+        all_outputs = all_outputs[1:]
+        all_masks = all_masks[:-1]
+        all_costs = all_costs[1:] - all_costs[:-1]
+
+        results = []
+        for group in range(groups):
+            hypotheses = []
+            for row in range(group * beam_size, (group + 1) * beam_size):
+                length = int(all_masks[:, row].sum())
+                hypotheses.append((list(all_outputs[:length, row]),
+                                   all_costs[:length, row].sum(),
+                                   all_costs[:length, row]))
+            results.append(hypotheses)
+        return results
+
+
+class AdaptiveBeamSearch(BeamSearch):
+    """Beam search which stays greedy while the model is confident.
+
+    A step keeps only the best candidate when its cost is at least `margin`
+    below that of the second best one, and the `beam_size` best candidates
+    otherwise, so the beam widens only at ambiguous slots. Only the first
+    row of the inputs is used, they may be tiled like for `BeamSearch`.
+    `greedy_fraction` is the fraction of the steps searched since the last
+    `reset_counts` which kept a single candidate.
+
+    """
+    def __init__(self, beam_size, margin, samples):
+        super(AdaptiveBeamSearch, self).__init__(samples)
+        self.beam_size = beam_size
+        self.margin = margin
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.steps = 0
+        self.greedy_steps = 0
+
+    @property
+    def greedy_fraction(self):
+        return float(self.greedy_steps) / max(self.steps, 1)
+
+    @staticmethod
+    def _tile_contexts(contexts, width):
+        # The contexts of the decoder (the attended sequence and its mask)
+        # are time major
+        return OrderedDict((name, numpy.repeat(value, width, axis=1))
+                           for name, value in contexts.items())
+
+    def search(self, input_values, eol_symbol, max_length, ignore_first_eol=False, as_arrays=False):
+        if not self.compiled:
+            self.compile()
+
+        input_values = OrderedDict((name, value[:1]) for name, value in input_values.items())
+        contexts, states = self.compute_initial_states_and_contexts(input_values)[:2]
+        tiled_contexts = {1: contexts}
+
+        def contexts_of_width(width):
+            if width not in tiled_contexts:
+                tiled_contexts[width] = self._tile_contexts(contexts, width)
+            return tiled_contexts[width]
+
+        all_outputs = states['outputs'][None, :]
+        all_masks = numpy.ones_like(all_outputs, dtype=theano_config.floatX)
+        all_costs = numpy.zeros_like(all_outputs, dtype=theano_config.floatX)
+
+        for i in range(max_length):
+            if all_masks[-1].sum() == 0:
+                break
+
+            logprobs = self.compute_logprobs(contexts_of_width(all_outputs.shape[1]), states)
+            next_costs = (all_costs[-1, :, None] +
+                          logprobs * all_masks[-1, :, None])
+            (finished,) = numpy.where(all_masks[-1] == 0)
+            next_costs[finished, :eol_symbol] = numpy.inf
+            next_costs[finished, eol_symbol + 1:] = numpy.inf
+
+            flat = next_costs.ravel()
+            candidates = min(self.beam_size, int(numpy.isfinite(flat).sum()))
+            args = numpy.argpartition(flat, candidates - 1)[:candidates]
+            args = args[numpy.argsort(flat[args])]
+            self.steps += 1
+            if candidates == 1 or flat[args[1]] - flat[args[0]] >= self.margin:
+                args = args[:1]
+                self.greedy_steps += 1
+            indexes, outputs = numpy.unravel_index(args, next_costs.shape)
+            chosen_costs = flat[args]
+
+            for name in states:
+                states[name] = states[name][indexes]
+            all_outputs = all_outputs[:, indexes]
+            all_masks = all_masks[:, indexes]
+            all_costs = all_costs[:, indexes]
+
+            states.update(self.compute_next_states(contexts_of_width(len(args)), states, outputs))
+            all_outputs = numpy.vstack([all_outputs, outputs[None, :]])
+            all_costs = numpy.vstack([all_costs, chosen_costs[None, :]])
+            mask = outputs != eol_symbol
+            if ignore_first_eol and i == 0:
+                mask[:] = 1
+            all_masks = numpy.vstack([all_masks, mask[None, :]])
+
+        all_outputs = all_outputs[1:]
+        all_masks = all_masks[:-1]
+        all_costs = all_costs[1:] - all_costs[:-1]
+        result = all_outputs, all_masks, all_costs
+        if as_arrays:
+            return result
+        return self.result_to_lists(result)
+
+
+def create_beam_search(config, samples):
+    """`BeamSearch`, or `AdaptiveBeamSearch` with config['beam_margin']."""
+    if config['beam_margin'] is None:
+        return BeamSearch(samples=samples)
+    return AdaptiveBeamSearch(config['beam_size'], config['beam_margin'], samples)
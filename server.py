@@ -0,0 +1,279 @@
+"""Punctuation server which keeps the model loaded between requests.
+
+    python server.py MODEL_DIR PARAMS_FILE [--port 8080] [--max-batch 16] [--max-wait-ms 20]
+
+POST / with a JSON object {"words": [...]} and, depending on the input of
+the model, the other sources of the training data (e.g. "audio" frames and
+"words_ends"). The end of </s> is appended to end indices which have one
+entry per word. Requests which arrive within --max-wait-ms of the first
+waiting one are decoded together in one batch. The response holds the
+punctuated text, the punctuation mark after every word with its
+probability, and the time the request spent queued and decoding. GET
+/stats returns the totals.
+
+"""
+import argparse
+import json
+import logging
+import numpy
+import threading
+import time
+
+from collections import OrderedDict
+
+from six.moves import BaseHTTPServer, queue, socketserver
+
+from checkpoint import LoadNMT
+from config import get_config
+from helpers import create_model
+from lexicon import word_to_index
+from search import BatchBeamSearch, merge_punctuation, pad_examples
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+# Sources with one entry per word whose last entry belongs to </s>, and
+# the sources they index
+WORD_END_SOURCES = OrderedDict([('words_ends', 'audio'), ('phones_words_ends', 'phones'),
+                                ('phones_words_acoustic_ends', 'audio')])
+
+# Sources of frames and the config key of their feature size
+FEATURE_SOURCES = OrderedDict([('audio', 'audio_feat_size'), ('prosody', 'prosody_feat_size')])
+
+
+class Request(object):
+    """A waiting request and, once decoded, its result."""
+    def __init__(self, example):
+        self.example = example
+        self.arrived = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def resolve_ends(example):
+    """Replaces the -1 ends of </s> in `example` by the last frame or phone.
+
+    In a padded batch -1 would index the padding instead. The model
+    reduces the frame rate by merging frames, so the last frame of the
+    utterance is in its last merged one.
+
+    """
+    for source, indexed in WORD_END_SOURCES.items():
+        if source in example and indexed in example:
+            last = len(example[indexed]) - 1
+            example[source] = [last if end < 0 else end for end in example[source]]
+    return example
+
+
+def featurize(config, sources, request):
+    """Returns the words of a request with </s> and its example of `sources`.
+
+    Raises a ValueError for a request which does not fit the model, so
+    that it fails alone instead of the whole batch it would be decoded in.
+
+    """
+    words = request['words'] + ['</s>']
+    example = {'words': [word_to_index(word, config['src_vocab'], config['hash_buckets'])
+                         for word in words]}
+    for source in sources:
+        if source == 'words':
+            continue
+        if source not in request:
+            raise ValueError("The model needs '{}'".format(source))
+        example[source] = request[source]
+        if source in WORD_END_SOURCES and len(request[source]) == len(words) - 1:
+            example[source] = request[source] + [-1]
+
+    resolve_ends(example)
+    for source, indexed in WORD_END_SOURCES.items():
+        if source in example and indexed in example:
+            last = len(example[indexed]) - 1
+            if any(end < 0 or end > last for end in example[source]):
+                raise ValueError("'{}' points outside of '{}'".format(source, indexed))
+    for source in WORD_END_SOURCES:
+        if source in example and len(example[source]) != len(words):
+            raise ValueError("'{}' needs one entry per word".format(source))
+    for source, size in FEATURE_SOURCES.items():
+        if source in example:
+            shape = numpy.shape(example[source])
+            if len(shape) != 2 or shape[1] != config[size]:
+                raise ValueError("'{}' needs {} features per frame".format(source, config[size]))
+    return words, example
+
+
+class Punctuator(object):
+    """Decodes batches of examples with the masked sampling graph."""
+
+    def __init__(self, config, model_dir, model_filename):
+        config['masked_sampling'] = True
+        self.config = config
+        _, samples, search_model = create_model(config)
+        loader = LoadNMT(model_dir, model_filename)
+        loader.set_model_parameters(search_model, loader.load_parameters(), borrow=True)
+        self.inputs = search_model.inputs
+        self.sources = sorted(set(v.name[len('sampling_'):] for v in self.inputs
+                                  if not v.name.endswith('_mask')))
+        self.beam_search = BatchBeamSearch(samples=samples)
+        self.beam_search.compile()
+        self.trg_ivocab = {v: k for k, v in config["trg_vocab"].items()}
+
+    def featurize(self, request):
+        """Converts a request into an example of the model sources."""
+        return featurize(self.config, self.sources, request)
+
+    def punctuate(self, batch):
+        """Returns the text, marks and their probabilities for every example."""
+        beam_size = self.config['beam_size']
+        padded = pad_examples([example for _, example in batch], self.sources, beam_size)
+        return self._search(batch, padded)
+
+    def _search(self, batch, padded):
+        input_values = OrderedDict((v, padded[v.name[len('sampling_'):]].astype(v.dtype))
+                                   for v in self.inputs)
+        results = self.beam_search.search_batch(
+            input_values, len(batch), self.config['trg_eos_idx'],
+            [len(words) + 2 for words, _ in batch], ignore_first_eol=True)
+
+        outputs = []
+        for (words, _), hypotheses in zip(batch, results):
+            # normalize costs according to the sequence lengths
+            marks, _, step_costs = min(hypotheses, key=lambda h: h[1] / max(len(h[0]), 1))
+            marks = [self.trg_ivocab.get(mark, '<unk>') for mark in marks]
+            outputs.append({
+                'text': " ".join(merge_punctuation(words[:-1], marks, self.config['punctuation_marks'])),
+                'punctuation': marks[:len(words) - 1],
+                'scores': numpy.exp(-step_costs[:len(words) - 1]).tolist(),
+            })
+        return outputs
+
+
+class MicroBatcher(threading.Thread):
+    """Collects concurrent requests into batches for the punctuator.
+
+    A batch is decoded when it has `max_batch` requests or when the oldest
+    request waited `max_wait` seconds.
+
+    """
+    def __init__(self, punctuator, max_batch, max_wait):
+        super(MicroBatcher, self).__init__()
+        self.daemon = True
+        self.punctuator = punctuator
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.stats = {'requests': 0, 'batches': 0, 'queue_seconds': 0., 'inference_seconds': 0.}
+        self.lock = threading.Lock()
+
+    def submit(self, example):
+        request = Request(example)
+        self.queue.put(request)
+        request.done.wait()
+        return request
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrived + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            started = time.time()
+            try:
+                results = self.punctuator.punctuate([request.example for request in batch])
+            except Exception as e:
+                logger.exception("Decoding failed")
+                results = [None] * len(batch)
+                for request in batch:
+                    request.error = str(e)
+            finished = time.time()
+
+            for request, result in zip(batch, results):
+                if result is not None:
+                    result['queue_ms'] = 1000 * (started - request.arrived)
+                    result['inference_ms'] = 1000 * (finished - started)
+                    result['batch_size'] = len(batch)
+                request.result = result
+                request.done.set()
+
+            with self.lock:
+                self.stats['requests'] += len(batch)
+                self.stats['batches'] += 1
+                self.stats['queue_seconds'] += sum(started - request.arrived for request in batch)
+                self.stats['inference_seconds'] += finished - started
+
+
+class PunctuationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'not found'})
+        batcher = self.server.batcher
+        with batcher.lock:
+            stats = dict(batcher.stats)
+        requests = max(stats['requests'], 1)
+        stats['mean_batch_size'] = float(stats['requests']) / max(stats['batches'], 1)
+        stats['mean_queue_ms'] = 1000 * stats['queue_seconds'] / requests
+        stats['mean_inference_ms'] = 1000 * stats['inference_seconds'] / max(stats['batches'], 1)
+        self._reply(200, stats)
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            example = self.server.batcher.punctuator.featurize(request)
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {'error': str(e)})
+
+        request = self.server.batcher.submit(example)
+        if request.error is not None:
+            return self._reply(500, {'error': request.error})
+        self._reply(200, request.result)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class PunctuationServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PunctuationHandler)
+        self.batcher = batcher
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir")
+    parser.add_argument("model_filename")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=20.)
+    args = parser.parse_args()
+
+    logger.info("Loading the model..")
+    punctuator = Punctuator(get_config(), args.model_dir, args.model_filename)
+    batcher = MicroBatcher(punctuator, args.max_batch, args.max_wait_ms / 1000.)
+    batcher.start()
+
+    server = PunctuationServer((args.host, args.port), batcher)
+    logger.info("Listening on {}:{}".format(args.host, args.port))
+    server.serve_forever()
@@ -1,10 +1,14 @@
 import numpy
 
-from fuel.datasets import H5PYDataset
-from fuel.schemes import ConstantScheme
+from collections import OrderedDict
+
+from blocks.extensions import SimpleExtension
+from fuel.datasets import Dataset, H5PYDataset
+from fuel.schemes import ConstantScheme, IndexScheme
 from fuel.streams import DataStream
-from fuel.transformers import (Batch, Filter, Padding, SortMapping, Unpack, Mapping)
+from fuel.transformers import (Batch, Filter, Padding, SortMapping, Unpack, Mapping, Transformer)
 
+from six import Iterator
 from six.moves import cPickle
 
 
@@ -51,6 +55,274 @@ class PaddingWithEOS(Padding):
         return tuple(data_with_masks)
 
 
+class ResumableExampleScheme(IndexScheme):
+    """Iterates over example indices starting from a given position.
+
+    The order of an epoch is fully determined by `seed` and `epoch`
+    (sequential if `seed` is None), so the position in the data is just
+    (epoch, offset) and the scheme can be moved there without reading
+    anything. With `shard` (rank, workers) it iterates only over every
+    workers-th example of that order, so the shards of data parallel
+    workers are disjoint in every epoch.
+
+    """
+    requests_examples = True
+
+    def __init__(self, examples, seed=None, shard=None, **kwargs):
+        super(ResumableExampleScheme, self).__init__(examples, **kwargs)
+        self.seed = seed
+        self.shard = shard
+        self.epoch = 0
+        self.offset = 0
+
+    def get_request_iterator(self):
+        indices = list(self.indices)
+        if self.seed is not None:
+            numpy.random.RandomState(self.seed + self.epoch).shuffle(indices)
+        if self.shard is not None:
+            rank, workers = self.shard
+            indices = indices[rank::workers]
+        return _ResumableRequestIterator(self, indices)
+
+
+class _ResumableRequestIterator(Iterator):
+    """Advances the offset of its scheme with every request."""
+    def __init__(self, scheme, indices):
+        self.scheme = scheme
+        self.indices = indices
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.exhausted:
+            raise StopIteration
+        if self.scheme.offset >= len(self.indices):
+            self.exhausted = True
+            self.scheme.epoch += 1
+            self.scheme.offset = 0
+            raise StopIteration
+        index = self.indices[self.scheme.offset]
+        self.scheme.offset += 1
+        return index
+
+
+class ResumableStream(Transformer):
+    """Keeps a small serializable cursor of the training stream.
+
+    Batches are sorted within read-ahead chunks of `chunk_batches` batches,
+    so the cursor stores where the current chunk starts in the example
+    order and how many of its batches were already returned. Restoring
+    the cursor seeks the scheme directly to the chunk and skips only the
+    batches of that single chunk.
+
+    """
+    def __init__(self, data_stream, scheme, chunk_batches, **kwargs):
+        kwargs.setdefault('produces_examples', False)
+        super(ResumableStream, self).__init__(data_stream, **kwargs)
+        self.scheme = scheme
+        self.chunk_batches = chunk_batches
+        self.chunk_epoch = scheme.epoch
+        self.chunk_offset = scheme.offset
+        self.batches = 0
+        self.skip = 0
+        self.epoch_finished = False
+
+    @property
+    def mask_sources(self):
+        return self.data_stream.mask_sources
+
+    @property
+    def cursor(self):
+        # Reading the last chunk ahead already advances the epoch of the
+        # scheme, so the epoch is finished only once its batches are
+        if self.epoch_finished:
+            return {'epoch': self.scheme.epoch, 'seed': self.scheme.seed,
+                    'offset': 0, 'batches': 0}
+        return {'epoch': self.chunk_epoch, 'seed': self.scheme.seed,
+                'offset': self.chunk_offset, 'batches': self.batches}
+
+    @cursor.setter
+    def cursor(self, cursor):
+        if cursor['seed'] != self.scheme.seed:
+            raise ValueError("Cursor was created with seed {} but the stream "
+                             "uses seed {}".format(cursor['seed'], self.scheme.seed))
+        self.scheme.epoch = self.chunk_epoch = cursor['epoch']
+        self.scheme.offset = self.chunk_offset = cursor['offset']
+        self.batches = 0
+        self.skip = cursor['batches']
+        self.epoch_finished = False
+
+    def get_epoch_iterator(self, **kwargs):
+        self.chunk_epoch = self.scheme.epoch
+        self.chunk_offset = self.scheme.offset
+        self.batches = 0
+        self.epoch_finished = False
+        return super(ResumableStream, self).get_epoch_iterator(**kwargs)
+
+    def _next_batch(self):
+        if self.batches % self.chunk_batches == 0:
+            self.chunk_epoch = self.scheme.epoch
+            self.chunk_offset = self.scheme.offset
+            self.batches = 0
+        try:
+            batch = next(self.child_epoch_iterator)
+        except StopIteration:
+            self.epoch_finished = True
+            raise
+        self.batches += 1
+        return batch
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        while self.skip > 0:
+            self.skip -= 1
+            self._next_batch()
+        return self._next_batch()
+
+
+class PackAudio(Transformer):
+    """Packs the audio of a batch into fewer rows.
+
+    Utterances are placed first-fit decreasing into rows of `length`
+    frames (or of the longest utterance of the batch if that is longer),
+    each starting at a multiple of `align` frames so that frame rate
+    reduction never merges frames of two utterances. Adds 'audio_starts',
+    which is one at the first frame of every utterance, and 'audio_rows',
+    the row of every utterance, and shifts the frame indices in
+    'words_ends' and 'phones_words_acoustic_ends' into the rows, with the
+    -1 end of '</s>' resolved to the last frame of its utterance. All other
+    sources keep one row per utterance.
+
+    """
+    frame_index_sources = ('words_ends', 'phones_words_acoustic_ends')
+
+    def __init__(self, data_stream, length=None, align=1, **kwargs):
+        kwargs.setdefault('produces_examples', False)
+        super(PackAudio, self).__init__(data_stream, **kwargs)
+        self.length = length
+        self.align = align
+        self.frames = 0
+        self.padded_frames = 0
+        self.packed_frames = 0
+
+    @property
+    def sources(self):
+        return self.data_stream.sources + ('audio_starts', 'audio_rows')
+
+    @property
+    def padding_fractions(self):
+        """Fractions of padding frames without and with packing so far."""
+        if not self.frames:
+            return 0., 0.
+        return (1. - float(self.frames) / self.padded_frames,
+                1. - float(self.frames) / self.packed_frames)
+
+    @staticmethod
+    def _shift_ends(ends, offset, length):
+        """Frame indices of an utterance placed at `offset` of its row.
+
+        The -1 end of '</s>' means the last frame of the utterance, which in
+        a packed row is no longer the last frame of the row.
+
+        """
+        ends = numpy.asarray(ends)
+        shifted = numpy.where(ends >= 0, ends, length + ends) + offset
+        if len(shifted) and (shifted.min() < offset or shifted.max() >= offset + length):
+            raise ValueError("Frame index out of the utterance at frames [{}, {})".format(offset, offset + length))
+        return shifted.astype(ends.dtype)
+
+    def transform_batch(self, batch):
+        data = OrderedDict(zip(self.data_stream.sources, batch))
+        audio = data['audio']
+        lengths = [len(frames) for frames in audio]
+        spans = [-(-length // self.align) * self.align for length in lengths]
+        capacity = max(max(spans), self.length or 0)
+
+        used = []
+        rows = [None] * len(audio)
+        offsets = [None] * len(audio)
+        for i in sorted(range(len(audio)), key=lambda i: -spans[i]):
+            for row in range(len(used)):
+                if used[row] + spans[i] <= capacity:
+                    break
+            else:
+                row = len(used)
+                used.append(0)
+            rows[i] = row
+            offsets[i] = used[row]
+            used[row] += spans[i]
+
+        feature_size = numpy.asarray(audio[0]).shape[1]
+        packed = [numpy.zeros((row_length, feature_size), dtype=numpy.asarray(audio[0]).dtype) for row_length in used]
+        starts = [numpy.zeros(row_length, dtype='float32') for row_length in used]
+        for i, frames in enumerate(audio):
+            packed[rows[i]][offsets[i]:offsets[i] + lengths[i]] = frames
+            starts[rows[i]][offsets[i]] = 1
+
+        for source in self.frame_index_sources:
+            if source in data:
+                data[source] = [self._shift_ends(ends, offset, length)
+                                for ends, offset, length in zip(data[source], offsets, lengths)]
+        data['audio'] = packed
+        data['audio_starts'] = starts
+        data['audio_rows'] = numpy.asarray(rows, dtype='int64')
+
+        self.frames += sum(lengths)
+        self.padded_frames += len(audio) * max(lengths)
+        self.packed_frames += len(used) * max(used)
+        return tuple(data.values())
+
+
+class PackingStatistics(SimpleExtension):
+    """Adds the padding fractions of a `PackAudio` stream to the log."""
+    def __init__(self, packing, **kwargs):
+        kwargs.setdefault('after_batch', True)
+        super(PackingStatistics, self).__init__(**kwargs)
+        self.packing = packing
+
+    def do(self, which_callback, *args):
+        unpacked, packed = self.packing.padding_fractions
+        self.main_loop.log.current_row['audio_padding_unpacked'] = unpacked
+        self.main_loop.log.current_row['audio_padding_packed'] = packed
+
+
+def find_transformer(data_stream, cls):
+    """Returns the first stream of class `cls` in a chain of transformers."""
+    while data_stream is not None:
+        if isinstance(data_stream, cls):
+            return data_stream
+        data_stream = getattr(data_stream, 'data_stream', None)
+    return None
+
+
+class MergedDataset(Dataset):
+    """The sources of several datasets with the same examples side by side."""
+    def __init__(self, datasets, **kwargs):
+        self.datasets = datasets
+        self.provides_sources = sum((dataset.sources for dataset in datasets), ())
+        super(MergedDataset, self).__init__(**kwargs)
+
+    @property
+    def num_examples(self):
+        return self.datasets[0].num_examples
+
+    def open(self):
+        return [dataset.open() for dataset in self.datasets]
+
+    def close(self, state):
+        for dataset, dataset_state in zip(self.datasets, state):
+            dataset.close(dataset_state)
+
+    def get_data(self, state=None, request=None):
+        data = sum((tuple(dataset.get_data(dataset_state, request))
+                    for dataset, dataset_state in zip(self.datasets, state)), ())
+        return tuple(value for source, value in zip(self.provides_sources, data)
+                     if source in self.sources)
+
+
 class _too_long(object):
     """Filters sequences longer than given sequence length."""
     def __init__(self, seq_len=500):
@@ -60,14 +332,27 @@ class _too_long(object):
         return max([len(x) for x in sentence_pair]) <= self.seq_len
 
 
-def get_tr_stream(path, src_eos_idx, phones_sil, tgt_eos_idx, seq_len=50, batch_size=80, sort_k_batches=12, **kwargs):
-    """Prepares the training data stream."""
+def get_tr_stream(path, src_eos_idx, phones_sil, tgt_eos_idx, seq_len=50, batch_size=80, sort_k_batches=12, seed=None, prosody=False,
+                  pack_audio=False, pack_length=None, pack_align=1, shard=None, teacher_posteriors=None, **kwargs):
+    """Prepares the training data stream.
+
+    The returned stream is a `ResumableStream` whose cursor is saved by
+    `CheckpointNMT` instead of pickling the whole pipeline. With
+    `teacher_posteriors`, the file written by distill.py, the examples get
+    the 'teacher_posteriors' source.
+
+    """
 
     sources = ('words', 'audio', 'words_ends', 'punctuation_marks', 'phones', 'phones_words_ends', 'phones_words_acoustic_ends')
     #sources = ('words', 'audio', 'words_ends', 'punctuation_marks', 'phones', 'phones_words_ends')
+    if prosody:
+        sources += ('prosody',)
     dataset = H5PYDataset(path, which_sets=('train',), sources=sources, load_in_memory=False)
+    if teacher_posteriors is not None:
+        dataset = MergedDataset([dataset, H5PYDataset(teacher_posteriors, which_sets=('train',), load_in_memory=False)])
     print "creating example stream"
-    stream = dataset.get_example_stream()
+    scheme = ResumableExampleScheme(dataset.num_examples, seed=seed, shard=shard)
+    stream = DataStream(dataset, iteration_scheme=scheme)
     print "example stream created"
 
     # Filter sequences that are too long
@@ -85,8 +370,14 @@ def get_tr_stream(path, src_eos_idx, phones_sil, tgt_eos_idx, seq_len=50, batch_
     # Construct batches from the stream with specified batch size
     stream = Batch(stream, iteration_scheme=ConstantScheme(batch_size))
 
+    # Put several utterances into one row of frames
+    mask_sources = None
+    if pack_audio:
+        stream = PackAudio(stream, pack_length, pack_align)
+        mask_sources = tuple(source for source in stream.sources if source != 'audio_rows')
+
     # Pad sequences that are short
-    masked_stream = PaddingWithEOS(stream, {
+    masked_stream = PaddingWithEOS(stream, mask_sources=mask_sources, padding={
         'words': src_eos_idx,
         'phones': phones_sil,
         'punctuation_marks': tgt_eos_idx,
@@ -94,15 +385,27 @@ def get_tr_stream(path, src_eos_idx, phones_sil, tgt_eos_idx, seq_len=50, batch_
         'words_ends': -1,
         'phones_words_ends': -1,
         'phones_words_acoustic_ends': -1,
+        'prosody': 0,
+        'audio_starts': 0,
+        'teacher_posteriors': 0,
     })
 
-    return masked_stream
+    return ResumableStream(masked_stream, scheme, sort_k_batches)
+
+
+def get_dev_stream(path, prosody=False, shard=None, **kwargs):
+    """Setup development set stream if necessary.
 
+    With `shard` (rank, workers) the stream holds every workers-th example
+    starting from the rank-th one.
 
-def get_dev_stream(path, **kwargs):
-    """Setup development set stream if necessary."""
+    """
 
     sources = ('words', 'audio', 'words_ends', 'punctuation_marks', 'phones', 'phones_words_ends', 'phones_words_acoustic_ends', 'text', 'uttids')
     #sources = ('words', 'audio', 'words_ends', 'punctuation_marks', 'phones', 'phones_words_ends', 'text', 'uttids')
+    if prosody:
+        sources += ('prosody',)
     dataset = H5PYDataset(path, which_sets=('dev',), sources=sources)
+    if shard is not None:
+        return DataStream(dataset, iteration_scheme=ResumableExampleScheme(dataset.num_examples, shard=shard))
     return dataset.get_example_stream()
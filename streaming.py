@@ -0,0 +1,390 @@
+"""Punctuation of words as they arrive from a live recognizer.
+
+Needs a model trained with config['streaming_lookahead'] K, whose encoders
+look only K words ahead and whose attention sees only the words up to the
+current mark. The mark after a word is decided greedily as soon as K more
+words, and for acoustic models the frames up to the end of the last of
+them plus config['streaming_frame_lookahead'], have arrived. Later words
+can not change it.
+
+    punctuator = StreamingPunctuator(config, model_dir, model_filename)
+    for words, frames, words_ends in recognizer:
+        emit(punctuator.push(words, frames, words_ends))
+    emit(punctuator.finish())
+
+`IncrementalPunctuator` instead re-punctuates whole partial hypotheses,
+which recognizers revise many times per second, reusing the computation
+for the unchanged words.
+
+"""
+import logging
+import numpy
+import theano
+
+from theano import tensor
+
+from blocks.filter import VariableFilter
+from blocks.graph import ComputationGraph
+from blocks.search import BeamSearch
+
+from checkpoint import LoadNMT
+from helpers import create_model, find_brick, merge_representations
+from lexicon import word_to_index
+from model import BidirectionalAudioEncoder, BidirectionalEncoder, Decoder
+from prepare_data import load_cmvn_stats
+
+logger = logging.getLogger(__name__)
+
+
+class RunningCMVN(object):
+    """Mean and variance normalization with running statistics.
+
+    Starts from the stored global statistics, weighted as `prior_frames`
+    frames, and adds every frame it normalizes.
+
+    """
+    def __init__(self, mean, std, prior_frames=1000):
+        self.count = float(prior_frames)
+        self.sum = numpy.asarray(mean, dtype='float64') * self.count
+        self.sum_sq = (numpy.asarray(std, dtype='float64') ** 2 + (self.sum / self.count) ** 2) * self.count
+
+    def normalize(self, frames):
+        self.count += len(frames)
+        self.sum += frames.sum(0)
+        self.sum_sq += (frames * frames).sum(0)
+        mean = self.sum / self.count
+        std = numpy.sqrt(numpy.maximum(self.sum_sq / self.count - mean ** 2, 1e-8))
+        return ((frames - mean) / std).astype('float32')
+
+
+class _Hypothesis(object):
+    """What is kept of the words and frames of an utterance so far."""
+    def __init__(self):
+        self.tokens = []
+        self.words_rows = None
+        self.audio_rows = None
+        self.frames = None
+        self.raw_frames = 0
+        self.frame_embeddings = None
+        self.final_frames = 0
+        self.decoder_states = []
+        self.marks = []
+
+
+class _ContinuedEncoding(object):
+    """Encodes the words and frames of a `_Hypothesis` continuing from its states.
+
+    Needs a model trained with config['streaming_lookahead'] K, in which a
+    word changes only the representations of itself and the K words before
+    it, so only those are recomputed. Acoustic models get the frames of the
+    recognizer, every config['take_every_nth'] of them is normalized with
+    `RunningCMVN` unless `normalize` is False, in which case the frames are
+    taken as they are, e.g. those of the HDF5 files.
+
+    """
+    def __init__(self, config, model_dir, model_filename, normalize=True, prior_frames=1000):
+        if config['streaming_lookahead'] is None:
+            raise ValueError("{} needs a model trained with config['streaming_lookahead']".format(
+                type(self).__name__))
+        self.config = config
+        self.lookahead = config['streaming_lookahead']
+        _, _, search_model = create_model(config)
+        loader = LoadNMT(model_dir, model_filename)
+        loader.set_model_parameters(search_model, loader.load_parameters(), borrow=True)
+
+        bricks = search_model.top_bricks
+        self.words_encoder = find_brick(bricks, BidirectionalEncoder)
+        self.audio_encoder = find_brick(bricks, BidirectionalAudioEncoder)
+        self._compile(find_brick(bricks, Decoder))
+        self.trg_ivocab = {v: k for k, v in config["trg_vocab"].items()}
+
+        self.cmvn = None
+        if self.audio_encoder is not None and normalize:
+            mean, std = load_cmvn_stats(config['cmvn_stats'])
+            self.cmvn = RunningCMVN(mean, std, prior_frames)
+
+    def _compile(self, decoder):
+        floatX = theano.config.floatX
+        forward_states = tensor.matrix('forward_states')
+        if self.words_encoder is not None:
+            words = tensor.lmatrix('words')
+            representation = self.words_encoder.apply_continued(
+                words, tensor.ones(words.shape, dtype=floatX), forward_states)
+            self._encode_words = theano.function([words, forward_states], representation)
+        if self.audio_encoder is not None:
+            audio = tensor.ftensor3('audio')
+            embeddings = self.audio_encoder.embed_frames_continued(
+                audio, tensor.ones(audio.shape[:2], dtype=floatX), forward_states)
+            self._embed_frames = theano.function([audio, forward_states], embeddings)
+
+            embeddings = tensor.tensor3('embeddings')
+            representation = self.audio_encoder.represent_words_continued(
+                embeddings, tensor.ones(embeddings.shape[:2], dtype=floatX), forward_states)
+            self._encode_audio_words = theano.function([embeddings, forward_states], representation)
+        if self.words_encoder is not None and self.audio_encoder is not None:
+            words, audio = tensor.tensor3('words'), tensor.tensor3('audio')
+            self._merge = theano.function([words, audio], merge_representations(self.config, words, audio, False))
+
+        # The decoder on a given representation instead of the encoders
+        self.representation = tensor.tensor3('representation')
+        generated = decoder.generate(self.representation)
+        _, samples = VariableFilter(bricks=[decoder.sequence_generator], name="outputs")(
+            ComputationGraph(generated[1]))
+        self.beam_search = BeamSearch(samples=samples)
+        self.beam_search.compile()
+
+    def _initial_states(self, rows, first):
+        dim = self.config['enc_nhids']
+        if rows is None or first == 0:
+            return numpy.zeros((1, dim), dtype=theano.config.floatX)
+        return rows[first - 1, :, :dim]
+
+    def _normalize(self, hypothesis, frames):
+        """Subsamples and normalizes frames of the recognizer."""
+        if frames is None or not len(frames) or self.cmvn is None:
+            return frames
+        n = self.config['take_every_nth']
+        first = -hypothesis.raw_frames % n
+        hypothesis.raw_frames += len(frames)
+        frames = numpy.asarray(frames)[first::n]
+        if len(frames):
+            frames = self.cmvn.normalize(frames)
+        return frames
+
+    def _add_frames(self, hypothesis, frames, tokens, reuse=True):
+        """Embeds the new frames, returns the first word they may change."""
+        k = self.config['frame_downsampling']
+        if frames is None or not len(frames):
+            if hypothesis.frame_embeddings is None:
+                raise ValueError("The model needs frames before the first words")
+            if reuse:
+                return len(tokens)
+        else:
+            frames = numpy.asarray(frames, dtype='float32')
+            if hypothesis.frames is not None:
+                frames = numpy.concatenate([hypothesis.frames, frames])
+            hypothesis.frames = frames
+
+        # Without reuse all frames are embedded again
+        start = hypothesis.final_frames if reuse else 0
+        embeddings = self._embed_frames(hypothesis.frames[None, start * k:],
+                                        self._initial_states(hypothesis.frame_embeddings, start))
+        if start > 0:
+            embeddings = numpy.concatenate([hypothesis.frame_embeddings[:start], embeddings])
+        hypothesis.frame_embeddings = embeddings
+        hypothesis.final_frames = max(0, len(hypothesis.frames) // k - self.config['streaming_frame_lookahead'])
+
+        for i, (_, end) in enumerate(tokens):
+            if end < 0 or end // k >= start:
+                return i
+        return len(tokens)
+
+    def _encode(self, hypothesis, first):
+        """Representation of `hypothesis.tokens`, recomputed from `first`."""
+        k = self.config['frame_downsampling']
+        if self.words_encoder is not None:
+            indices = [word_to_index(word, self.config['src_vocab'], self.config['hash_buckets'])
+                       for word, _ in hypothesis.tokens[first:]]
+            rows = self._encode_words(numpy.array([indices]), self._initial_states(hypothesis.words_rows, first))
+            if first > 0:
+                rows = numpy.concatenate([hypothesis.words_rows[:first], rows])
+            hypothesis.words_rows = rows
+        if self.audio_encoder is not None:
+            last = len(hypothesis.frame_embeddings) - 1
+            ends = [last if end < 0 else min(end // k, last) for _, end in hypothesis.tokens[first:]]
+            rows = self._encode_audio_words(hypothesis.frame_embeddings[ends],
+                                            self._initial_states(hypothesis.audio_rows, first))
+            if first > 0:
+                rows = numpy.concatenate([hypothesis.audio_rows[:first], rows])
+            hypothesis.audio_rows = rows
+
+        if self.words_encoder is None:
+            return hypothesis.audio_rows
+        if self.audio_encoder is None:
+            return hypothesis.words_rows
+        return self._merge(hypothesis.words_rows, hypothesis.audio_rows)
+
+
+class StreamingPunctuator(_ContinuedEncoding):
+    """Emits the punctuation of an utterance while its words arrive.
+
+    Word ends count the frames after subsampling, like in the training
+    data. The encoders continue from the states of the words and frames
+    of earlier pushes, so a push costs the same however long the
+    utterance already is.
+
+    """
+    def __init__(self, config, model_dir, model_filename, normalize=True, prior_frames=1000):
+        super(StreamingPunctuator, self).__init__(config, model_dir, model_filename, normalize, prior_frames)
+        self.acoustic = self.audio_encoder is not None
+        self.start()
+
+    def start(self):
+        """Begins a new utterance, the normalization statistics are kept."""
+        self.hypothesis = _Hypothesis()
+        self.words = []
+        self.words_ends = []
+        self.frames = 0
+        self.new_frames = []
+        self.marks = []
+        self.states = None
+
+    def push(self, words, frames=None, words_ends=None):
+        """Adds words, new frames and the ends of the words.
+
+        Returns the (word, mark) pairs which were decided.
+
+        """
+        self.words.extend(words)
+        frames = self._normalize(self.hypothesis, frames)
+        if self.acoustic and frames is not None and len(frames):
+            self.new_frames.append(numpy.asarray(frames, dtype='float32'))
+            self.frames += len(frames)
+        if words_ends is not None:
+            self.words_ends.extend(words_ends)
+        return self._emit(self._ready())
+
+    def finish(self):
+        """Ends the utterance, returns the remaining (word, mark) pairs."""
+        self.words_ends = self.words_ends[:len(self.words)]
+        emitted = self._emit(len(self.words), final=True)
+        self.start()
+        return emitted
+
+    def _frames_needed(self, end):
+        k = self.config['frame_downsampling']
+        return (end // k + self.config['streaming_frame_lookahead'] + 1) * k
+
+    def _ready(self):
+        """Number of marks whose lookahead has arrived."""
+        if not self.acoustic:
+            return len(self.words) - self.lookahead
+        ready = min(len(self.words), len(self.words_ends)) - self.lookahead
+        while ready > len(self.marks) and \
+                self._frames_needed(self.words_ends[ready - 1 + self.lookahead]) > self.frames:
+            ready -= 1
+        return ready
+
+    def _tokens(self, final):
+        length = len(self.words)
+        if self.acoustic:
+            length = min(length, len(self.words_ends))
+        ends = self.words_ends[:length] if self.acoustic else [None] * length
+        tokens = list(zip(self.words[:length], ends))
+        if final:
+            tokens.append(('</s>', -1))
+        return tokens
+
+    def _emit(self, ready, final=False):
+        if ready <= len(self.marks):
+            return []
+
+        # Words are only appended, each changes the K words before it
+        hypothesis = self.hypothesis
+        tokens = self._tokens(final)
+        first = max(0, len(hypothesis.tokens) - self.lookahead)
+        if self.acoustic:
+            frames = numpy.concatenate(self.new_frames) if self.new_frames else None
+            self.new_frames = []
+            first = min(first, max(0, self._add_frames(hypothesis, frames, tokens) - self.lookahead))
+        first = min(first, len(tokens) - 1)
+        hypothesis.tokens = tokens
+
+        # The representations of the words before `ready` are final, and
+        # the attention of their marks looks at nothing else
+        representation = self._encode(hypothesis, first)
+        contexts, states = self.beam_search.compute_initial_states_and_contexts(
+            {self.representation: representation})[:2]
+        if self.states is None:
+            self.states = states
+
+        eos = self.config['trg_eos_idx']
+        emitted = []
+        while len(self.marks) < ready:
+            logprobs = self.beam_search.compute_logprobs(contexts, self.states)
+            logprobs[:, eos] = numpy.inf
+            outputs = logprobs.argmin(axis=1)
+            self.states.update(self.beam_search.compute_next_states(contexts, self.states, outputs))
+
+            mark = self.trg_ivocab.get(outputs[0], '<unk>')
+            emitted.append((self.words[len(self.marks)], mark))
+            self.marks.append(mark)
+        return emitted
+
+
+class IncrementalPunctuator(_ContinuedEncoding):
+    """Re-punctuates partial hypotheses which change only at their end.
+
+    For every stream the representations, frame embeddings and decoder
+    states of the last hypothesis are kept, so an update recomputes them
+    only from K words before the first changed word (see
+    `_ContinuedEncoding`), and a mark depends only on the representations
+    up to its word. Every hypothesis is punctuated greedily as if it were
+    complete. With `reuse` False everything is recomputed, e.g. to measure
+    the saving.
+
+    """
+    def __init__(self, config, model_dir, model_filename, normalize=True, prior_frames=1000, reuse=True):
+        super(IncrementalPunctuator, self).__init__(config, model_dir, model_filename, normalize, prior_frames)
+        self.reuse = reuse
+        self.streams = {}
+        self.stats = {'rows': 0, 'rows_computed': 0, 'steps': 0, 'steps_computed': 0}
+
+    def close(self, stream):
+        """Forgets a stream whose utterance ended."""
+        self.streams.pop(stream, None)
+
+    def update(self, stream, words, frames=None, words_ends=None):
+        """Punctuates the current hypothesis of a stream.
+
+        `words` and `words_ends` cover the whole hypothesis, `frames` only
+        the frames which arrived since the last update. Returns the mark
+        after every word.
+
+        """
+        hypothesis = self.streams.setdefault(stream, _Hypothesis())
+        if words_ends is None:
+            words_ends = [None] * len(words)
+        tokens = list(zip(words, words_ends)) + [('</s>', -1)]
+        if self.reuse and tokens == hypothesis.tokens and (frames is None or not len(frames)):
+            return hypothesis.marks
+
+        first = 0
+        if self.reuse:
+            while first < min(len(tokens), len(hypothesis.tokens)) and tokens[first] == hypothesis.tokens[first]:
+                first += 1
+            first = max(0, first - self.lookahead)
+        if self.audio_encoder is not None:
+            # The backward window of the word level audio GRU reaches the
+            # first changed word from K words before it
+            frames = self._normalize(hypothesis, frames)
+            first = min(first, max(0, self._add_frames(hypothesis, frames, tokens, self.reuse) - self.lookahead))
+        # </s> follows the last word, it changes with anything else
+        first = min(first, len(tokens) - 1)
+        hypothesis.tokens = tokens
+
+        representation = self._encode(hypothesis, first)
+        self._decode(hypothesis, representation, first)
+        self.stats['rows'] += len(tokens)
+        self.stats['rows_computed'] += len(tokens) - first
+        self.stats['steps'] += len(words)
+        self.stats['steps_computed'] += len(words) - first
+        return hypothesis.marks
+
+    def _decode(self, hypothesis, representation, first):
+        contexts, states = self.beam_search.compute_initial_states_and_contexts(
+            {self.representation: representation})[:2]
+        if first > 0:
+            states = hypothesis.decoder_states[first]
+        hypothesis.decoder_states = hypothesis.decoder_states[:first] + [states]
+        hypothesis.marks = hypothesis.marks[:first]
+
+        eos = self.config['trg_eos_idx']
+        for _ in range(first, len(hypothesis.tokens) - 1):
+            logprobs = self.beam_search.compute_logprobs(contexts, states)
+            logprobs[:, eos] = numpy.inf
+            outputs = logprobs.argmin(axis=1)
+            states = dict(states)
+            states.update(self.beam_search.compute_next_states(contexts, states, outputs))
+            hypothesis.decoder_states.append(states)
+            hypothesis.marks.append(self.trg_ivocab.get(outputs[0], '<unk>'))
@@ -0,0 +1,150 @@
+"""Where the time of a training batch goes.
+
+`time_stream_stages` wraps every stage of a Fuel stream (the dataset reads
+at the bottom, then `Filter`, `SortMapping`, `PaddingWithEOS` ...) and
+`PipelineTiming` adds to every row of the training log the time spent
+waiting for data, in each stage, in the Theano step and in each extension
+callback. The mean and 95th percentile of the last `window` batches are
+written to a file in the Prometheus text format, e.g. for the textfile
+collector of the node exporter.
+
+"""
+import numpy
+import os
+import time
+
+from collections import OrderedDict, defaultdict, deque
+
+from blocks.extensions import SimpleExtension
+
+METRIC_NAME = 'punctuation_training_batch_seconds'
+BATCHES_METRIC_NAME = 'punctuation_training_batches_total'
+
+# Names of the main loop callbacks in the profile of Blocks
+CALLBACK_NAMES = ('before_training', 'before_epoch', 'before_batch', 'after_batch',
+                  'after_epoch', 'after_training', 'on_resumption', 'on_interrupt', 'on_error')
+
+
+class StageTimes(object):
+    """Seconds spent in every stage of a stream, outermost stage first."""
+    def __init__(self, names):
+        self.names = names
+        self.cumulative = OrderedDict((name, 0.) for name in names)
+
+    def add(self, name, seconds):
+        self.cumulative[name] += seconds
+
+    def exclusive(self):
+        """Time of every stage without that of the stages it reads from."""
+        cumulative = list(self.cumulative.values()) + [0.]
+        return OrderedDict((name, cumulative[i] - cumulative[i + 1]) for i, name in enumerate(self.names))
+
+
+class _TimedGetData(object):
+    def __init__(self, get_data, times, name):
+        self.get_data = get_data
+        self.times = times
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.get_data(*args, **kwargs)
+        finally:
+            self.times.add(self.name, time.time() - start)
+
+
+def _stage_name(stream):
+    if not hasattr(stream, 'data_stream') and hasattr(stream, 'dataset'):
+        return type(stream.dataset).__name__
+    return type(stream).__name__
+
+
+def time_stream_stages(data_stream):
+    """Times every stream in a chain of transformers, returns the `StageTimes`."""
+    streams = []
+    while data_stream is not None:
+        streams.append(data_stream)
+        data_stream = getattr(data_stream, 'data_stream', None)
+
+    # Repeated stages, e.g. the two `Batch`es, are numbered from the outside
+    names = []
+    seen = defaultdict(int)
+    for stream in streams:
+        name = _stage_name(stream)
+        seen[name] += 1
+        names.append(name if seen[name] == 1 else "{}_{}".format(name, seen[name]))
+
+    times = StageTimes(names)
+    for stream, name in zip(streams, names):
+        stream.get_data = _TimedGetData(stream.get_data, times, name)
+    return times
+
+
+class PipelineTiming(SimpleExtension):
+    """Logs the time of every part of a batch and exports rolling summaries.
+
+    The parts are read from the profile of the main loop, so an extension
+    callback after the training step is counted in the next batch. With
+    `stage_times` from `time_stream_stages` the data wait is split further
+    by stream stage. The summaries are written to `path` every
+    `export_every` batches.
+
+    """
+    def __init__(self, path, stage_times=None, window=100, export_every=10, **kwargs):
+        kwargs.setdefault('after_batch', True)
+        super(PipelineTiming, self).__init__(**kwargs)
+        self.path = path
+        self.stage_times = stage_times
+        self.window = window
+        self.export_every = export_every
+        self.history = defaultdict(lambda: deque(maxlen=window))
+        self.previous = {}
+        self.batches = 0
+
+    def _parts(self):
+        """Seconds spent in every part since the previous call."""
+        totals = defaultdict(float)
+        for key, seconds in self.main_loop.profile.total.items():
+            if key[-1] == 'read_data':
+                totals[('data_wait', '')] += seconds
+            elif key[-1] == 'train':
+                totals[('compute', '')] += seconds
+            elif len(key) > 1 and key[-2] in CALLBACK_NAMES:
+                totals[('extension', key[-1])] += seconds
+        if self.stage_times is not None:
+            for name, seconds in self.stage_times.exclusive().items():
+                totals[('stage', name)] = seconds
+
+        parts = OrderedDict()
+        for part in sorted(totals):
+            parts[part] = totals[part] - self.previous.get(part, 0.)
+        self.previous = totals
+        return parts
+
+    def do(self, which_callback, *args):
+        current_row = self.main_loop.log.current_row
+        for (kind, name), seconds in self._parts().items():
+            current_row['time_{}'.format("_".join(filter(None, (kind, name))))] = seconds
+            self.history[(kind, name)].append(seconds)
+
+        self.batches += 1
+        if self.batches % self.export_every == 0:
+            self.export()
+
+    def export(self):
+        lines = ["# HELP {} Time of the parts of a training batch over the last {} batches".format(
+                     METRIC_NAME, self.window),
+                 "# TYPE {} gauge".format(METRIC_NAME)]
+        for (kind, name), values in sorted(self.history.items()):
+            labels = 'kind="{}"'.format(kind) + (',name="{}"'.format(name) if name else '')
+            lines.append('{}{{{},stat="mean"}} {:.6f}'.format(METRIC_NAME, labels, numpy.mean(values)))
+            lines.append('{}{{{},stat="p95"}} {:.6f}'.format(METRIC_NAME, labels, numpy.percentile(values, 95)))
+        lines.append("# TYPE {} counter".format(BATCHES_METRIC_NAME))
+        lines.append("{} {}".format(BATCHES_METRIC_NAME, self.batches))
+
+        # Readers never see a partially written file
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(temporary, self.path)
@@ -0,0 +1,107 @@
+import json
+import logging
+import numpy
+import os
+
+from blocks.log import TrainingLog
+
+logger = logging.getLogger(__name__)
+
+LOG_RECORDS_FILENAME = 'log.jsonl'
+
+
+def _to_json(value):
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(x) for x in value]
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def iter_log_records(path):
+    """Yields the per-batch records written by `AppendOnlyLog`."""
+    with open(path, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class AppendOnlyLog(TrainingLog):
+    """Training log which appends finished rows to a JSON lines file.
+
+    Only the current and the previous row are kept in memory, older rows
+    are written to `path` one record per line. Checkpoints store a small
+    cursor (see `cursor`) instead of the whole log, so the size and the
+    time of a dump do not grow with the number of batches.
+
+    """
+    def __init__(self, path):
+        super(AppendOnlyLog, self).__init__()
+        self.path = path
+        self.flushed = -1
+        self._file = None
+
+    def __missing__(self, time):
+        # Rows which were already written are not resurrected
+        if time <= self.flushed:
+            return {}
+        self.flush(before=time - 1)
+        return super(AppendOnlyLog, self).__missing__(time)
+
+    def _open(self):
+        if self._file is None:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._file = open(self.path, 'a')
+        return self._file
+
+    def flush(self, before):
+        """Writes and forgets all rows older than `before`."""
+        times = sorted(time for time in self.keys() if time < before)
+        if not times:
+            return
+
+        f = self._open()
+        for time in times:
+            record = _to_json(dict.pop(self, time))
+            record['iteration'] = time
+            f.write(json.dumps(record) + '\n')
+        self.flushed = times[-1]
+
+    def cursor(self):
+        """Returns what is needed to resume the log from a checkpoint."""
+        self.flush(before=self.status['iterations_done'] - 1)
+        f = self._open()
+        f.flush()
+        os.fsync(f.fileno())
+
+        return {'offset': f.tell(),
+                'flushed': self.flushed,
+                'uuid': self.uuid,
+                'status': dict(self.status),
+                'rows': {time: dict(row) for time, row in self.items()}}
+
+    @classmethod
+    def from_cursor(cls, cursor, path):
+        """Restores the log, dropping records written after the cursor."""
+        log = cls(path)
+        if os.path.exists(path) and os.path.getsize(path) > cursor['offset']:
+            logger.info(" Truncating {} to the checkpointed offset".format(path))
+            with open(path, 'r+') as f:
+                f.truncate(cursor['offset'])
+
+        log.flushed = cursor['flushed']
+        log.uuid = cursor['uuid']
+        log.status.update(cursor['status'])
+        for time, row in cursor['rows'].items():
+            dict.__setitem__(log, time, row)
+        return log
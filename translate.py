@@ -1,7 +1,9 @@
 import logging
+import multiprocessing
 import numpy
 import os
 import pickle
+import time
 
 import theano
 from theano import tensor
@@ -10,42 +12,58 @@ from blocks.model import Model
 from blocks.select import Selector
 from blocks.filter import VariableFilter
 from blocks.graph import ComputationGraph
-from blocks.search import BeamSearch
 
 from collections import OrderedDict
-from helpers import create_model
+from six.moves import queue
+from helpers import create_model, uses_prosody
 from model import BidirectionalEncoder, Decoder
 from stream import get_dev_stream
+from kaldi_data import get_kaldi_stream
 from sampling import SamplingBase
+from search import create_beam_search, merge_punctuation
 from checkpoint import LoadNMT
+from parallel import check_thread_count
 
 
 logger = logging.getLogger(__name__)
 theano.config.on_unused_input = 'warn'
 
+# Bytes of output buffered before writing to the file
+OUTPUT_BUFFER_SIZE = 1 << 16
+
+# Seconds to wait for a result before checking that the workers still run
+WORKER_POLL_SECONDS = 1
+
 def tile(x, beam_size):
     return numpy.tile(x, (beam_size,) + (1,) * x.ndim)
 
-def main(config, model_dir, model_filename, data_path, input, output):
+def translate(config, model_dir, model_filename, data_path, alignment_dir=None, shard=None):
+    """Punctuates the dev set of `data_path`.
+
+    With `alignment_dir`, `data_path` is a Kaldi data directory which is
+    featurized on the fly instead of an HDF5 file. With `shard` (rank,
+    workers) only every workers-th utterance is punctuated. Yields the
+    index in the whole set, the uttid, the punctuated text, the number of
+    words and the cost of every utterance.
+
+    """
     logger.info("Loading the model..")
     cost, samples, search_model = create_model(config)
     loader = LoadNMT(model_dir, model_filename)
-    loader.set_model_parameters(search_model, loader.load_parameters())
-    beam_search = BeamSearch(samples=samples)
+    loader.set_model_parameters(search_model, loader.load_parameters(), borrow=True)
+    beam_search = create_beam_search(config, samples)
 
     # Get test set stream
-    test_stream = get_dev_stream(data_path)
-    ftrans = open(output, 'w')
+    if alignment_dir is not None:
+        test_stream = get_kaldi_stream(config, data_path, alignment_dir, prosody=uses_prosody(config), shard=shard)
+    else:
+        test_stream = get_dev_stream(data_path, prosody=uses_prosody(config), shard=shard)
+    rank, workers = shard or (0, 1)
 
     # Helper utilities
     sutils = SamplingBase()
     trg_eos_idx = config['trg_eos_idx']
     trg_ivocab = {v: k for k, v in config["trg_vocab"].items()}
-    src_ivocab = {v: k for k, v in config["src_vocab"].items()}
-
-
-    logger.info("Started translation: ")
-    total_cost = 0.0
 
     for i, line in enumerate(test_stream.get_epoch_iterator()):
         beam_size = config['beam_size']
@@ -68,7 +86,7 @@ def main(config, model_dir, model_filename, data_path, input, output):
 
         best = numpy.argsort(costs)[0]
         try:
-            total_cost += costs[best]
+            best_cost = costs[best]
             trans_out = trans[best]
 
             # convert idx to words
@@ -76,31 +94,119 @@ def main(config, model_dir, model_filename, data_path, input, output):
 
         except ValueError:
             logger.info("Can NOT find a translation for line: {}".format(i+1))
+            best_cost = 0.0
             trans_out = '<UNK>'
 
         source_words = original.strip().split()[:-1]
         target_words = trans_out.split()
+        output = merge_punctuation(source_words, target_words, config["punctuation_marks"])
+
+        yield rank + i * workers, uttid, " ".join(output), len(source_words), best_cost
+
+    if config['beam_margin'] is not None:
+        logger.info("Decoded {:.1%} of the steps greedily".format(beam_search.greedy_fraction))
+
+
+def _translate_worker(rank, workers, results, args):
+    try:
+        for result in translate(*args, shard=(rank, workers)):
+            results.put(result)
+    finally:
+        results.put(rank)
+
+
+def translate_in_workers(workers, *args):
+    """Runs `translate` on `workers` shards in separate processes.
+
+    Every worker loads the model once. The results are yielded in the
+    order of the whole set, each as soon as all the previous ones arrived.
+    Raises as soon as a worker fails, without yielding anything after the
+    first missing result.
+
+    """
+    check_thread_count()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_translate_worker, args=(rank, workers, results, args))
+                 for rank in range(workers)]
+    for process in processes:
+        process.start()
+
+    pending = {}
+    next_index = 0
+    finished = set()
+    try:
+        while len(finished) < workers:
+            try:
+                result = results.get(timeout=WORKER_POLL_SECONDS)
+            except queue.Empty:
+                # A worker killed by a signal never sends that it finished
+                failed = [rank for rank, process in enumerate(processes) if process.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError("Workers {} failed".format(failed))
+                continue
+            if not isinstance(result, tuple):
+                finished.add(result)
+                continue
+            pending[result[0]] = result
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+
+        for process in processes:
+            process.join()
+        failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError("Workers {} failed".format(failed))
+        if pending:
+            raise RuntimeError("Result {} is missing".format(next_index))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+def main(config, model_dir, model_filename, data_path, input, output, alignment_dir=None, workers=1):
+    """Writes the punctuated dev set of `data_path` to `output`.
+
+    With more than one worker the set is decoded in that many processes
+    (see `translate_in_workers`) and the lines are only written to
+    `output`, with `workers` 1 they are printed as well.
+
+    """
+    if workers > 1:
+        results = translate_in_workers(workers, config, model_dir, model_filename, data_path, alignment_dir)
+    else:
+        results = translate(config, model_dir, model_filename, data_path, alignment_dir)
+    ftrans = open(output, 'w', OUTPUT_BUFFER_SIZE)
 
-        output = []
-        for (word, punct) in zip(source_words, target_words):
-            if punct in config["punctuation_marks"]:
-                output.append(word)
-                output.append(punct)
-            else:
-                output.append(word)
-
-        if len(source_words) > len(target_words):
-            output.extend(source_words[len(target_words):])
-
-
-        print uttid, " ".join(output)
-        print >> ftrans, uttid, " ".join(output)
-
-        if i != 0 and i % 100 == 0:
-            logger.info("Translated {} lines of test set...".format(i))
-
+    logger.info("Started translation: ")
+    total_cost = 0.0
+    total_words = 0
+    lines = 0
+    start = time.time()
+
+    try:
+        for (_, uttid, text, num_words, cost) in results:
+            total_cost += cost
+            total_words += num_words
+            lines += 1
+
+            if workers == 1:
+                print uttid, text
+            print >> ftrans, uttid, text
+
+            if lines % 100 == 0:
+                elapsed = time.time() - start
+                logger.info("Translated {} lines of test set, {:.2f} utterances/s, {:.1f} words/s".format(
+                    lines, lines / elapsed, total_words / elapsed))
+    finally:
+        ftrans.close()
+
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info("Translated {} lines in {:.1f}s, {:.2f} utterances/s, {:.1f} words/s".format(
+        lines, elapsed, lines / elapsed, total_words / elapsed))
     logger.info("Total cost of the test: {}".format(total_cost))
-    ftrans.close()
 
 
 if __name__ == "__main__":
@@ -115,3 +221,10 @@ if __name__ == "__main__":
     data_path = "%s/data_global_cmvn_with_phones_alignment.h5" % config["data_dir"]
 
     main(config, model_dir, model_filename, data_path, "../nmt_punctuation/dev_raw.txt", "punctuated_dev.txt")
+
+    # To punctuate a new ASR output without building an HDF5 file
+    # main(config, model_dir, model_filename, config["best_asr_data_dir"], None, "punctuated_best_asr.txt",
+    #      alignment_dir=config["best_asr_alignment_dir"])
+
+    # To decode in several processes, e.g. with OMP_NUM_THREADS=1
+    # main(config, model_dir, model_filename, data_path, None, "punctuated_dev.txt", workers=8)
@@ -0,0 +1,96 @@
+"""Punctuation of transcripts of any length in overlapping windows.
+
+A long transcript is split into windows of at most config['window_words']
+words which share at least config['window_overlap'] words with the
+previous window. Each window starts right after the longest pause near
+the end of the previous one, so that windows rarely start within a
+sentence. The windows are decoded in batches by the `Punctuator` of
+server.py, so memory depends only on the window and batch sizes, and
+every word in an overlap gets the mark of the window which is most sure
+about it.
+
+"""
+import numpy
+
+
+def split_windows(pauses, window, overlap):
+    """Returns the (start, end) word ranges of the windows.
+
+    `pauses` holds the pause after every word. Every window but the first
+    starts after the longest pause which leaves it between `overlap` and
+    2 `overlap` words in common with the previous window.
+
+    """
+    if window <= 2 * overlap:
+        raise ValueError("Windows have to be longer than twice the overlap")
+    windows = []
+    start = 0
+    while True:
+        end = min(start + window, len(pauses))
+        windows.append((start, end))
+        if end == len(pauses):
+            return windows
+        start = max(range(end - 2 * overlap, end - overlap + 1), key=lambda i: pauses[i - 1])
+
+
+def word_pauses(request):
+    """Pause after every word of a request, from its prosody or word ends."""
+    words = len(request['words'])
+    if 'prosody' in request:
+        return numpy.asarray(request['prosody'])[:words, 2]
+    if 'words_ends' in request:
+        # Frames between word ends, i.e. the next word with the pause before it
+        ends = numpy.asarray(request['words_ends'][:words])
+        return numpy.append(numpy.diff(ends), 0)
+    return numpy.zeros(words)
+
+
+def window_request(request, start, end):
+    """The part of a request (see server.py) with the words start to end."""
+    words = len(request['words'])
+    window = {'words': request['words'][start:end]}
+    first_frame = 0
+    if 'words_ends' in request:
+        ends = numpy.asarray(request['words_ends'][:words])
+        if start > 0:
+            first_frame = ends[start - 1] + 1
+        window['words_ends'] = (ends[start:end] - first_frame).tolist()
+        if 'audio' in request:
+            last_frame = ends[end - 1] + 1 if end < words else len(request['audio'])
+            window['audio'] = request['audio'][first_frame:last_frame]
+    if 'prosody' in request:
+        prosody = numpy.asarray(request['prosody'])
+        window['prosody'] = numpy.concatenate([prosody[start:end], numpy.zeros_like(prosody[:1])]).tolist()
+
+    unsupported = set(request) - set(window)
+    if unsupported:
+        raise ValueError("Can not split {} into windows".format(", ".join(sorted(unsupported))))
+    return window
+
+
+class WindowedPunctuator(object):
+    """Punctuates requests of any length with a `Punctuator`."""
+
+    def __init__(self, punctuator, window, overlap, batch_size=16):
+        self.punctuator = punctuator
+        self.window = window
+        self.overlap = overlap
+        self.batch_size = batch_size
+
+    def punctuate(self, request):
+        """Returns the mark after every word and its probability."""
+        words = len(request['words'])
+        windows = split_windows(word_pauses(request), self.window, self.overlap)
+        marks = [None] * words
+        scores = numpy.zeros(words) - 1
+
+        for i in range(0, len(windows), self.batch_size):
+            batch = windows[i:i + self.batch_size]
+            examples = [self.punctuator.featurize(window_request(request, start, end))
+                        for start, end in batch]
+            for (start, _), result in zip(batch, self.punctuator.punctuate(examples)):
+                for j, (mark, score) in enumerate(zip(result['punctuation'], result['scores'])):
+                    if score > scores[start + j]:
+                        marks[start + j] = mark
+                        scores[start + j] = score
+        return marks, scores